@@ -69,7 +69,11 @@ to the user.
 
 import os, tempfile, shutil, subprocess, re
 
-from StringIO import StringIO
+# talking with gpg processes
+import select, errno, fcntl, time, threading, Queue
+
+# caches and indexes of keys
+import copy, json, hashlib, sqlite3, bisect
 
 import monkeysign.translation
 
@@ -81,8 +85,11 @@ class Context():
     GPG as a process.
 
     It uses the gpg-agent to prompt for passphrases and communicates
-    with GPG over the stdin for commnads (--command-fd) and stdout for
-    status (--status-fd).
+    with GPG over the stdin for commnads (--command-fd) and a private
+    pipe for status (--status-fd, see status_pipe below).
+
+    Commands return a GpgResult and nothing about them is kept on the
+    context, so it can be shared between threads.
     """
 
     # the gpg binary to call
@@ -107,6 +114,44 @@ class Context():
     # if not false, needs to be a file descriptor
     debug = False
 
+    # how long to wait for gpg during a single step of a conversation
+    # with it (e.g. between a command and its GOT_IT), in seconds
+    #
+    # None means to wait forever
+    timeout = 60
+
+    # how long to wait for the user to enter a passphrase in the agent
+    passphrase_timeout = 300
+
+    # how long a single gpg process is allowed to run, in seconds
+    #
+    # None means to wait forever
+    deadline = None
+
+    # whether gpg should write status lines to a private pipe instead
+    # of the status-fd option, which mixes them with diagnostics on
+    # stderr
+    status_pipe = True
+
+    # whether gpg should write diagnostics (--logger-fd) to a private
+    # pipe instead of stderr
+    logger_pipe = False
+
+    # where the probed capabilities of gpg binaries are saved, see
+    # capabilities()
+    capabilities_cache = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'monkeysign', 'gpg-capabilities.json')
+
+    # binary path => ([dev, inode, mtime, size], GpgCapabilities)
+    capabilities_probed = {}
+    capabilities_lock = threading.Lock()
+
+    # functions called with the metrics of every gpg process, see
+    # GpgSession.metrics() and MetricsCounter
+    #
+    # sinks added here see all processes, set this on a context to
+    # only see its processes
+    sinks = []
+
     def __init__(self):
         self.options = dict(Context.options) # copy
 
@@ -126,7 +171,7 @@ class Context():
         else:
             return false
 
-    def build_command(self, command):
+    def build_command(self, command, overrides = None):
         """internal helper to build a proper gpg commandline
 
         this will add relevant arguments around the gpg binary.
@@ -146,44 +191,118 @@ class Context():
         it is here that the options dictionary is converted into a
         list. the command argument is expected to be a list of
         arguments that can be converted to strings. if it is not a
-        list, it is cast into a list."""
+        list, it is cast into a list.
+
+        the overrides dictionary can be used to change options for
+        this command only. an override of False removes the option."""
         options = []
-        for left, right in self.options.iteritems():
+        if overrides:
+            opts = dict(self.options)
+            opts.update(overrides)
+        else:
+            opts = self.options
+        # items() copies, in case another thread changes the options
+        for left, right in opts.items():
+            if right is False:
+                continue
             options += ['--' + left]
             if right is not None:
                 options += [str(right)]
         if type(command) is str:
             command = [command]
+        else:
+            command = list(command)
         if len(command) > 0 and command[0][0:2] != '--':
             command[0] = '--' + command[0]
         return [self.gpg_binary] + options + command
 
-    def call_command(self, command, stdin=None):
+    def call_command(self, command, stdin=None, output=None, handlers=None, overrides=None):
         """internal wrapper to call a GPG commandline
 
         this will call the command generated by build_command() and
-        setup a regular pipe to the subcommand.
+        setup a regular pipe to the subcommand, through a GpgSession.
 
         this assumes that we have the status-fd on stdout and
         command-fd on stdin, but could really be used in any other
         way.
 
-        we pass the stdin argument in the standard input of gpg and we
-        keep the output in the stdout and stderr array. the exit code
-        is in the returncode variable.
+        we pass the stdin argument in the standard input of gpg and
+        return a GpgResult with the output, status lines and exit
+        code of gpg. nothing is kept on the context, so it can be
+        used by many threads at once. the process is killed and a
+        GpgTimeoutError is raised if it runs past the deadline.
+
+        if an output file object is given, the standard output of gpg
+        is written there as it comes instead of being kept in the
+        result.
 
-        we can optionnally watch for a confirmation pattern on the
-        statusfd.
+        handlers for status events can be passed to be called as
+        status lines come in, see StatusParser. options can be
+        changed for this command only with overrides, see
+        build_command().
         """
-        proc = subprocess.Popen(self.build_command(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (self.stdout, self.stderr) = proc.communicate(stdin)
-        self.returncode = proc.returncode
+        session = self.session(command, handlers, overrides)
+        if output is not None:
+            session.stdout.sink = output.write
+        session.communicate(stdin)
+        return self.result(session)
+
+    def stream_command(self, command, stdin=None, handlers=None, overrides=None):
+        """call a GPG commandline, yielding its output as it comes
+
+        this is like call_command(), but returns a GpgStream, which
+        iterates over the chunks of the standard output of gpg
+        without keeping them in memory.
+        """
+        return GpgStream(self, self.session(command, handlers, overrides), stdin)
+
+    def session(self, command, handlers=None, overrides=None, stdin=None):
+        """start a GpgSession for the command
+
+        status handlers are called as status lines come in, see
+        StatusParser. gpg reads from the given stdin file, if any,
+        see GpgSession."""
+        session = GpgSession(self, command, overrides, stdin)
+        if handlers:
+            session.status.parser = StatusParser(handlers)
+        return session
+
+    def report(self, session):
+        """pass the metrics of a finished session to the sinks"""
+        if self.sinks:
+            metrics = session.metrics()
+            for sink in self.sinks:
+                sink(metrics)
+
+    def result(self, session):
+        """the GpgResult of a completed session"""
+        result = GpgResult.from_session(session)
         if self.debug:
-            print >>self.debug, 'command:', self.build_command(command)
-            print >>self.debug, 'ret:', self.returncode, 'stdout:', self.stdout, 'stderr:', self.stderr
-        return proc.returncode == 0
+            print >>self.debug, 'command:', result.command
+            print >>self.debug, 'ret:', result.returncode, 'stdout:', result.stdout, 'stderr:', result.stderr
+        return result
+
+    @staticmethod
+    def _returncode(fd):
+        """the exit code of gpg, for errors raised while reading fd"""
+        if isinstance(fd, SessionStream):
+            return fd.session.returncode
+        return None
+
+    def readline(self, fd, timeout = None):
+        """read a line from a file descriptor or a GpgSession stream
+
+        the timeout is only supported on GpgSession streams, which
+        will raise a GpgTimeoutError if no line shows up in time. by
+        default, the timeout of the context is used.
+        """
+        if isinstance(fd, SessionStream):
+            if timeout is None:
+                timeout = self.timeout
+            return fd.readline(timeout)
+        return fd.readline()
 
-    def seek_pattern(self, fd, pattern):
+    def seek_pattern(self, fd, pattern, timeout = None):
         """iterate over file descriptor until certain pattern is found
 
         fd is a file descriptor
@@ -193,29 +312,61 @@ class Context():
         found. it will raise an IOError if the pattern is not found
         and EOF is reached.
 
-        this may hang for streams that do not send EOF or are waiting
-        for input.
+        this may hang for regular streams that do not send EOF or are
+        waiting for input. GpgSession streams will instead raise a
+        GpgTimeoutError after the given timeout (see readline()).
         """
-        line = fd.readline()
+        line = self.readline(fd, timeout)
         match = re.search(pattern, line)
         while line and not match:
             if self.debug: print >>self.debug, "skipped:", line,
-            line = fd.readline()
+            line = self.readline(fd, timeout)
             match = re.search(pattern, line)
         if match:
             if self.debug: print >>self.debug, "FOUND:", line,
             return match
         else:
-            raise GpgProtocolError(self.returncode, _("could not find pattern '%s' in input") % pattern)
+            raise GpgProtocolError(self._returncode(fd), _("could not find pattern '%s' in input") % pattern)
 
-    def seek(self, fd, pattern):
-        """look for a specific GNUPG status line in the output
+    def read_status(self, fd, timeout = None):
+        """return the next status event found on the file descriptor
 
-        this is a stub for seek_pattern()
+        lines that are not status lines (e.g. human-readable messages
+        on stderr) are skipped. this returns None at EOF.
         """
-        return self.seek_pattern(fd, '^\[GNUPG:\] ' + pattern)
+        line = self.readline(fd, timeout)
+        while line:
+            event = StatusParser.parse_line(line)
+            if event is not None:
+                return event
+            if self.debug: print >>self.debug, "skipped:", line,
+            line = self.readline(fd, timeout)
+        return None
 
-    def expect_pattern(self, fd, pattern):
+    def seek(self, fd, pattern, timeout = None):
+        """look for a specific GNUPG status line in the output
+
+        the pattern is a status keyword, optionally followed by the
+        first arguments expected, for example "GET_LINE
+        keyedit.prompt". status lines not matching the pattern are
+        skipped.
+
+        this returns the matching StatusEvent or raises an IOError if
+        the pattern is not found and EOF is reached, like
+        seek_pattern().
+        """
+        args = pattern.split(' ')
+        keyword = args.pop(0)
+        event = self.read_status(fd, timeout)
+        while event is not None and not event.match(keyword, args):
+            if self.debug: print >>self.debug, "skipped:", event
+            event = self.read_status(fd, timeout)
+        if event is None:
+            raise GpgProtocolError(self._returncode(fd), _("could not find pattern '%s' in input") % pattern)
+        if self.debug: print >>self.debug, "FOUND:", event
+        return event
+
+    def expect_pattern(self, fd, pattern, timeout = None):
         """make sure the next line matches the provided pattern
 
         in contrast with seek_pattern(), this will *not* skip
@@ -225,28 +376,1012 @@ class Context():
         this therefore looks only at the next line, but may also hang
         like seek_pattern()
         """
-        line = fd.readline()
+        line = self.readline(fd, timeout)
         match = re.search(pattern, line)
 
         if self.debug:
             if match: print >>self.debug, "FOUND:", line,
             else: print >>self.debug, "SKIPPED:", line,
         if not match:
-            raise GpgProtocolError(self.returncode, 'expected "%s", found "%s"' % (pattern, line))
+            raise GpgProtocolError(self._returncode(fd), 'expected "%s", found "%s"' % (pattern, line))
         return match
 
-    def expect(self, fd, pattern):
+    def expect(self, fd, pattern, timeout = None):
         """look for a specific GNUPG status on the next line of output
 
-        this is a stub for expect()
+        this is similar to expect_pattern(), but looks only at the
+        next status line, with the pattern of seek(). informational
+        status lines (see StatusParser.informational) are skipped,
+        as gpg interleaves those with the dialog.
         """
-        return self.expect_pattern(fd, '^\[GNUPG:\] ' + pattern)
+        args = pattern.split(' ')
+        keyword = args.pop(0)
+        event = self.read_status(fd, timeout)
+        while event is not None and event.keyword in StatusParser.informational and not event.match(keyword, args):
+            if self.debug: print >>self.debug, "skipped:", event
+            event = self.read_status(fd, timeout)
+        if event is None or not event.match(keyword, args):
+            if self.debug: print >>self.debug, "SKIPPED:", event
+            raise GpgProtocolError(self._returncode(fd), 'expected "%s", found "%s"' % (pattern, event or ''))
+        if self.debug: print >>self.debug, "FOUND:", event
+        return event
 
     def version(self):
         """return the version of the GPG binary"""
-        self.call_command(['version'])
-        m = re.search('gpg \(GnuPG\) (\d+.\d+(?:.\d+)*)', self.stdout)
-        return m.group(1)
+        return self.capabilities().version
+
+    def capabilities(self):
+        """what the GPG binary can do, as a GpgCapabilities object
+
+        gpg is only probed the first time this is called for a given
+        binary, and the result is kept in memory and on disk, in the
+        capabilities_cache file. gpg is probed again if the binary
+        changes, which is detected through its inode and mtime.
+        """
+        path = self.find_binary()
+        try:
+            st = os.stat(path)
+            key = [st.st_dev, st.st_ino, st.st_mtime, st.st_size]
+        except OSError:
+            key = None
+        with Context.capabilities_lock:
+            cached = Context.capabilities_probed.get(path)
+            if cached is not None and key is not None and cached[0] == key:
+                return cached[1]
+            cache = self.read_capabilities_cache()
+            entry = cache.get(path)
+            if entry is not None and key is not None and entry.get('key') == key:
+                capabilities = GpgCapabilities.from_dict(entry)
+            else:
+                capabilities = GpgCapabilities.probe(self)
+                if key is not None:
+                    entry = capabilities.to_dict()
+                    entry['key'] = key
+                    cache[path] = entry
+                    self.write_capabilities_cache(cache)
+            Context.capabilities_probed[path] = (key, capabilities)
+            return capabilities
+
+    def find_binary(self):
+        """the full path to the gpg binary, looked up in the PATH"""
+        if os.path.dirname(self.gpg_binary):
+            return os.path.abspath(self.gpg_binary)
+        for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            path = os.path.join(directory, self.gpg_binary)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+        return self.gpg_binary
+
+    def read_capabilities_cache(self):
+        """the capabilities saved on disk, by binary path"""
+        try:
+            with open(self.capabilities_cache) as fd:
+                cache = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        return cache
+
+    def write_capabilities_cache(self, cache):
+        """save the capabilities on disk, failing silently
+
+        the file is replaced atomically, in case other processes
+        read it at the same time."""
+        directory = os.path.dirname(self.capabilities_cache)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            (fd, tmp) = tempfile.mkstemp(dir=directory, prefix='.capabilities-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, self.capabilities_cache)
+        except (IOError, OSError):
+            pass # this is only a cache
+
+class GpgCapabilities(object):
+    """what a gpg binary can do, see Context.capabilities()
+
+    this knows the version of gpg, the long options (and commands)
+    it supports and how it uses the agent, which is one of:
+
+     * optional: the agent is used if --use-agent is given (1.x)
+     * use-agent: same, but gpg-agent handles passphrases (2.0)
+     * always: gpg always talks to the agent, even for keys (2.1+)
+    """
+
+    def __init__(self, version, options = (), agent = None):
+        self.version = version
+        self.options = set(options)
+        if agent is None:
+            agent = self.agent_mode(version)
+        self.agent = agent
+
+    @staticmethod
+    def probe(context):
+        """ask gpg what it can do"""
+        result = context.call_command(['version'])
+        m = re.search('gpg \(GnuPG\) (\d+.\d+(?:.\d+)*)', result.stdout)
+        if m is None:
+            raise GpgRuntimeError(result.returncode, _('cannot find GnuPG version: %s') % result.error_message())
+        options = []
+        result = context.call_command(['dump-options'])
+        if result:
+            options = [ line[2:] for line in result.stdout.split("\n") if line.startswith('--') ]
+        return GpgCapabilities(m.group(1), options)
+
+    @property
+    def version_info(self):
+        """the version as a tuple of integers, for comparisons"""
+        return tuple([ int(x) for x in self.version.split('.') ])
+
+    @staticmethod
+    def agent_mode(version):
+        version = tuple([ int(x) for x in version.split('.')[:2] ])
+        if version >= (2, 1):
+            return 'always'
+        elif version >= (2, 0):
+            return 'use-agent'
+        return 'optional'
+
+    def supports(self, option):
+        """if gpg knows about the given option or command
+
+        the option is given with or without leading dashes, for
+        example 'quick-sign-key' or '--export-filter'."""
+        return option.lstrip('-') in self.options
+
+    def to_dict(self):
+        return { 'version': self.version,
+                 'options': sorted(self.options),
+                 'agent': self.agent }
+
+    @classmethod
+    def from_dict(cls, data):
+        # json gives us unicode strings
+        return cls(str(data['version']), [ str(o) for o in data.get('options', []) ], str(data.get('agent')))
+
+    def __repr__(self):
+        return '<GpgCapabilities %s, agent %s, %d options>' % (self.version, self.agent, len(self.options))
+
+class StatusEvent(object):
+    """a status line from gpg, split in a keyword and its arguments
+
+    see doc/DETAILS in the GnuPG source for the meaning of those.
+    """
+
+    # there can be tens of thousands of those in a big import
+    __slots__ = ('keyword', 'args', 'line')
+
+    def __init__(self, keyword, args, line = None):
+        self.keyword = keyword
+        self.args = args
+        # the original line, for display
+        self.line = line
+
+    def match(self, keyword, args = []):
+        """check if this is the given status with the given first arguments"""
+        return self.keyword == keyword and self.args[:len(args)] == args
+
+    def __str__(self):
+        if self.line is not None:
+            return self.line.rstrip("\n")
+        return StatusParser.prefix + ' '.join([self.keyword] + self.args)
+
+class StatusParser():
+    """tokenizer for the status lines gpg writes on the --status-fd
+
+    every status line is split once into a keyword and its arguments,
+    and turned into a StatusEvent. events can be consumed by iterating
+    over parse() or feed(), and handlers can be registered per keyword
+    to be called as events are found. for example, this counts keys
+    imported:
+
+        counts = {'IMPORT_OK': 0}
+        def count(event):
+            counts[event.keyword] += 1
+        parser = StatusParser({'IMPORT_OK': count})
+        for event in parser.parse(stderr):
+            pass
+
+    lines which are not status lines are ignored.
+    """
+
+    # what every status line starts with
+    prefix = '[GNUPG:] '
+
+    # status keywords that only inform us of what gpg is doing and
+    # that can show up in the middle of a dialog, see Context.expect()
+    informational = set(['KEY_CONSIDERED',
+                         'PINENTRY_LAUNCHED',
+                         'PROGRESS',
+                         'USERID_HINT',
+                         'NEED_PASSPHRASE',
+                         'INQUIRE_MAXLEN',
+                         ])
+
+    def __init__(self, handlers = None):
+        # keyword => function called with each matching StatusEvent
+        self.handlers = {}
+        if handlers is not None:
+            self.handlers.update(handlers)
+        # incomplete line left over by feed()
+        self.partial = ''
+
+    @staticmethod
+    def parse_line(line):
+        """parse a single line, returning None if it's not a status line"""
+        if not line.startswith(StatusParser.prefix):
+            return None
+        fields = line[len(StatusParser.prefix):].rstrip("\r\n").split(' ')
+        return StatusEvent(fields[0], fields[1:], line)
+
+    def dispatch(self, event):
+        """call the handler registered for the event, if any"""
+        handler = self.handlers.get(event.keyword)
+        if handler is not None:
+            handler(event)
+        return event
+
+    def parse(self, source, keywords = None):
+        """iterate over the events found in the source
+
+        the source is either a string or an iterable of lines, like a
+        file object.
+
+        if a list of keywords is given, only those events are
+        returned, which saves creating events we do not care about.
+        """
+        if isinstance(source, basestring):
+            source = source.split("\n")
+        if keywords is not None:
+            keywords = set(keywords)
+        prefix = self.prefix
+        start = len(prefix)
+        handlers = self.handlers
+        # this is parse_line() and dispatch() inlined, as this loop
+        # runs for every status line
+        for line in source:
+            if not line.startswith(prefix):
+                continue
+            fields = line[start:].rstrip("\r\n").split(' ')
+            if keywords is not None and fields[0] not in keywords:
+                continue
+            event = StatusEvent(fields[0], fields[1:], line)
+            if handlers:
+                handler = handlers.get(event.keyword)
+                if handler is not None:
+                    handler(event)
+            yield event
+
+    def feed(self, data):
+        """parse a chunk of data read from gpg
+
+        partial lines are kept until the next call, or close(). this
+        returns the list of events found."""
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        return list(self.parse(lines))
+
+    def close(self):
+        """parse whatever is left after the last feed()"""
+        (data, self.partial) = (self.partial, '')
+        return list(self.parse([data]))
+
+class GpgResult(object):
+    """the outcome of a single gpg command
+
+    this holds everything gpg said during the command, its exit code
+    and how long it ran. results are immutable so they can be shared
+    between threads, and evaluate to true if the command succeeded:
+
+        result = context.call_command(['list-keys'])
+        if result:
+            print result.stdout
+
+    status lines are in status and diagnostics in logger, those are
+    the same as stderr if status_pipe or logger_pipe are off in the
+    context. the parsed status lines are available as events.
+    """
+
+    __slots__ = ('command', 'returncode', 'stdout', 'stderr', 'status', 'logger', 'started', 'elapsed', '_events')
+
+    def __init__(self, command, returncode, stdout = '', stderr = '', status = '', logger = '', started = None, elapsed = None):
+        for name, value in [('command', command),
+                            ('returncode', returncode),
+                            ('stdout', stdout),
+                            ('stderr', stderr),
+                            ('status', status),
+                            ('logger', logger),
+                            ('started', started),
+                            ('elapsed', elapsed),
+                            ('_events', None)]:
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_session(cls, session):
+        """the result of a completed GpgSession"""
+        elapsed = session.elapsed
+        if elapsed is None:
+            elapsed = time.time() - session.started
+        return cls(session.command, session.returncode,
+                   session.stdout.getvalue(), session.stderr.getvalue(),
+                   session.status.getvalue(), session.logger.getvalue(),
+                   session.started, elapsed)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(_('gpg results cannot be modified'))
+
+    def __nonzero__(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return '<GpgResult %s: %s>' % (' '.join(self.command), self.returncode)
+
+    @property
+    def events(self):
+        """the StatusEvents found in the status output, parsed once"""
+        if self._events is None:
+            object.__setattr__(self, '_events', tuple(StatusParser().parse(self.status)))
+        return self._events
+
+    def error_message(self):
+        """the last diagnostic gpg printed during the command
+
+        this is what is shown to the user when a command fails, and
+        skips status lines, in case those are mixed with diagnostics.
+        """
+        for line in reversed(self.logger.split("\n")):
+            if line and not line.startswith(StatusParser.prefix):
+                return line
+        return ''
+
+class ImportResult(object):
+    """what gpg did with every key during an import
+
+    this collects the IMPORT_OK, IMPORT_PROBLEM and IMPORT_RES status
+    lines of an import, as they come in. keys maps the fingerprint of
+    every key imported to the IMPORT_OK flags, ORed together if the
+    key was seen more than once, and problems maps fingerprints to
+    the reason gpg gave for not importing them. gpg does not always
+    know the fingerprint of a key it could not import, those problems
+    are under None. counts is the IMPORT_RES summary, by name:
+
+        result = keyring.import_many(blobs)
+        print result.counts['imported'], len(result.problems)
+
+    the GpgResult of the command is in result. this evaluates to true
+    if at least one key was imported and gpg completed the import,
+    like Keyring.import_data().
+
+    see doc/DETAILS in the GnuPG source for the meaning of the flags
+    and reasons.
+    """
+
+    # IMPORT_OK flags
+    NEW = 1
+    NEW_UIDS = 2
+    NEW_SIGS = 4
+    NEW_SUBKEYS = 8
+    SECRET = 16
+
+    # IMPORT_RES fields, in order. newer gpg versions add more fields
+    # at the end, those are ignored
+    fields = ('count', 'no_user_id', 'imported', 'imported_rsa',
+              'unchanged', 'n_uids', 'n_subk', 'n_sigs', 'n_revoc',
+              'sec_read', 'sec_imported', 'sec_dups', 'skipped_new_keys',
+              'not_imported', 'skipped_v3')
+
+    def __init__(self):
+        self.keys = {}
+        self.problems = {}
+        self.counts = None
+        self.result = None
+
+    def handlers(self):
+        """the status handlers to pass to Context.session()"""
+        return {'IMPORT_OK': self.ok,
+                'IMPORT_PROBLEM': self.problem,
+                'IMPORT_RES': self.summary,
+                }
+
+    def ok(self, event):
+        fpr = event.args[1]
+        self.keys[fpr] = self.keys.get(fpr, 0) | int(event.args[0])
+
+    def problem(self, event):
+        if len(event.args) > 1:
+            fpr = event.args[1]
+        else:
+            fpr = None
+        self.problems[fpr] = int(event.args[0])
+
+    def summary(self, event):
+        self.counts = dict(zip(self.fields, [ int(x) for x in event.args ]))
+
+    def __nonzero__(self):
+        return bool(self.keys) and self.counts is not None
+
+    def __repr__(self):
+        return '<ImportResult %d keys, %d problems>' % (len(self.keys), len(self.problems))
+
+class GpgStream(object):
+    """the output of a gpg command, as it comes
+
+    this iterates over the chunks of the standard output of gpg,
+    which are not kept in memory. the GpgResult of the command is
+    available in the result attribute once the iteration is complete,
+    with an empty stdout. see Context.stream_command().
+    """
+
+    def __init__(self, context, session, stdin = None):
+        self.context = context
+        self.session = session
+        self.stdin = stdin
+        self.result = None
+
+    def __iter__(self):
+        for chunk in self.session.stream(self.stdin):
+            yield chunk
+        self.result = self.context.result(self.session)
+
+class MetricsCounter(object):
+    """a metrics sink keeping totals in memory
+
+    totals are kept per stage and gpg command. the stage is set by
+    the caller with enter(), so it can be told how much time was
+    spent in gpg during each step of a larger operation, and how much
+    in our own code. summary() formats all this for display.
+    """
+
+    # the fields added up in the totals
+    fields = ['calls', 'wall', 'spawn', 'bytes_in', 'bytes_out', 'status_lines', 'failed']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage = None
+        self.started = time.time()
+        # stage names, in the order they were entered
+        self.stages = []
+        # stage => total time spent in the stage
+        self.durations = {}
+        # (stage, command) => { field => total }
+        self.totals = {}
+
+    def enter(self, stage):
+        """start a new stage, ending the current one"""
+        with self.lock:
+            self._end()
+            self.stage = stage
+            self.started = time.time()
+            if stage not in self.durations:
+                self.stages.append(stage)
+                self.durations[stage] = 0
+
+    def _end(self):
+        if self.stage is not None:
+            self.durations[self.stage] += time.time() - self.started
+
+    def __call__(self, metrics):
+        with self.lock:
+            key = (self.stage, metrics['command'])
+            if key not in self.totals:
+                self.totals[key] = dict([ (field, 0) for field in self.fields ])
+            totals = self.totals[key]
+            totals['calls'] += 1
+            for field in ['wall', 'spawn', 'bytes_in', 'bytes_out', 'status_lines']:
+                totals[field] += metrics[field]
+            if metrics['returncode'] != 0:
+                totals['failed'] += 1
+
+    def summary(self):
+        """a table of the totals, per stage and command"""
+        with self.lock:
+            self._end()
+            self.started = time.time()
+            lines = ['%-16s %-20s %5s %9s %9s %9s %9s %6s' % (_('stage'), _('command'), _('calls'), _('time'), _('spawn'), _('in'), _('out'), _('failed'))]
+            for stage in [None] + self.stages:
+                for key in sorted([ key for key in self.totals if key[0] == stage ]):
+                    totals = self.totals[key]
+                    lines.append('%-16s %-20s %5d %8.3fs %8.3fs %9d %9d %6d' % (stage or '-', key[1], totals['calls'], totals['wall'], totals['spawn'], totals['bytes_in'], totals['bytes_out'], totals['failed']))
+                if stage is not None:
+                    lines.append('%-16s %-20s %5s %8.3fs' % (stage, _('(stage total)'), '', self.durations[stage]))
+            return "\n".join(lines)
+
+class MetricsLog(object):
+    """a metrics sink writing a JSON object per line to a file"""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+
+    def __call__(self, metrics):
+        line = json.dumps(metrics)
+        with self.lock:
+            self.fd.write(line + "\n")
+            self.fd.flush()
+
+class GpgSession():
+    """a running gpg process we talk with
+
+    gpg writes to its stdout, stderr and status-fd and may block on
+    any of those if we do not read them. the session therefore always
+    drains every output stream of the process, with poll() (or
+    select() where poll is not available), and buffers what was read
+    until it is asked for. this way, waiting for a status line never
+    deadlocks because gpg is stuck writing to a full stdout pipe, or
+    the other way around.
+
+    streams are available as the stdout, stderr, status and logger
+    attributes, and behave like file objects with a readline() method
+    that takes a timeout, so they can be used with Context.seek() and
+    Context.expect(). status and logger are private pipes if the
+    status_pipe and logger_pipe settings of the context are set, and
+    the same as stderr otherwise. commands are written to gpg through
+    the stdin attribute, which is a regular file object. gpg can also
+    read its input directly from a file or pipe given as stdin, then
+    the stdin attribute is None and nothing can be sent.
+
+    the process is not allowed to run past the context deadline, if
+    any. a GpgTimeoutError is raised if that happens or if a single
+    step of the conversation takes longer than its timeout. the
+    process is killed when the session is closed, which should
+    always be done, for example with a try/finally block.
+    """
+
+    # how much data to read from a pipe at once
+    bufsize = 4096
+
+    def __init__(self, context, command, overrides = None, stdin = None):
+        self.context = context
+        self.started = time.time()
+        # how long the process ran, once it exited
+        self.elapsed = None
+        self.deadline = None
+        if context.deadline is not None:
+            self.deadline = time.time() + context.deadline
+        # private pipes: option => (read end, write end)
+        pipes = {}
+        if context.status_pipe:
+            pipes['status-fd'] = self.pipe()
+        if context.logger_pipe:
+            pipes['logger-fd'] = self.pipe()
+        overrides = dict(overrides or {})
+        for option, (r, w) in pipes.items():
+            overrides[option] = w
+        self.command = context.build_command(command, overrides)
+        # the gpg command, without options, for metrics. the first
+        # argument gets its -- from build_command(), but it may be an
+        # option, like in ['recipient', fpr, '--encrypt'], then the
+        # action is the first argument given with its --
+        if type(command) is str:
+            self.verb = command
+        else:
+            actions = [ arg for arg in command if arg.startswith('--') ]
+            self.verb = (actions or command)[0]
+        self.verb = self.verb.lstrip('-')
+        def inherit():
+            # runs in the child: let gpg see the write ends
+            for option, (r, w) in pipes.items():
+                flags = fcntl.fcntl(w, fcntl.F_GETFD)
+                fcntl.fcntl(w, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        try:
+            self.proc = subprocess.Popen(self.command, stdin=stdin or subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=inherit)
+            self.spawned = time.time()
+        finally:
+            # the child has its copy, if any, we only read
+            for option, (r, w) in pipes.items():
+                os.close(w)
+        # None if gpg reads from a file we were given
+        self.stdin = self.proc.stdin
+        self.stdout = SessionStream(self, self.proc.stdout)
+        self.stderr = SessionStream(self, self.proc.stderr)
+        self.status = self.logger = self.stderr
+        if 'status-fd' in pipes:
+            self.status = SessionStream(self, os.fdopen(pipes['status-fd'][0], 'rb', 0))
+        if 'logger-fd' in pipes:
+            self.logger = SessionStream(self, os.fdopen(pipes['logger-fd'][0], 'rb', 0))
+        self.streams = {}
+        for stream in [self.stdout, self.stderr, self.status, self.logger]:
+            self.streams[stream.fd] = stream
+        # input waiting to be written, from that offset, see send()
+        self.pending = ''
+        self.offset = 0
+        self.close_input = False
+        # how much data we sent to and received from gpg
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+    @staticmethod
+    def pipe():
+        """a pipe that is not inherited by child processes by default
+
+        this makes sure that gpg processes started at the same time
+        from other threads do not keep our pipes open."""
+        fds = os.pipe()
+        for fd in fds:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        return fds
+
+    def finished(self):
+        """if all output streams have reached EOF"""
+        for stream in self.streams.values():
+            if not stream.eof:
+                return False
+        return True
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    def remaining(self, timeout = None):
+        """seconds left before the given timeout or the deadline expire
+
+        this returns None if there is no limit at all."""
+        limits = []
+        if timeout is not None:
+            limits.append(timeout)
+        if self.deadline is not None:
+            limits.append(self.deadline - time.time())
+        if limits:
+            return min(limits)
+        return None
+
+    @staticmethod
+    def wait_fds(readers, writers, timeout):
+        """wait for file descriptors to be ready
+
+        this returns the lists of readable and writable file
+        descriptors, which are empty if the timeout expired."""
+        if timeout is not None:
+            timeout = max(timeout, 0)
+            deadline = time.time() + timeout
+        while True:
+            try:
+                if hasattr(select, 'poll'):
+                    poller = select.poll()
+                    for fd in readers:
+                        poller.register(fd, select.POLLIN | select.POLLPRI)
+                    for fd in writers:
+                        poller.register(fd, select.POLLOUT)
+                    if timeout is not None:
+                        events = poller.poll(timeout * 1000)
+                    else:
+                        events = poller.poll()
+                    readable = [ fd for fd, event in events if fd in readers ]
+                    writable = [ fd for fd, event in events if fd in writers ]
+                    return (readable, writable)
+                else:
+                    (readable, writable, x) = select.select(readers, writers, [], timeout)
+                    return (readable, writable)
+            except (select.error, IOError, OSError) as e:
+                # signals (like SIGALRM) interrupt the system call
+                if e.args[0] != errno.EINTR:
+                    raise
+                # wait only for what is left of the timeout
+                if timeout is not None:
+                    timeout = max(deadline - time.time(), 0)
+
+    def fill(self, fd):
+        """read a chunk of data from the given stream into its buffer"""
+        stream = self.streams[fd]
+        try:
+            data = os.read(fd, self.bufsize)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            raise
+        self.bytes_out += len(data)
+        stream.feed(data)
+
+    def drain(self, stream):
+        """read what was already written to the stream, without waiting"""
+        while not stream.eof and self.wait_fds([stream.fd], [], 0)[0]:
+            self.fill(stream.fd)
+
+    def send(self, data, close = False):
+        """queue data to be written to gpg without blocking
+
+        the data is written as the pipe to gpg has room for it, when
+        process() is called, and stdin is closed after that if close
+        is true."""
+        if self.stdin is None and not data:
+            return
+        if not self.pending:
+            fd = self.stdin.fileno()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if data:
+            # drop what was written, once per call instead of per write
+            (self.pending, self.offset) = (self.pending[self.offset:] + data, 0)
+        self.close_input = close
+        if not self.queued() and close:
+            self.stdin.close()
+
+    def queued(self):
+        """how much of the input is not written yet"""
+        return len(self.pending) - self.offset
+
+    def flush(self):
+        """write as much of the pending input as gpg will take"""
+        try:
+            written = os.write(self.stdin.fileno(), buffer(self.pending, self.offset, select.PIPE_BUF))
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN):
+                return
+            elif e.errno == errno.EPIPE:
+                # gpg exited without reading everything
+                (self.pending, self.offset) = ('', 0)
+                written = 0
+            else:
+                raise
+        self.bytes_in += written
+        self.offset += written
+        if self.offset == len(self.pending):
+            (self.pending, self.offset) = ('', 0)
+            if self.close_input:
+                self.stdin.close()
+
+    def fds(self):
+        """the file descriptors to wait on, see process()
+
+        returns a (readers, writers) tuple."""
+        readers = [ fd for fd, stream in self.streams.items() if not stream.eof ]
+        writers = []
+        if self.queued() and self.stdin is not None and not self.stdin.closed:
+            writers.append(self.stdin.fileno())
+        return (readers, writers)
+
+    def process(self, readable, writable):
+        """handle file descriptors that are ready, see fds()"""
+        for fd in readable:
+            self.fill(fd)
+        if writable:
+            self.flush()
+
+    def pump(self, timeout = None):
+        """wait for data on any of the output streams and read it
+
+        pending input is also written along the way. this raises a
+        GpgTimeoutError if nothing happened before the timeout or the
+        deadline."""
+        timeout = self.remaining(timeout)
+        (readers, writers) = self.fds()
+        (readable, writable) = self.wait_fds(readers, writers, timeout)
+        if not readable and not writable:
+            self.check_deadline()
+            raise GpgTimeoutError(self.proc.returncode, _('timeout waiting for gpg, last output: %s') % self.status.last_line())
+        self.process(readable, writable)
+
+    @staticmethod
+    def pump_many(sessions):
+        """wait for data on the output streams of any of the sessions
+
+        this is like pump(), for sessions running at the same time,
+        which need to be read together so none of them blocks the
+        others. this raises a GpgTimeoutError if a deadline passed."""
+        readers = []
+        limits = []
+        for session in sessions:
+            readers += session.fds()[0]
+            limit = session.remaining()
+            if limit is not None:
+                limits.append(max(limit, 0))
+        timeout = None
+        if limits:
+            timeout = min(limits)
+        readable = GpgSession.wait_fds(readers, [], timeout)[0]
+        if not readable:
+            for session in sessions:
+                session.check_deadline()
+        for session in sessions:
+            session.process([ fd for fd in readable if fd in session.streams ], [])
+
+    def detach(self, stream):
+        """stop reading the output stream, and return its pipe
+
+        this is used to connect the output of gpg to another process,
+        which then reads it directly. the caller must close the pipe."""
+        del self.streams[stream.fd]
+        stream.eof = True
+        return stream.pipe
+
+    def check_deadline(self):
+        """raise a GpgTimeoutError if the deadline is passed"""
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise GpgTimeoutError(self.proc.returncode, _('gpg did not complete in %s seconds') % self.context.deadline)
+
+    def communicate(self, data = None):
+        """feed the data to gpg and collect all its output
+
+        this is similar to subprocess.Popen.communicate(), but follows
+        the deadline of the context. the process is killed if it
+        expires.
+
+        returns a (stdout, stderr) tuple, the status and logger
+        streams are also read completely.
+        """
+        try:
+            self.send(data or '', True)
+            while not self.finished():
+                self.pump()
+            self.wait()
+        finally:
+            self.close()
+        return (self.stdout.getvalue(), self.stderr.getvalue())
+
+    def stream(self, data = None):
+        """feed the data to gpg and yield its output as it comes
+
+        this is like communicate(), except the standard output is not
+        kept in the session but returned in chunks as soon as it is
+        read, so memory use does not depend on its size. the process
+        is killed if the iteration is stopped early.
+        """
+        chunks = []
+        self.stdout.sink = chunks.append
+        try:
+            self.send(data or '', True)
+            while not self.finished():
+                self.pump()
+                while chunks:
+                    yield chunks.pop(0)
+            self.wait()
+        finally:
+            self.close()
+
+    def wait(self):
+        """close the input and wait for gpg to finish
+
+        remaining output is still collected, so it is available
+        afterwards.
+
+        returns the exit code of the process"""
+        if self.stdin is not None and not self.stdin.closed:
+            try:
+                self.stdin.close()
+            except IOError:
+                pass # broken pipe, gpg is gone already
+        while not self.finished():
+            self.pump()
+        if self.proc.poll() is None:
+            if self.deadline is None:
+                self.proc.wait()
+            else:
+                self.wait_exit()
+        if self.elapsed is None:
+            self.elapsed = time.time() - self.started
+        return self.proc.returncode
+
+    def wait_exit(self):
+        """wait for the process to exit, until the deadline
+
+        Popen.wait() does not take a timeout, so it runs in a thread
+        which closes a pipe when the process is gone, and we wait for
+        that pipe with wait_fds()."""
+        (r, w) = self.pipe()
+        def reap():
+            try:
+                self.proc.wait()
+            finally:
+                os.close(w)
+        thread = threading.Thread(target = reap, name = 'GpgSession')
+        thread.daemon = True
+        thread.start()
+        try:
+            while not self.wait_fds([r], [], self.deadline - time.time())[0]:
+                self.check_deadline()
+        finally:
+            os.close(r)
+
+    def close(self):
+        """terminate the process if it is still running
+
+        the metrics of the session are reported to the context the
+        first time this is called."""
+        if self.proc.poll() is None:
+            try:
+                self.proc.kill()
+            except OSError:
+                pass # already gone
+            self.proc.wait()
+        for f in [self.proc.stdin] + [ stream.pipe for stream in self.streams.values() ]:
+            if f is None:
+                continue
+            try:
+                f.close()
+            except IOError:
+                pass
+        if not self.closed:
+            self.closed = True
+            if self.elapsed is None:
+                self.elapsed = time.time() - self.started
+            self.context.report(self)
+
+    def metrics(self):
+        """a summary of what the process did, see Context.sinks"""
+        return { 'command': self.verb,
+                 'argv': self.command,
+                 'started': self.started,
+                 'wall': self.elapsed,
+                 'spawn': self.spawned - self.started,
+                 'bytes_in': self.bytes_in,
+                 'bytes_out': self.bytes_out,
+                 'status_lines': self.status.getvalue().count(StatusParser.prefix),
+                 'returncode': self.proc.returncode,
+                 }
+
+class SessionStream():
+    """an output stream of a GpgSession
+
+    this buffers data read from one of the pipes of the process, see
+    GpgSession for details.
+    """
+
+    def __init__(self, session, pipe):
+        self.session = session
+        self.pipe = pipe
+        self.fd = pipe.fileno()
+        # everything we read from the pipe
+        self.chunks = []
+        # how many chunks were moved to the line buffer
+        self.consumed = 0
+        # data moved out of the chunks, but not returned by readline() yet
+        self.buffer = ''
+        self.eof = False
+        # function called with the data instead of keeping it, if any
+        self.sink = None
+        # StatusParser fed with the data as it comes, if any
+        self.parser = None
+
+    def feed(self, data):
+        if self.parser is not None:
+            if data:
+                self.parser.feed(data)
+            else:
+                self.parser.close()
+        if data:
+            if self.sink is not None:
+                self.sink(data)
+            else:
+                self.chunks.append(data)
+        else:
+            self.eof = True
+
+    def readline(self, timeout = None):
+        """read a line, waiting at most timeout seconds for it
+
+        like file.readline(), this returns an empty string at EOF, and
+        raises a GpgTimeoutError if the timeout expires before a full
+        line is available."""
+        if timeout is not None:
+            limit = time.time() + timeout
+        while True:
+            if self.consumed < len(self.chunks):
+                self.buffer += ''.join(self.chunks[self.consumed:])
+                self.consumed = len(self.chunks)
+            pos = self.buffer.find("\n")
+            if pos >= 0:
+                (line, self.buffer) = (self.buffer[:pos+1], self.buffer[pos+1:])
+                return line
+            if self.eof:
+                (line, self.buffer) = (self.buffer, '')
+                return line
+            if timeout is None:
+                self.session.pump()
+            else:
+                self.session.pump(limit - time.time())
+
+    def getvalue(self):
+        """all the data read from the stream so far"""
+        return ''.join(self.chunks)
+
+    def last_line(self):
+        """the last complete line read from the stream, for errors"""
+        lines = self.getvalue().rstrip("\n").split("\n")
+        return lines[-1]
 
 class Keyring():
     """Keyring functionalities.
@@ -267,6 +1402,35 @@ class Keyring():
     # the context this keyring is associated with
     context = None
 
+    # the class of the context, created for every keyring
+    context_class = Context
+
+    # if sign_key() should use --quick-sign-key, None to use it if
+    # gpg supports it
+    quick_sign = None
+
+    # a KeyIndex get_keys() looks keys up in, when it understands
+    # the pattern
+    index = None
+
+    # the KeyLookup built by lookup()
+    _lookup = None
+
+    # set this to a dictionary to remember the results of
+    # export_data() and get_keys() until the keyring changes
+    cache = None
+
+    # bumped by changed() every time we modify the keyring
+    generation = 0
+
+    # how many patterns get_keys_many() passes to a single gpg
+    batch = 1000
+
+    # set this to have get_keys() read public keys straight from the
+    # keyring files when it can, instead of listing them through gpg.
+    # the validity of keys is unknown then, see PacketReader
+    native = False
+
     def __init__(self, homedir=None):
         """constructor for the gpg context
 
@@ -278,7 +1442,7 @@ class Keyring():
         later function calls on the object may modify the keyring (or
         other keyrings, if the homedir option is modified.
         """
-        self.context = Context()
+        self.context = self.context_class()
         if homedir is not None:
             self.context.set_option('homedir', homedir)
         else:
@@ -298,27 +1462,191 @@ class Keyring():
         You may need to set import-flags to import non-exportable
         signatures, however.
         """
-        self.context.call_command(['import'], data)
-        fd = StringIO(self.context.stderr)
-        try:
-            self.context.seek(fd, 'IMPORT_OK')
-            self.context.seek(fd, 'IMPORT_RES')
-        except GpgProtocolError:
-            return False
-        return True
+        self.changed()
+        return self._imported(self.context.call_command(['import'], data))
+
+    def import_many(self, sources):
+        """Import many blocks of OpenPGP data in a single gpg process.
+
+        The sources are strings or file objects, files are read as
+        they are sent to gpg so they do not need to fit in memory.
+        Everything is imported by a single gpg --import, which is much
+        faster than calling import_data() for every key.
 
-    def export_data(self, fpr = None, secret = False):
+        This returns an ImportResult with what happened to each key.
+        """
+        self.changed()
+        imported = ImportResult()
+        session = self.context.session(['import'], imported.handlers())
+        try:
+            for source in sources:
+                if isinstance(source, basestring):
+                    chunks = [source]
+                else:
+                    chunks = iter(lambda: source.read(session.bufsize), '')
+                for chunk in chunks:
+                    session.send(chunk)
+                    # do not queue more than gpg can take
+                    while session.queued() > session.bufsize:
+                        session.pump()
+            session.send('', True)
+            while not session.finished():
+                session.pump()
+            session.wait()
+        finally:
+            session.close()
+        imported.result = self.context.result(session)
+        return imported
+
+    def transfer_to(self, other, fprs = None, secret = False, options = None):
+        """Copy keys from this keyring to another one.
+
+        The keys matching the given fingerprints, a string or a list,
+        are exported from this keyring and imported in the other. The
+        output of the export goes straight in the import process, both
+        run at the same time and the key material is never armored or
+        read into Python.
+
+        Options can be changed for both commands, for example to set
+        export-options or import-options, see Context.build_command().
+
+        This returns an ImportResult, see import_many().
+        """
+        if secret: command = ['export-secret-keys']
+        else: command = ['export']
+        if isinstance(fprs, basestring):
+            command.append(fprs)
+        elif fprs:
+            command += list(fprs)
+        overrides = dict(options or {})
+        overrides['armor'] = False
+        other.changed()
+        imported = ImportResult()
+        exporter = self.context.session(command, overrides = overrides)
+        importer = None
+        try:
+            exporter.send('', True)
+            pipe = exporter.detach(exporter.stdout)
+            try:
+                importer = other.context.session(['import'], imported.handlers(), overrides, pipe)
+            finally:
+                # the import process has its own copy
+                pipe.close()
+            sessions = [exporter, importer]
+            while not exporter.finished() or not importer.finished():
+                GpgSession.pump_many(sessions)
+            exporter.wait()
+            importer.wait()
+        finally:
+            exporter.close()
+            if importer is not None:
+                importer.close()
+        imported.result = other.context.result(importer)
+        return imported
+
+    @staticmethod
+    def _imported(result):
+        """check the GpgResult of an import for success"""
+        # we need at least one IMPORT_OK followed by the IMPORT_RES summary
+        imported = False
+        for event in StatusParser().parse(result.status, ['IMPORT_OK', 'IMPORT_RES']):
+            if event.keyword == 'IMPORT_OK':
+                imported = True
+            elif event.keyword == 'IMPORT_RES' and imported:
+                return True
+        return False
+
+    def export_data(self, fpr = None, secret = False, output = None):
         """Export OpenPGP data blocks from the keyring.
 
         This exports actual OpenPGP data, by default in binary format,
         but can also be exported asci-armored by setting the 'armor'
-        option."""
-        self.context.set_option('armor')
+        option. Binary data is cheaper for gpg, and can be armored
+        later with armor() or ArmorEncoder from monkeysign.packets where
+        needed.
+
+        If an output file object is given, the data is written there
+        as it comes and this returns true if the export succeeded. Use
+        this or iter_export() to export large keyrings."""
+        command = self._export_command(fpr, secret)
+        if output is not None:
+            return bool(self.context.call_command(command, output=output))
+        return self._memoized(('export', fpr, secret), lambda: self.context.call_command(command).stdout)
+
+    def signatures(self, fpr):
+        """the signature packets on a key, as a set of strings
+
+        keep this before signing the key, to export only the new
+        certifications with export_delta() afterwards. returns None if
+        the key cannot be exported or read."""
+        data = self.context.call_command(['export', fpr], overrides = {'armor': False}).stdout
+        if not data:
+            return None
+        # the packets module builds OpenPGPkeys, so it imports us
+        from monkeysign.packets import PacketReader
+        try:
+            return PacketReader(data).signatures()
+        except ValueError:
+            return None
+
+    def export_delta(self, fpr, known = None):
+        """Export only the certifications a key got.
+
+        known is what signatures() returned for the key before it was
+        signed. This returns the binary data of the primary key and of
+        the user ids with new signatures, along with those signatures
+        and the self-signatures gpg needs to import them, see
+        PacketReader.delta(). On keys carrying many signatures, this
+        is a fraction of what export_data() returns. An empty string
+        is returned if the key got no new signature.
+
+        If known is None, or the key cannot be read, this falls back
+        to a gpg export with the export-clean option, which drops the
+        signatures made by keys missing from this keyring."""
+        command = ['export', fpr]
+        if known is not None:
+            data = self.context.call_command(command, overrides = {'armor': False}).stdout
+            from monkeysign.packets import PacketReader
+            try:
+                return PacketReader(data).delta(known)
+            except ValueError:
+                pass
+        return self.context.call_command(command, overrides = {'armor': False, 'export-options': 'export-clean'}).stdout
+
+    def changed(self):
+        """forget what we know about the keyring, because it changed
+
+        this is called by the methods modifying the keyring, call it
+        if gpg is used on this keyring some other way."""
+        self.generation += 1
+        self._lookup = None
+        if self.cache:
+            self.cache.clear()
+
+    def _memoized(self, key, compute):
+        """the result of compute(), remembered in the cache if enabled
+
+        the key is completed with the keyring generation and the gpg
+        options, which can change what gpg returns."""
+        if self.cache is None:
+            return compute()
+        key = (self.generation, tuple(sorted(self.context.options.items()))) + key
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    def iter_export(self, fpr = None, secret = False):
+        """Export OpenPGP data blocks, in chunks as gpg outputs them
+
+        See export_data() and Context.stream_command(), this returns a
+        GpgStream."""
+        return self.context.stream_command(self._export_command(fpr, secret))
+
+    def _export_command(self, fpr, secret):
         if secret: command = ['export-secret-keys']
         else: command = ['export']
         if fpr: command += [fpr]
-        self.context.call_command(command)
-        return self.context.stdout
+        return command
 
     def fetch_keys(self, fpr, keyserver = None):
         """Download keys from a keyserver into the local keyring
@@ -327,102 +1655,235 @@ class Keyring():
 
         Returns true if the command succeeded.
         """
+        self.changed()
+        return bool(self.context.call_command(['recv-keys', fpr], overrides=self._keyserver(keyserver)))
+
+    @staticmethod
+    def _keyserver(keyserver):
+        """options to use a keyserver for a single command"""
         if keyserver is not None:
-            self.context.set_option('keyserver', keyserver)
-        self.context.call_command(['recv-keys', fpr])
-        return self.context.returncode == 0
+            return {'keyserver': keyserver}
+        return None
 
     def get_keys(self, pattern = None, secret = False, public = True):
         """load keys matching a specific patterns
 
         this uses the (rather poor) list-keys API to load keys
-        information
+        information. returns a dictionary of OpenPGPkey objects
+        indexed by fingerprint, or None if no key was found.
         """
+        if self.index is not None and self.index.handles(pattern):
+            return self.index.get_keys(pattern, secret, public)
+        if self.native and public and not secret:
+            keys = self._memoized(('read_keys',), self.read_keys)
+            if keys is not None:
+                keys = KeyLookup(keys.itervalues()).get_keys(pattern)
+            if keys is not None:
+                return self._copy_keys(keys) or None
+        keys = self._memoized(('get_keys', pattern, secret, public), lambda: self._get_keys(pattern, secret, public))
+        if keys is None:
+            return None
+        return self._copy_keys(keys)
+
+    @staticmethod
+    def _copy_keys(keys):
+        """a copy of a dictionary of cached keys
+
+        callers may change the dictionary and the keys, not the
+        cached ones."""
+        return dict([ (fpr, copy.copy(key)) for fpr, key in keys.iteritems() ])
+
+    def _get_keys(self, pattern, secret, public):
         keys = {}
-        if public:
-            command = ['list-keys']
-            if pattern: command += [pattern]
-            self.context.call_command(command)
-            if self.context.returncode == 0:
-                # discard trustdb data, first line of output
-                self.context.stdout = "\n".join(self.context.stdout.split("\n")[1:])
-                for keydata in self.context.stdout.split("pub:"):
-                    if not keydata: continue
-                    keydata = "pub:" + keydata
-                    key = OpenPGPkey(keydata)
-                    keys[key.fpr] = key
-            elif self.context.returncode == 2:
+        parser = KeyListParser(keys)
+        for command, overrides in self._list_commands(pattern, secret, public):
+            stream = self.context.stream_command(command, overrides = overrides)
+            for key in self._list_keys(stream, parser):
+                pass
+            if not self._listed(stream.result):
                 return None
+        return keys
+
+    def read_keys(self):
+        """read the public keys straight from the keyring files
+
+        this does not run gpg, see PacketReader for what this knows
+        about keys. returns a dictionary of OpenPGPkey objects
+        indexed by fingerprint, like get_keys(), or None if the keys
+        cannot be read that way, for example because other keyrings
+        are configured."""
+        if 'keyring' in self.context.options or 'no-default-keyring' in self.context.options:
+            return None
+        # gpg 2.1 and later use the keybox if there is one
+        for name in ('pubring.kbx', 'pubring.gpg'):
+            path = os.path.join(self.homedir, name)
+            if os.path.exists(path):
+                break
+        else:
+            return None
+        keys = {}
+        from monkeysign.packets import PacketReader
+        try:
+            for key in PacketReader.open(path).keys():
+                keys[key.fpr] = key
+        except (EnvironmentError, ValueError):
+            return None
+        return keys
+
+    def iter_keys(self, pattern = None, secret = False, public = True):
+        """iterate over the keys matching a specific pattern
+
+        keys are parsed as gpg lists them, so only one key is kept in
+        memory at a time. this yields nothing if no key was found.
+
+        when both public and secret keys are requested, gpg 2.1 lists
+        them in a single pass. older versions keep secret keys in a
+        separate keyring, so all keys are loaded with get_keys()
+        first, to merge both listings.
+        """
+        commands = self._list_commands(pattern, secret, public)
+        if len(commands) > 1:
+            # not self.get_keys(), which returns a future in AsyncKeyring
+            for key in (Keyring.get_keys(self, pattern, secret, public) or {}).itervalues():
+                yield key
+            return
+        for command, overrides in commands:
+            stream = self.context.stream_command(command, overrides = overrides)
+            for key in self._list_keys(stream, KeyListParser()):
+                yield key
+            self._listed(stream.result)
+
+    def lookup(self, refresh = False):
+        """a KeyLookup of all the public and secret keys in this keyring
+
+        this lists the keyring once, or reads the KeyIndex if there
+        is one, and keeps the result, to answer questions like "do we
+        have this key?" without running gpg. pass refresh to list the
+        keyring again after changing it."""
+        if self._lookup is None or refresh:
+            if self.index is not None:
+                keys = (self.index.get_keys(None, True, True) or {}).itervalues()
             else:
-                raise GpgProtocolError(self.context.returncode, _('unexpected GPG exit code in list-keys: %d') % self.context.returncode)
+                keys = self.iter_keys(None, True, True)
+            self._lookup = KeyLookup(keys)
+        return self._lookup
+
+    def get_keys_many(self, patterns, secret = False, public = True):
+        """load the keys matching any of the patterns, in one gpg call
+
+        returns a tuple made of a dictionary of the OpenPGPkey found,
+        indexed by fingerprint, and the list of the patterns that did
+        not match any key. gpg does not tell which pattern matched
+        which key, so this is found out from the listing, see
+        KeyLookup.search().
+
+        patterns are passed batch at a time, so huge lists do not
+        overflow the command line.
+        """
+        patterns = list(patterns)
+        keys = {}
+        parser = KeyListParser(keys)
+        for i in range(0, len(patterns), self.batch):
+            for command, overrides in self._list_commands(patterns[i:i+self.batch], secret, public):
+                stream = self.context.stream_command(command, overrides = overrides)
+                for key in self._list_keys(stream, parser):
+                    pass
+                # gpg fails if any pattern is missing, but still
+                # lists the others
+                self._listed(stream.result)
+        lookup = KeyLookup(keys.itervalues())
+        missing = [ pattern for pattern in patterns if not lookup.search(pattern) ]
+        return (keys, missing)
+
+    def _list_commands(self, pattern, secret, public):
+        """the listing commands get_keys() needs, with their overrides
+
+        the pattern can also be a list of patterns."""
+        if not pattern: pattern = []
+        elif not isinstance(pattern, list): pattern = [pattern]
+        if public and secret and self.context.capabilities().supports('with-secret'):
+            return [(['list-keys'] + pattern, {'with-secret': None})]
+        commands = []
+        if public:
+            commands.append((['list-keys'] + pattern, None))
         if secret:
-            command = ['list-secret-keys']
-            if pattern: command += [pattern]
-            self.context.call_command(command)
-            if self.context.returncode == 0:
-                for keydata in self.context.stdout.split("sec::"):
-                    if not keydata: continue
-                    keydata = "sec::" + keydata
-                    key = OpenPGPkey(keydata)
-                    # check if we already have that key, in which case we
-                    # add to it instead of adding a new key
-                    if key.fpr in keys:
-                        keys[key.fpr].parse_gpg_list(self.context.stdout)
-                        del key
-                    else:
-                        keys[key.fpr] = key
-            elif self.context.returncode == 2:
-                return None
-            else:
-                raise GpgProtocolError(self.context.returncode, _('unexpected GPG exit code in list-keys: %d') % self.context.returncode)
-        return keys
+            commands.append((['list-secret-keys'] + pattern, None))
+        return commands
+
+    @staticmethod
+    def _list_keys(stream, parser):
+        """feed a GpgStream to a KeyListParser, yielding keys as they come"""
+        for chunk in stream:
+            for key in parser.feed(chunk):
+                yield key
+        for key in parser.close():
+            yield key
+
+    @staticmethod
+    def _listed(result):
+        """check the result of a key listing
+
+        returns False if gpg did not find any key."""
+        if result.returncode == 2:
+            return False
+        elif result.returncode != 0:
+            raise GpgProtocolError(result.returncode, _('unexpected GPG exit code in list-keys: %d') % result.returncode)
+        return True
+
+    @staticmethod
+    def _parse_keys(keys, result):
+        """add the keys found in a complete listing to keys
+
+        returns False if gpg did not find any key."""
+        if not Keyring._listed(result):
+            return False
+        KeyListParser(keys).parse(result.stdout)
+        return True
 
-    def encrypt_data(self, data, recipient):
+    def encrypt_data(self, data, recipient, always_trust = False):
         """encrypt data using asymetric encryption
 
+        the recipient key does not need to be valid if always_trust is
+        set, which is what we want for keys we just signed.
+
         returns the encrypted data or raise a GpgRuntimeError if it fails
         """
-        self.context.call_command(['recipient', recipient, '--encrypt'], data)
-        if self.context.returncode == 0:
-            return self.context.stdout
-        else:
-            raise GpgRuntimeError(self.context.returncode, _('encryption to %s failed: %s.') % (recipient, self.context.stderr.split("\n")[-2]))
+        return self._encrypted(self.context.call_command(['recipient', recipient, '--encrypt'], data, overrides = self._trust(always_trust)), recipient)
+
+    @staticmethod
+    def _trust(always_trust):
+        if always_trust:
+            return {'always-trust': None}
+        return None
+
+    @staticmethod
+    def _encrypted(result, recipient):
+        if result:
+            return result.stdout
+        raise GpgRuntimeError(result.returncode, _('encryption to %s failed: %s.') % (recipient, result.error_message()))
 
     def decrypt_data(self, data):
         """decrypt data using asymetric encryption
 
         returns the plaintext data or raise a GpgRuntimeError if it failed.
         """
-        self.context.call_command(['--decrypt'], data)
-        if self.context.returncode == 0:
-            return self.context.stdout
-        else:
-            raise GpgRuntimeError(self.context.returncode, _('decryption failed: %s') % self.context.stderr.split("\n")[-2])
+        return self._decrypted(self.context.call_command(['--decrypt'], data))
+
+    @staticmethod
+    def _decrypted(result):
+        if result:
+            return result.stdout
+        raise GpgRuntimeError(result.returncode, _('decryption failed: %s') % result.error_message())
+
+    def edit_key(self, fpr):
+        """start an EditSession to change the key"""
+        return EditSession(self, fpr)
 
     def del_uid(self, fingerprint, pattern):
-        if self.context.debug: print >>self.context.debug, 'command:', self.context.build_command(['edit-key', fingerprint])
-        proc = subprocess.Popen(self.context.build_command(['edit-key', fingerprint]), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # start copy-paste from sign_key()
-        self.context.expect(proc.stderr, 'GET_LINE keyedit.prompt')
-        while True:
-            m = self.context.seek_pattern(proc.stdout, '^uid:.::::::::([^:]*):::[^:]*:(\d+),[^:]*:')
-            if m and m.group(1) == pattern:
-                # XXX: we don't have the +1 that sign_key has, why?
-                index = int(m.group(2))
-                break
-        print >>proc.stdin, str(index)
-        self.context.expect(proc.stderr, 'GOT_IT')
-        self.context.expect(proc.stderr, 'GET_LINE keyedit.prompt')
-        # end of copy-paste from sign_key()
-        print >>proc.stdin, 'deluid'
-        self.context.expect(proc.stderr, 'GOT_IT')
-        self.context.expect(proc.stderr, 'GET_BOOL keyedit.remove.uid.okay')
-        print >>proc.stdin, 'y'
-        self.context.expect(proc.stderr, 'GOT_IT')
-        self.context.expect(proc.stderr, 'GET_LINE keyedit.prompt')
-        print >>proc.stdin, 'save'
-        self.context.expect(proc.stderr, 'GOT_IT')
-        return proc.wait() == 0
+        """remove the given user id from the key
+
+        See EditSession to remove many uids at once."""
+        return self.edit_key(fingerprint).select_uid(pattern).deluid().commit()
 
     def sign_key(self, pattern, signall = False, local = False):
         """sign a OpenPGP public key
@@ -435,166 +1896,1591 @@ class Keyring():
         specific key (default) or any pattern (fingerprint, keyid,
         partial user id) that GPG will accept if we sign all uids.
 
-        @todo that this currently block if the pattern specifies an
-        incomplete UID and we do not sign all keys.
+        A GpgRuntimeError is raised if the uid is not found on the
+        key, and a GpgTimeoutError if gpg stops answering (see the
+        timeout settings of the Context).
+
+        If gpg supports it, this uses sign_uids() instead of talking
+        with the key editor, see quick_sign. Otherwise, a single uid
+        is signed through an EditSession.
         """
+        self.changed()
+        if self.use_quick_sign():
+            if signall:
+                fpr = self._find_fingerprint(pattern)
+                return self.sign_uids(fpr, None, local)
+            else:
+                fpr = self._find_fingerprint('=' + pattern)
+                return self.sign_uids(fpr, [pattern], local)
+
+        if not signall:
+            return self.edit_key(pattern).select_uid(pattern).sign(local).commit()
 
         # we iterate over the keys matching the provided
         # keyid, but we should really load those uids from the
         # output of --sign-key
         if self.context.debug: print >>self.context.debug, 'command:', self.context.build_command([['sign-key', 'lsign-key'][local], pattern])
-        proc = subprocess.Popen(self.context.build_command([['sign-key', 'lsign-key'][local], pattern]), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        session = GpgSession(self.context, [['sign-key', 'lsign-key'][local], pattern])
+        try:
+            return self._sign_key(session)
+        finally:
+            session.close()
+
+    def use_quick_sign(self):
+        """if sign_key() should use sign_uids(), see quick_sign"""
+        if self.quick_sign is None:
+            return self.context.capabilities().supports('quick-sign-key')
+        return self.quick_sign
 
+    def sign_uids(self, fpr, uids = None, local = False):
+        """sign some or all uids of a key in a single gpg call
+
+        This uses --quick-sign-key, which does not need any dialog
+        with gpg, but is only available in GnuPG 2.1 and later. The
+        key is given by its full fingerprint, and the uids to sign as
+        a list of full user ids, all uids are signed if this is None.
+
+        Errors are the same as sign_key().
+        """
+        self.changed()
+        return self._quick_signed(self.context.call_command(self._quick_sign_command(fpr, uids, local)), uids)
+
+    def _find_fingerprint(self, pattern):
+        """the fingerprint of the first key matching the pattern"""
+        if re.match('^[0-9A-F]{40}$', pattern, re.IGNORECASE):
+            return pattern
+        return self._fingerprint(self.context.call_command(['list-keys', pattern]))
+
+    @staticmethod
+    def _fingerprint(result):
+        """the fingerprint of the first key found by a listing"""
+        m = re.search('^fpr:::::::::([0-9A-F]{40}):', result.stdout, re.MULTILINE)
+        if not result or m is None:
+            raise GpgRuntimeError(result.returncode, _('unable to open key for editing: %s') % result.error_message().decode('utf-8'))
+        return m.group(1)
+
+    @staticmethod
+    def _quick_sign_command(fpr, uids, local):
+        return [['quick-sign-key', 'quick-lsign-key'][local], fpr] + list(uids or [])
+
+    @staticmethod
+    def _quick_signed(result, uids):
+        """check the GpgResult of sign_uids()"""
+        keywords = [ event.keyword for event in result.events ]
+        if 'EXPIRED' in keywords or 'KEYEXPIRED' in keywords:
+            raise GpgRuntimeError(result.returncode, _('key is expired, cannot sign'))
+        listed = re.findall('^uid:', result.stdout, re.MULTILINE)
+        if not result:
+            if listed:
+                # gpg opened the key, so it's a uid that is missing
+                raise GpgRuntimeError(result.returncode, _('user id not found on key: %s') % ', '.join(uids or []))
+            raise GpgRuntimeError(result.returncode, _('unable to open key for editing: %s') % result.error_message().decode('utf-8'))
+        # gpg succeeds without listing the key when there is nothing
+        # left to sign
+        if 'ALREADY_SIGNED' in keywords and not listed:
+            raise GpgRuntimeError(result.returncode, _('you already signed that key'))
+        return True
+
+    def _sign_key(self, session):
+        """the actual dialog with gpg for sign_key(), signing all uids"""
         # if there are multiple uids to sign, we'll get this point, and a whole other interface
         try:
-            multiuid = self.context.expect(proc.stderr, 'GET_BOOL keyedit.sign_all.okay')
+            multiuid = self.context.expect(session.status, 'GET_BOOL keyedit.sign_all.okay')
         except GpgProtocolError:
             multiuid = False
-        if multiuid:
-            if signall: # special case, sign all keys
-                print >>proc.stdin, "y"
-                self.context.expect(proc.stderr, 'GOT_IT')
-                # confirm signature
-                try:
-                    self.context.expect(proc.stderr, 'GET_BOOL sign_uid.okay')
-                except GpgProtocolError as e:
-                    if 'sign_uid.dupe_okay' in str(e):
-                        raise GpgRuntimeError(self.context.returncode, _('you already signed that key'))
-                    else:
-                        raise GpgRuntimeError(self.context.returncode, _('unable to open key for editing: %s') % self.context.stderr.decode('utf-8'))
-                print >>proc.stdin, 'y'
-                self.context.expect(proc.stderr, 'GOT_IT')
-                # expect the passphrase confirmation
-                # we seek because i have seen a USERID_HINT <keyid> <uid> in some cases
-                try:
-                    self.context.seek(proc.stderr, 'GOOD_PASSPHRASE')
-                except GpgProtocolError:
-                    raise GpgRuntimeError(self.context.returncode, _('unable to prompt for passphrase, is gpg-agent running?'))
-                return proc.wait() == 0
-
-            # don't sign all uids
-            print >>proc.stdin, "n"
-            self.context.expect(proc.stderr, 'GOT_IT')
-            # select the uid
-            self.context.expect(proc.stderr, 'GET_LINE keyedit.prompt')
-            while True:
-                # XXX: this will hang if the pattern requested is not found, we need a better way!
-                m = self.context.seek_pattern(proc.stdout, '^uid:.::::::::([^:]*):::[^:]*:(\d+),[^:]*:')
-                if m and m.group(1) == pattern:
-                    index = int(m.group(2)) + 1
-                    break
-            print >>proc.stdin, str(index)
-            self.context.expect(proc.stderr, 'GOT_IT')
-            # sign the selected uid
-            self.context.seek(proc.stderr, 'GET_LINE keyedit.prompt')
-            print >>proc.stdin, "sign"
-            self.context.expect(proc.stderr, 'GOT_IT')
+        if multiuid: # sign all uids
+            print >>session.stdin, "y"
+            self.context.expect(session.status, 'GOT_IT')
             # confirm signature
             try:
-                self.context.expect(proc.stderr, 'GET_BOOL sign_uid.okay')
+                self.context.expect(session.status, 'GET_BOOL sign_uid.okay')
+            except GpgProtocolError as e:
+                if 'sign_uid.dupe_okay' in str(e):
+                    raise GpgRuntimeError(session.returncode, _('you already signed that key'))
+                else:
+                    raise GpgRuntimeError(session.returncode, _('unable to open key for editing: %s') % session.logger.getvalue().decode('utf-8'))
+            print >>session.stdin, 'y'
+            self.context.expect(session.status, 'GOT_IT')
+            # expect the passphrase confirmation
+            # we seek because i have seen a USERID_HINT <keyid> <uid> in some cases
+            try:
+                self.context.seek(session.status, 'GOOD_PASSPHRASE', self.context.passphrase_timeout)
             except GpgProtocolError:
-                raise GpgRuntimeError(self.context.returncode, _('unable to open key for editing: %s') % self.context.stderr.decode('utf-8'))
+                raise GpgRuntimeError(session.returncode, _('unable to prompt for passphrase, is gpg-agent running?'))
+            return session.wait() == 0
 
         # we fallthrough here if there's only one key to sign
         try:
-            print >>proc.stdin, 'y'
+            print >>session.stdin, 'y'
         except IOError as e:
             if e.errno == 32:
                 # broken pipe, probably that key is missing
-                raise GpgRuntimeError(self.context.returncode, _('unable to open key for editing: %s') % self.context.stderr.decode('utf-8'))
+                raise GpgRuntimeError(session.returncode, _('unable to open key for editing: %s') % session.logger.getvalue().decode('utf-8'))
             else:
                 pass
         try:
-            self.context.expect(proc.stderr, 'GOT_IT')
+            self.context.expect(session.status, 'GOT_IT')
         except GpgProtocolError as e:
             # deal with expired keys
             # XXX: weird that this happens here and not earlier
             if 'EXPIRED' in str(e):
-                raise GpgRuntimeError(self.context.returncode, _('key is expired, cannot sign'))
+                raise GpgRuntimeError(session.returncode, _('key is expired, cannot sign'))
+            elif session.status.eof:
+                # gpg went away before reading our answer, same as the broken pipe above
+                raise GpgRuntimeError(session.returncode, _('unable to open key for editing: %s') % session.logger.getvalue().decode('utf-8'))
             else:
                 raise
         # expect the passphrase confirmation
         try:
-            self.context.seek(proc.stderr, 'GOOD_PASSPHRASE')
+            self.context.seek(session.status, 'GOOD_PASSPHRASE', self.context.passphrase_timeout)
         except GpgProtocolError:
-            raise GpgRuntimeError(self.context.returncode, _('password confirmation failed'))
-        if multiuid:
-            # we save the resulting key in uid selection mode
-            self.context.expect(proc.stderr, 'GET_LINE keyedit.prompt')
-            print >>proc.stdin, "save"
-            self.context.expect(proc.stderr, 'GOT_IT')
-        return proc.wait() == 0
+            raise GpgRuntimeError(session.returncode, _('password confirmation failed'))
+        return session.wait() == 0
+
+class EditSession():
+    """a --edit-key conversation with gpg, for many operations at once
+
+    operations are queued by calling the methods below, which can be
+    chained, and run in a single gpg process by commit(), which saves
+    the key once at the end:
+
+        edit = keyring.edit_key(fpr)
+        edit.select_uid('Foo <foo@example.com>').select_uid('Bar <bar@example.com>')
+        edit.deluid()
+        edit.commit()
+
+    it can also be used as a context manager, in which case commit()
+    is called when the block ends without an exception.
+
+    like in gpg, operations like sign() and deluid() apply to the
+    selected uids, see select_uid(). the errors raised are the same
+    as the ones of Keyring.sign_key().
+    """
+
+    # the uid lines of the key listing, with the uid and its index and flags
+    uid_pattern = re.compile('^uid:[^:]*::::::::([^:]*):::[^:]*:(\d+),([^:]*):', re.MULTILINE)
+
+    def __init__(self, keyring, fpr):
+        self.keyring = keyring
+        self.context = keyring.context
+        self.fpr = fpr
+        # (method, arguments) to run in commit()
+        self.operations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def select_uid(self, uid = None, uidhash = None):
+        """select a uid, given its full text or its hash
+
+        selecting by hash requires GnuPG 2.1 or later. a
+        GpgRuntimeError is raised by commit() if the uid is not on
+        the key."""
+        self.operations.append((self._select_uid, [uid, uidhash]))
+        return self
+
+    def deselect(self):
+        """deselect all uids"""
+        self.operations.append((self._command, ['uid 0']))
+        return self
+
+    def sign(self, local = False):
+        """sign the selected uids, or all uids if none are selected"""
+        self.operations.append((self._sign, [local]))
+        return self
+
+    def deluid(self):
+        """remove the selected uids"""
+        self.operations.append((self._command, ['deluid', {'keyedit.remove.uid.okay': 'y'}]))
+        return self
+
+    def trust(self, level):
+        """set the ownertrust of the key, from 1 (unknown) to 5 (ultimate)"""
+        self.operations.append((self._command, ['trust', {'edit_ownertrust.value': str(level),
+                                                          'edit_ownertrust.set_ultimate.okay': 'y'}]))
+        return self
+
+    def expire(self, expiry):
+        """change the expiry of the key, in the format of gpg (e.g. 1y, 0 for never)"""
+        self.operations.append((self._command, ['expire', {'keygen.valid': str(expiry)}, self.context.passphrase_timeout]))
+        return self
+
+    def commit(self):
+        """run the queued operations and save the key
+
+        returns true if gpg saved the key."""
+        (operations, self.operations) = (self.operations, [])
+        if not operations:
+            return True
+        self.keyring.changed()
+        session = GpgSession(self.context, ['edit-key', self.fpr])
+        try:
+            event = self.context.read_status(session.status)
+            while event is not None and not event.match('GET_LINE', ['keyedit.prompt']):
+                event = self.context.read_status(session.status)
+            if event is None:
+                raise GpgRuntimeError(session.returncode, _('unable to open key for editing: %s') % session.logger.getvalue().decode('utf-8'))
+            for (method, args) in operations:
+                method(session, *args)
+            self._command(session, 'save', {'keyedit.save.okay': 'y'})
+            return session.wait() == 0
+        finally:
+            session.close()
+
+    def _command(self, session, command, answers = {}, timeout = None):
+        """send a command and answer the prompts until the next one
+
+        returns the list of StatusEvents seen in between, or raises a
+        GpgProtocolError if gpg asks something not in answers."""
+        print >>session.stdin, command
+        events = []
+        while True:
+            event = self.context.read_status(session.status, timeout)
+            if event is None:
+                # gpg exited, which is normal after save
+                return events
+            events.append(event)
+            if self.context.debug: print >>self.context.debug, "FOUND:", event
+            if event.match('GET_LINE', ['keyedit.prompt']):
+                return events
+            elif event.keyword == 'ALREADY_SIGNED' or event.match('GET_BOOL', ['sign_uid.dupe_okay']):
+                raise GpgRuntimeError(session.returncode, _('you already signed that key'))
+            elif event.keyword in ['GET_BOOL', 'GET_LINE', 'GET_HIDDEN']:
+                if event.args[0] not in answers:
+                    raise GpgProtocolError(session.returncode, _('unexpected prompt from gpg: %s') % event)
+                print >>session.stdin, answers[event.args[0]]
+
+    def _listing(self, session, start = 0):
+        """the uids of the last key listing gpg printed after start
+
+        this is a list of (uid, index, flags) tuples. gpg prints the
+        listing before the prompt, so it's all there when we get
+        the prompt, but we may not have read it all yet."""
+        session.drain(session.stdout)
+        return self.listed_uids(session.stdout.getvalue()[start:])
+
+    @classmethod
+    def listed_uids(cls, output):
+        """the (uid, index, flags) of the last key listing in that
+        output of the key editor
+
+        the index is what the uid command takes to select the uid."""
+        pos = max(output.rfind('\nsec:'), output.rfind('\npub:'), 0)
+        return cls.uid_pattern.findall(output[pos:])
+
+    def _select_uid(self, session, uid, uidhash):
+        if uidhash is not None:
+            start = len(session.stdout.getvalue())
+            self._command(session, 'uid ' + uidhash)
+            # gpg only prints the key again if the uid is found
+            if not [ flags for (text, index, flags) in self._listing(session, start) if 's' in flags ]:
+                raise GpgRuntimeError(session.returncode, _('user id not found on key: %s') % uidhash)
+            return
+        for (text, index, flags) in self._listing(session):
+            if text == uid:
+                if 's' not in flags:
+                    self._command(session, 'uid ' + index)
+                return
+        raise GpgRuntimeError(session.returncode, _('user id not found on key: %s') % uid)
+
+    def _sign(self, session, local):
+        answers = {'keyedit.sign_all.okay': 'y', 'sign_uid.okay': 'y'}
+        events = self._command(session, ['sign', 'lsign'][local], answers, self.context.passphrase_timeout)
+        if not [ e for e in events if e.match('GET_BOOL', ['sign_uid.okay']) ]:
+            if [ e for e in events if e.keyword in ['EXPIRED', 'KEYEXPIRED'] ]:
+                raise GpgRuntimeError(session.returncode, _('key is expired, cannot sign'))
+            raise GpgRuntimeError(session.returncode, _('unable to open key for editing: %s') % session.logger.getvalue().decode('utf-8'))
 
 class TempKeyring(Keyring):
-    def __init__(self):
+    def __init__(self, pool = None):
         """Override the parent class to generate a temporary GPG home
-        that gets destroyed at the end of operations."""
-        Keyring.__init__(self, tempfile.mkdtemp(prefix="pygpg-"))
+        that gets destroyed at the end of operations.
+
+        The homedir comes from the given pool, if any, see
+        TempKeyringPool."""
+        self._pool = pool
+        if self._pool is not None:
+            homedir = self._pool.get()
+        else:
+            homedir = tempfile.mkdtemp(prefix="pygpg-")
+        Keyring.__init__(self, homedir)
 
     def __del__(self):
-        shutil.rmtree(self.homedir)
+        if self._pool is not None:
+            self._pool.put(self.homedir)
+        else:
+            shutil.rmtree(self.homedir)
+
+class TempKeyringPool(object):
+    """a pool of temporary GPG homes, ready to use
+
+    gpg creates a keybox and a trustdb the first time it runs in a
+    homedir, and removing the homedir when done takes a while too.
+    this keeps a few homedirs ready, copied from a template gpg
+    initialized once, and removes the ones given back in a background
+    thread, so neither happens while a TempKeyring is being used:
+
+        pool = TempKeyringPool()
+        keyring = TempKeyring(pool) # initialized already
+
+    homedirs given back are never handed out again, gpg-agent may
+    still hold the secrets imported there. they are renamed away
+    right away and removed later. the homedirs are created in a tmpfs
+    like /dev/shm if there is one, so nothing gets to disk.
+    """
+
+    # where the homedirs go, the first that can be written to,
+    # None is the default temporary directory
+    dirs = ['/dev/shm', None]
+
+    def __init__(self, size = 2, dir = None):
+        self.size = size
+        if dir is None:
+            for dir in self.dirs:
+                if dir is None or os.path.isdir(dir) and os.access(dir, os.W_OK | os.X_OK):
+                    break
+        self.dir = dir
+        # the initialized homedir the others are copied from
+        self.template = None
+        # homedirs ready to be handed out
+        self.ready = []
+        # how many of those are being made
+        self.pending = 0
+        # the homedirs handed out
+        self.given = set()
+        self.lock = threading.Lock()
+        self.tasks = Queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target = self.work, name = 'TempKeyringPool')
+        self.thread.daemon = True
+        self.thread.start()
+        self.refill()
+
+    def get(self):
+        """a homedir to use, initialized if one was ready"""
+        with self.lock:
+            homedir = self.ready.pop() if self.ready else None
+        self.refill()
+        if homedir is None:
+            # do not wait for the pool
+            homedir = tempfile.mkdtemp(prefix="pygpg-", dir = self.dir)
+        with self.lock:
+            self.given.add(homedir)
+        return homedir
+
+    def put(self, homedir):
+        """give back a homedir, it will be removed
+
+        it is renamed out of the way first, so it is gone when this
+        returns."""
+        with self.lock:
+            self.given.discard(homedir)
+        trash = tempfile.mkdtemp(prefix="pygpg-trash-", dir = os.path.dirname(homedir))
+        try:
+            os.rename(homedir, os.path.join(trash, 'homedir'))
+        except OSError:
+            os.rmdir(trash)
+            trash = homedir
+        with self.lock:
+            if not self.closed:
+                self.tasks.put(lambda: shutil.rmtree(trash, True))
+                return
+        shutil.rmtree(trash, True)
+
+    def refill(self):
+        """make homedirs in the background, up to the size of the pool"""
+        with self.lock:
+            missing = self.size - len(self.ready) - self.pending
+            if self.closed or missing <= 0:
+                return
+            self.pending += missing
+        for i in range(missing):
+            self.tasks.put(self.make)
+
+    def make(self):
+        """initialize a homedir, and add it to the ready ones"""
+        homedir = None
+        try:
+            if self.template is None:
+                self.template = tempfile.mkdtemp(prefix="pygpg-template-", dir = self.dir)
+                context = Keyring(self.template).context
+                # this is not a command anyone asked for
+                context.sinks = []
+                # this creates the keybox and trustdb
+                context.call_command(['list-keys'])
+            homedir = tempfile.mkdtemp(prefix="pygpg-", dir = self.dir)
+            for name in os.listdir(self.template):
+                path = os.path.join(self.template, name)
+                if os.path.isfile(path):
+                    shutil.copy2(path, homedir)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                if homedir is not None and not self.closed:
+                    # even if it was not all copied, gpg will do the rest
+                    self.ready.append(homedir)
+                    homedir = None
+            if homedir is not None:
+                shutil.rmtree(homedir, True)
+
+    def work(self):
+        """run the tasks queued, until None"""
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    break
+                task()
+            except EnvironmentError:
+                pass
+            finally:
+                self.tasks.task_done()
+
+    def close(self):
+        """remove all the homedirs, once the background work is done
+
+        this includes the homedirs still handed out, which TempKeyrings
+        alive when the program exits never give back, call this when
+        done with the keyrings."""
+        with self.lock:
+            self.closed = True
+        self.tasks.put(None)
+        self.thread.join()
+        with self.lock:
+            (homedirs, self.ready, self.given) = (self.ready + list(self.given), [], set())
+        for homedir in homedirs + [self.template]:
+            if homedir is not None:
+                shutil.rmtree(homedir, True)
+
+class KeyIndex(object):
+    """an index of the keys of a keyring, in a sqlite database
+
+    this keeps the fingerprints, keyids, uids, emails, trust,
+    algorithms and dates of the keys on disk, along with their
+    listing, so they can be looked up without listing the whole
+    keyring through gpg every time.
+
+    the index is stamped with the size and modification time of the
+    keyring files. when those change, the keyring is listed again,
+    but only the keys whose listing changed are written to the
+    database.
+    """
+
+    # where the databases are kept, one per keyring
+    cache = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'monkeysign')
+
+    # the files gpg changes when the keyring changes
+    files = ['pubring.gpg', 'pubring.kbx', 'secring.gpg', 'trustdb.gpg', 'private-keys-v1.d']
+
+    # bumped when the tables change, to rebuild old databases
+    version = 2
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE IF NOT EXISTS keys (fpr TEXT PRIMARY KEY, keyid TEXT, shortid TEXT,
+                                     trust TEXT, algo INTEGER, length INTEGER,
+                                     creation INTEGER, expiry INTEGER, secret INTEGER,
+                                     digest TEXT, listing TEXT);
+    CREATE INDEX IF NOT EXISTS keys_keyid ON keys (keyid);
+    CREATE INDEX IF NOT EXISTS keys_shortid ON keys (shortid);
+    CREATE TABLE IF NOT EXISTS subkeys (fpr TEXT, subfpr TEXT, keyid TEXT, shortid TEXT);
+    CREATE INDEX IF NOT EXISTS subkeys_fpr ON subkeys (fpr);
+    CREATE INDEX IF NOT EXISTS subkeys_subfpr ON subkeys (subfpr);
+    CREATE INDEX IF NOT EXISTS subkeys_keyid ON subkeys (keyid);
+    CREATE INDEX IF NOT EXISTS subkeys_shortid ON subkeys (shortid);
+    CREATE TABLE IF NOT EXISTS uids (fpr TEXT, position INTEGER, uid TEXT, email TEXT, trust TEXT,
+                                     PRIMARY KEY (fpr, position));
+    CREATE INDEX IF NOT EXISTS uids_email ON uids (email);
+    """
+
+    def __init__(self, keyring, path = None):
+        self.keyring = keyring
+        if path is None:
+            digest = hashlib.sha1(os.path.abspath(keyring.homedir)).hexdigest()
+            path = os.path.join(self.cache, 'keys-%s.sqlite' % digest[:16])
+            if not os.path.isdir(self.cache):
+                os.makedirs(self.cache)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        if self.meta('version') != str(self.version):
+            with self.db:
+                self.db.executescript("DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS keys; DROP TABLE IF EXISTS subkeys; DROP TABLE IF EXISTS uids;")
+        with self.db:
+            self.db.executescript(self.schema)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(self.version),))
+
+    def close(self):
+        self.db.close()
+
+    def meta(self, name):
+        """a value from the meta table, None if missing"""
+        try:
+            row = self.db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        except sqlite3.OperationalError:
+            # no table yet
+            return None
+        if row is None:
+            return None
+        return row[0]
+
+    def stamp(self):
+        """the size and modification time of the keyring files"""
+        stamp = []
+        for name in self.files:
+            try:
+                st = os.stat(os.path.join(self.keyring.homedir, name))
+                stamp.append([name, st.st_size, st.st_mtime])
+            except OSError:
+                stamp.append([name, None, None])
+        return json.dumps(stamp)
+
+    def refresh(self, force = False):
+        """update the index if the keyring changed since the last time
+
+        returns the number of keys written to the database."""
+        stamp = self.stamp()
+        if not force and self.meta('stamp') == stamp:
+            return 0
+        digests = dict(self.db.execute('SELECT fpr, digest FROM keys'))
+        commands = self.keyring._list_commands(None, True, True)
+        # gpg 1.x lists secret keys separately, merge them in
+        secrets = {}
+        for command, overrides in commands[1:]:
+            for lines in self._blocks(command, overrides):
+                secrets[KeyListParser.fingerprint(lines)] = lines
+        written = 0
+        with self.db:
+            (command, overrides) = commands[0]
+            for lines in self._blocks(command, overrides):
+                fpr = KeyListParser.fingerprint(lines)
+                lines += secrets.pop(fpr, [])
+                written += self._update(digests, fpr, lines)
+            for fpr, lines in secrets.iteritems():
+                written += self._update(digests, fpr, lines)
+            # what is left was deleted from the keyring
+            for fpr in digests:
+                self.db.execute('DELETE FROM keys WHERE fpr = ?', (fpr,))
+                self.db.execute('DELETE FROM subkeys WHERE fpr = ?', (fpr,))
+                self.db.execute('DELETE FROM uids WHERE fpr = ?', (fpr,))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (stamp,))
+        return written
+
+    def _blocks(self, command, overrides):
+        """the lines of each key listed by the command"""
+        parser = KeyListParser()
+        stream = self.keyring.context.stream_command(command, overrides = overrides)
+        for chunk in stream:
+            for lines in parser.blocks(chunk):
+                yield lines
+        for lines in parser.close_blocks():
+            yield lines
+        self.keyring._listed(stream.result)
+
+    def _update(self, digests, fpr, lines):
+        """write a key to the index, unless its listing did not change
+
+        digests maps the fingerprints in the index to the digest of
+        their listing, the key is removed from it. returns 1 if the
+        key was written, 0 otherwise."""
+        listing = "\n".join(lines)
+        digest = hashlib.sha1(listing).hexdigest()
+        if digests.pop(fpr, None) == digest:
+            return 0
+        key = OpenPGPkey()
+        key.parse_records([ line.split(":") for line in lines ])
+        keyid = key._keyid or ''
+        self.db.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (fpr, keyid, keyid[-8:], key.trust, key.algo, key.length,
+                         key.creation, key.expiry, int(key.secret), digest, listing))
+        # the primary key is in there too, gpg finds keys by any of
+        # their keyids
+        self.db.execute('DELETE FROM subkeys WHERE fpr = ?', (fpr,))
+        for subkey in [key] + key.subkeys.values():
+            subkeyid = subkey.fpr and subkey.fpr[-16:] or subkey._keyid or ''
+            self.db.execute('INSERT INTO subkeys VALUES (?, ?, ?, ?)',
+                            (fpr, subkey.fpr, subkeyid, subkeyid[-8:]))
+        self.db.execute('DELETE FROM uids WHERE fpr = ?', (fpr,))
+        for position, uid in enumerate(key.uidslist):
+            self.db.execute('INSERT INTO uids VALUES (?, ?, ?, ?, ?)',
+                            (fpr, position, uid.uid, self.email(uid.uid), uid.trust))
+        return 1
+
+    @staticmethod
+    def email(uid):
+        """the email address in a uid, lowercased, None if there is none"""
+        m = re.search('<([^<>]*@[^<>]*)>', uid)
+        if m:
+            return m.group(1).lower()
+        if re.match('^[^ <>]+@[^ <>]+$', uid):
+            return uid.lower()
+        return None
+
+    @staticmethod
+    def handles(pattern):
+        """if the pattern is something find() understands
+
+        that is no pattern, a fingerprint or keyid, or an email
+        between angle brackets. other patterns have gpg semantics
+        (substrings, exact matches...) the index does not implement."""
+        if pattern is None:
+            return True
+        return bool(re.match('^(0x)?[0-9A-F]{8,40}$|^<[^<>]+>$', pattern, re.IGNORECASE))
+
+    def find(self, pattern = None):
+        """the fingerprints of the keys matching the pattern
+
+        the pattern is a fingerprint (or its prefix), a long or short
+        keyid, or an email between angle brackets. keyids and full
+        fingerprints of subkeys find their primary key. no pattern
+        finds all keys."""
+        self.refresh()
+        if pattern is None:
+            rows = self.db.execute('SELECT fpr FROM keys ORDER BY fpr')
+        elif pattern.startswith('<'):
+            return self.find_email(pattern[1:-1])
+        else:
+            pattern = pattern.upper()
+            if pattern.startswith('0X'):
+                pattern = pattern[2:]
+            if len(pattern) == 8:
+                rows = self.db.execute('SELECT DISTINCT fpr FROM subkeys WHERE shortid = ? ORDER BY fpr', (pattern,))
+            elif len(pattern) == 16:
+                rows = self.db.execute('SELECT DISTINCT fpr FROM subkeys WHERE keyid = ? ORDER BY fpr', (pattern,))
+            else:
+                rows = self.db.execute('SELECT fpr FROM keys WHERE fpr >= ? AND fpr < ? UNION SELECT fpr FROM subkeys WHERE subfpr = ? ORDER BY fpr', (pattern, pattern + 'G', pattern))
+        return [ row[0] for row in rows ]
+
+    def find_email(self, email):
+        """the fingerprints of the keys with a uid for that email"""
+        self.refresh()
+        rows = self.db.execute('SELECT DISTINCT fpr FROM uids WHERE email = ? ORDER BY fpr', (email.lower(),))
+        return [ row[0] for row in rows ]
+
+    def get_key(self, fpr):
+        """the OpenPGPkey for that fingerprint, None if not indexed"""
+        row = self.db.execute('SELECT listing, secret FROM keys WHERE fpr = ?', (fpr,)).fetchone()
+        if row is None:
+            return None
+        key = OpenPGPkey()
+        key.parse_lines(row[0].split("\n"))
+        key.secret = bool(row[1])
+        return key
+
+    def get_keys(self, pattern = None, secret = False, public = True):
+        """like Keyring.get_keys(), from the index
+
+        returns None if no key was found."""
+        keys = {}
+        for fpr in self.find(pattern):
+            key = self.get_key(fpr)
+            if key is not None and (public or key.secret):
+                keys[fpr] = key
+        return keys or None
+
+class KeyLookup(object):
+    """an index of keys in memory, to find them without asking gpg
+
+    this is built from a single listing, see Keyring.lookup(), and
+    understands the patterns people use the most: fingerprints and
+    their prefixes, long and short keyids of keys and subkeys,
+    emails and @domains. unlike gpg, emails must match exactly,
+    case aside.
+    """
+
+    def __init__(self, keys):
+        # fingerprint => OpenPGPkey
+        self.keys = {}
+        # long and short keyid => fingerprints
+        self.keyids = {}
+        # email or domain => fingerprints
+        self.emails = {}
+        self.domains = {}
+        for key in keys:
+            self._add(key)
+        # sorted, to find prefixes by bisection
+        self.fprs = sorted(self.keys)
+
+    def _add(self, key):
+        self.keys[key.fpr] = key
+        for subkey in [key] + key.subkeys.values():
+            keyid = subkey.fpr and subkey.fpr[-16:] or subkey._keyid
+            if keyid:
+                for l in (16, 8):
+                    self.keyids.setdefault(keyid[-l:], []).append(key.fpr)
+        for uid in key.uidslist:
+            email = KeyIndex.email(uid.uid)
+            if email is not None:
+                self.emails.setdefault(email, []).append(key.fpr)
+                self.domains.setdefault(email.split('@')[-1], []).append(key.fpr)
+
+    def find(self, pattern):
+        """the fingerprints of the keys matching the pattern
+
+        returns None if the pattern is not something we understand,
+        in which case gpg should be asked."""
+        pattern = pattern.strip()
+        hexid = self.hexid(pattern)
+        if hexid is not None:
+            if len(hexid) in (8, 16):
+                fprs = self.keyids.get(hexid, [])
+            else:
+                start = bisect.bisect_left(self.fprs, hexid)
+                end = bisect.bisect_right(self.fprs, hexid + 'G')
+                fprs = self.fprs[start:end]
+        elif re.match('^<[^<> ]+@[^<> ]+>$', pattern):
+            fprs = self.emails.get(pattern[1:-1].lower(), [])
+        elif re.match('^[^<> ]+@[^<> ]+$', pattern):
+            fprs = self.emails.get(pattern.lower(), [])
+        elif re.match('^@[^<> @]+$', pattern):
+            fprs = self.domains.get(pattern[1:].lower(), [])
+        else:
+            return None
+        return self._unique(fprs)
+
+    def search(self, pattern):
+        """the fingerprints of the keys matching the pattern, like gpg
+
+        this is find(), but patterns it does not understand are
+        matched against user ids: exactly if they start with '=',
+        as a case-insensitive substring otherwise. emails and
+        domains not found exactly are looked for as substrings too."""
+        fprs = self.find(pattern)
+        if fprs or self.hexid(pattern) is not None:
+            return fprs
+        if pattern.startswith('='):
+            match = lambda uid: uid == pattern[1:]
+        else:
+            needle = pattern.strip().lstrip('*<').rstrip('>').lower()
+            match = lambda uid: needle in uid.lower()
+        fprs = []
+        for fpr in self.fprs:
+            for uid in self.keys[fpr].uidslist:
+                if match(uid.uid):
+                    fprs.append(fpr)
+                    break
+        return fprs
+
+    @staticmethod
+    def hexid(pattern):
+        """the fingerprint or keyid in the pattern, uppercase and
+        without spaces, or None if it is not one"""
+        hexid = pattern.replace(' ', '').upper()
+        if hexid.startswith('0X'):
+            hexid = hexid[2:]
+        if re.match('^[0-9A-F]{8,40}$', hexid):
+            return hexid
+        return None
+
+    @staticmethod
+    def _unique(fprs):
+        # a key can match more than once, through its subkeys or uids
+        unique = []
+        for fpr in fprs:
+            if fpr not in unique:
+                unique.append(fpr)
+        return unique
+
+    def get_keys(self, pattern = None, secret = False, public = True):
+        """like Keyring.get_keys(), from memory
+
+        returns a dictionary of OpenPGPkeys, maybe empty, or None if
+        the pattern is not something we understand."""
+        if pattern is None:
+            fprs = self.fprs
+        else:
+            fprs = self.find(pattern)
+            if fprs is None:
+                return None
+        keys = {}
+        for fpr in fprs:
+            key = self.keys[fpr]
+            if public or key.secret:
+                keys[fpr] = key
+        return keys
+
+class GpgFuture():
+    """the result of a gpg command that may not have completed yet
+
+    this is what the AsyncContext and AsyncKeyring return, and works
+    like the futures of the concurrent.futures module: result() runs
+    the EventLoop until the command completes, and returns its result
+    or raises its exception. callbacks can also be registered to be
+    called on completion, and then() chains processing on the result.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._done = False
+        self._result = None
+        self._exception = None
+        self.callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """the result of the command, waiting for it if needed"""
+        if not self._done:
+            self.loop.run_until_complete(self)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """the exception raised by the command, if any"""
+        if not self._done:
+            self.loop.run_until_complete(self)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """call the callback with the future once it is done"""
+        if self._done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        (callbacks, self.callbacks) = (self.callbacks, [])
+        for callback in callbacks:
+            callback(self)
+
+    def then(self, function):
+        """a future for the result of function called on our result
+
+        exceptions are passed through, and so are those raised by the
+        function. the function can also return another future, to
+        start another command, in which case its result is used."""
+        future = GpgFuture(self.loop)
+        def forward(done):
+            if done._exception is not None:
+                future.set_exception(done._exception)
+            else:
+                future.set_result(done._result)
+        def chain(done):
+            if done._exception is not None:
+                future.set_exception(done._exception)
+                return
+            try:
+                result = function(done._result)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                if isinstance(result, GpgFuture):
+                    result.add_done_callback(forward)
+                else:
+                    future.set_result(result)
+        self.add_done_callback(chain)
+        return future
+
+class EventLoop():
+    """run many gpg processes concurrently in a single thread
+
+    commands are submitted with a Dialog, which talks with gpg, and
+    a GpgFuture is returned for their result. all the running
+    processes are multiplexed in a single poll() (or select()) call,
+    so we do not need threads to avoid blocking on any of them. the
+    deadline of the context and the timeouts of the dialog are
+    enforced here too: the process is killed and the future gets a
+    GpgTimeoutError.
+
+    at most concurrency processes run at once, if set, the others are
+    queued until a slot is free.
+    """
+
+    def __init__(self, concurrency = None):
+        self.concurrency = concurrency
+        # (future, context, command, dialog) waiting for a free slot
+        self.queue = []
+        # running GpgTask objects
+        self.tasks = []
+
+    def submit(self, context, command, dialog):
+        """start running a command, returns a GpgFuture for its result"""
+        future = GpgFuture(self)
+        self.queue.append((future, context, command, dialog))
+        self.start()
+        return future
+
+    def start(self):
+        """start queued commands if there is room for them"""
+        while self.queue and (self.concurrency is None or len(self.tasks) < self.concurrency):
+            (future, context, command, dialog) = self.queue.pop(0)
+            try:
+                session = GpgSession(context, command)
+            except OSError as e:
+                future.set_exception(e)
+                continue
+            task = GpgTask(future, session, dialog)
+            self.tasks.append(task)
+            try:
+                dialog.start(session)
+            except Exception as e:
+                self.finish(task, exception = e)
+
+    def gather(self, futures):
+        """a future for the list of results of all the given futures
+
+        the first exception raised by any of those is passed
+        through."""
+        future = GpgFuture(self)
+        results = [None] * len(futures)
+        pending = [len(futures)]
+        def collect(i):
+            def callback(done):
+                if future.done():
+                    return
+                if done._exception is not None:
+                    future.set_exception(done._exception)
+                    return
+                results[i] = done._result
+                pending[0] -= 1
+                if not pending[0]:
+                    future.set_result(results)
+            return callback
+        if not futures:
+            future.set_result(results)
+        for i, f in enumerate(futures):
+            f.add_done_callback(collect(i))
+        return future
+
+    def step(self):
+        """wait for any running process to do something and handle it"""
+        readers = []
+        writers = []
+        owners = {}
+        limits = []
+        for task in self.tasks:
+            (r, w) = task.session.fds()
+            for fd in r + w:
+                owners[fd] = task
+            readers += r
+            writers += w
+            for limit in [task.session.deadline, task.dialog.expires]:
+                if limit is not None:
+                    limits.append(limit)
+            if task.session.finished():
+                # only waiting for the process to exit now
+                limits.append(time.time() + 0.01)
+        timeout = None
+        if limits:
+            timeout = min(limits) - time.time()
+        (readable, writable) = GpgSession.wait_fds(readers, writers, timeout)
+        for task in list(self.tasks):
+            task.session.process([ fd for fd in readable if owners[fd] is task ],
+                                 [ fd for fd in writable if owners[fd] is task ])
+            self.advance(task)
+        self.start()
+
+    def advance(self, task):
+        """pass new events to the dialog and check if the task is over"""
+        session = task.session
+        try:
+            task.dispatch()
+            if session.finished() and session.proc.poll() is not None:
+                self.finish(task, result = task.dialog.result(session))
+                return
+            session.check_deadline()
+            if task.dialog.expires is not None and time.time() >= task.dialog.expires:
+                task.dialog.timeout(session)
+        except Exception as e:
+            self.finish(task, exception = e)
+
+    def finish(self, task, result = None, exception = None):
+        """stop the process of the task and complete its future"""
+        task.session.close()
+        self.tasks.remove(task)
+        context = task.session.context
+        if context.debug:
+            print >>context.debug, 'command:', task.session.command
+            print >>context.debug, 'ret:', task.session.returncode, 'stdout:', task.session.stdout.getvalue(), 'stderr:', task.session.stderr.getvalue()
+        if exception is not None:
+            task.future.set_exception(exception)
+        else:
+            task.future.set_result(result)
+
+    def run_until_complete(self, future):
+        """run the loop until the given future is done"""
+        while not future.done() and (self.tasks or self.queue):
+            self.step()
+
+    def run(self):
+        """run the loop until all commands are completed"""
+        while self.tasks or self.queue:
+            self.step()
+
+class GpgTask():
+    """a GpgSession run by the EventLoop, with its Dialog and GpgFuture"""
+
+    def __init__(self, future, session, dialog):
+        self.future = future
+        self.session = session
+        self.dialog = dialog
+        self.parser = StatusParser()
+        # how many chunks of the status stream were parsed
+        self.parsed = 0
+        # status events not handled by the dialog yet
+        self.events = []
+        self.closed = False
+
+    def dispatch(self):
+        """parse what gpg wrote on the status stream and pass it to the dialog"""
+        status = self.session.status
+        for data in status.chunks[self.parsed:]:
+            self.events += self.parser.feed(data)
+        self.parsed = len(status.chunks)
+        if status.eof and not self.closed:
+            self.events += self.parser.close()
+            self.closed = True
+        while self.events:
+            if not self.dialog.event(self.session, self.events[0]):
+                break # the dialog wants to see it again later
+            self.events.pop(0)
+
+class Dialog():
+    """a conversation with gpg run by the EventLoop
+
+    this is the non-interactive conversation: it feeds the input to
+    gpg, waits for it to finish and returns the session, which has
+    all the output of the process. subclasses answer status events
+    as they are parsed, see SignDialog.
+    """
+
+    # when the current step of the conversation expires, as a
+    # time.time() value, None means never
+    expires = None
+
+    def __init__(self, context, stdin = None, output = None):
+        self.context = context
+        self.stdin = stdin
+        # file object the standard output is written to, if any
+        self.output = output
+
+    def start(self, session):
+        """called when the process is started"""
+        if self.output is not None:
+            session.stdout.sink = self.output.write
+        session.send(self.stdin or '', True)
+
+    def event(self, session, event):
+        """handle a StatusEvent
+
+        this returns False if the event can not be handled yet, in
+        which case it will be passed again when more output comes
+        in."""
+        return True
+
+    def timeout(self, session):
+        """called when the expires time is passed"""
+        raise GpgTimeoutError(session.returncode, _('timeout waiting for gpg, last output: %s') % session.status.last_line())
+
+    def result(self, session):
+        """the result of the conversation, when gpg is finished
+
+        this is the GpgResult of the command by default."""
+        return self.context.result(session)
+
+class SignDialog(Dialog):
+    """the conversation of Keyring.sign_key(), for the EventLoop
+
+    this answers prompts as they show up instead of following a
+    script like Keyring.sign_key(), but should produce the same
+    results and errors.
+    """
+
+    def __init__(self, context, pattern, signall):
+        Dialog.__init__(self, context)
+        self.pattern = pattern
+        self.signall = signall
+        # if we selected the uid to sign in the key editor
+        self.selected = False
+        # if we asked the key editor to sign it
+        self.signing = False
+        # if we confirmed the signature
+        self.confirmed = False
+        # if gpg complained about expired keys
+        self.expired = False
+        # how long we keep looking for the uid in the listing
+        self.searching = None
+
+    def start(self, session):
+        self.expires = time.time() + self.context.timeout
+
+    def answer(self, session, line, timeout = None):
+        session.send(line + "\n")
+        self.expires = time.time() + (timeout or self.context.timeout)
+
+    def event(self, session, event):
+        if event.keyword in ['EXPIRED', 'KEYEXPIRED']:
+            self.expired = True
+        elif event.match('GET_BOOL', ['keyedit.sign_all.okay']):
+            self.answer(session, ['n', 'y'][bool(self.signall)])
+        elif event.match('GET_LINE', ['keyedit.prompt']):
+            if self.confirmed:
+                # we save the resulting key in uid selection mode
+                self.answer(session, 'save')
+            elif self.signing:
+                # gpg refused to sign and went back to the prompt
+                raise GpgRuntimeError(session.returncode, _('unable to open key for editing: %s') % session.logger.getvalue().decode('utf-8'))
+            elif self.selected:
+                self.signing = True
+                self.answer(session, 'sign')
+            else:
+                index = self.find_uid(session)
+                if index is None:
+                    # gpg printed the whole listing before prompting,
+                    # but we may not have read all of it yet
+                    if self.searching is None:
+                        self.searching = time.time() + 1
+                    if time.time() < self.searching:
+                        self.expires = self.searching
+                        return False
+                    raise GpgRuntimeError(session.returncode, _('user id not found on key: %s') % self.pattern)
+                self.selected = True
+                self.answer(session, str(index))
+        elif event.match('GET_BOOL', ['sign_uid.okay']):
+            self.confirmed = True
+            # this is where the agent prompts for the passphrase
+            self.answer(session, 'y', self.context.passphrase_timeout)
+        elif event.keyword == 'ALREADY_SIGNED' or event.match('GET_BOOL', ['sign_uid.dupe_okay']):
+            raise GpgRuntimeError(session.returncode, _('you already signed that key'))
+        elif event.match('GET_BOOL', ['keyedit.save.okay']):
+            self.answer(session, 'y')
+        elif event.keyword in ['GET_BOOL', 'GET_LINE', 'GET_HIDDEN']:
+            raise GpgProtocolError(session.returncode, _('unexpected prompt from gpg: %s') % event)
+        return True
+
+    def find_uid(self, session):
+        """the index of the uid to sign in the key editor listing"""
+        for (text, index, flags) in EditSession.listed_uids(session.stdout.getvalue()):
+            if text == self.pattern:
+                return index
+        return None
+
+    def timeout(self, session):
+        if self.searching is not None and not self.selected:
+            raise GpgRuntimeError(session.returncode, _('user id not found on key: %s') % self.pattern)
+        Dialog.timeout(self, session)
+
+    def result(self, session):
+        if self.expired:
+            raise GpgRuntimeError(session.returncode, _('key is expired, cannot sign'))
+        if not self.confirmed:
+            raise GpgRuntimeError(session.returncode, _('unable to open key for editing: %s') % session.logger.getvalue().decode('utf-8'))
+        return session.returncode == 0
+
+class AsyncContext(Context):
+    """a Context running gpg commands concurrently in an EventLoop
+
+    Python 2 has no asyncio, so this uses our own EventLoop instead,
+    which can be shared between many contexts. submit() starts a
+    command and returns a GpgFuture right away, call_command() still
+    waits for the command to complete.
+    """
+
+    def __init__(self, loop = None):
+        Context.__init__(self)
+        if loop is None:
+            loop = EventLoop()
+        self.loop = loop
+
+    def submit(self, command, stdin = None, dialog = None, output = None, overrides = None):
+        """start a command in the event loop, see EventLoop.submit()
+
+        the result of the future is the GpgResult of gpg, unless
+        another dialog is given. the standard output is written to the
+        output file object as it comes, if any. the options are
+        copied, with the overrides, so they can be changed before the
+        command actually starts."""
+        context = copy.copy(self)
+        context.options = dict(self.options)
+        context.options.update(overrides or {})
+        if dialog is None:
+            dialog = Dialog(context, stdin, output)
+        else:
+            dialog.context = context
+        return self.loop.submit(context, command, dialog)
+
+class AsyncKeyring(Keyring):
+    """a Keyring whose operations run concurrently
+
+    the methods here take the same arguments as the Keyring ones, but
+    return a GpgFuture instead of waiting for gpg. many operations,
+    possibly on different keyrings, can run in the same EventLoop:
+
+        loop = EventLoop()
+        keyring = AsyncKeyring(loop = loop)
+        futures = [ keyring.fetch_keys(fpr) for fpr in fingerprints ]
+        loop.run()
+        for future in futures:
+            print future.result()
+    """
+
+    context_class = AsyncContext
+
+    def __init__(self, homedir = None, loop = None):
+        Keyring.__init__(self, homedir)
+        if loop is not None:
+            self.context.loop = loop
+
+    @property
+    def loop(self):
+        return self.context.loop
+
+    def import_data(self, data):
+        self.changed()
+        return self.context.submit(['import'], data).then(self._imported)
+
+    def export_data(self, fpr = None, secret = False, output = None):
+        command = self._export_command(fpr, secret)
+        if output is not None:
+            return self.context.submit(command, output = output).then(bool)
+        return self.context.submit(command).then(lambda result: result.stdout)
+
+    def fetch_keys(self, fpr, keyserver = None):
+        self.changed()
+        return self.context.submit(['recv-keys', fpr], overrides = self._keyserver(keyserver)).then(bool)
+
+    def get_keys(self, pattern = None, secret = False, public = True):
+        """load keys matching a specific patterns
+
+        the public and secret listings run concurrently."""
+        futures = []
+        for command, overrides in self._list_commands(pattern, secret, public):
+            futures.append(self.context.submit(command, overrides = overrides))
+        def parse(results):
+            keys = {}
+            # public listing first, so secrets get merged in
+            for result in results:
+                if not self._parse_keys(keys, result):
+                    return None
+            return keys
+        return self.loop.gather(futures).then(parse)
+
+    def encrypt_data(self, data, recipient, always_trust = False):
+        return self.context.submit(['recipient', recipient, '--encrypt'], data, overrides = self._trust(always_trust)).then(lambda result: self._encrypted(result, recipient))
+
+    def decrypt_data(self, data):
+        return self.context.submit(['--decrypt'], data).then(self._decrypted)
+
+    def sign_key(self, pattern, signall = False, local = False):
+        self.changed()
+        if self.use_quick_sign():
+            if signall:
+                (uids, lookup) = (None, pattern)
+            else:
+                (uids, lookup) = ([pattern], '=' + pattern)
+            # like Keyring.sign_key(), the pattern is the uid to sign
+            # unless all uids are signed
+            if signall and re.match('^[0-9A-F]{40}$', pattern, re.IGNORECASE):
+                return self.sign_uids(pattern, uids, local)
+            return self.context.submit(['list-keys', lookup]).then(lambda result: self.sign_uids(self._fingerprint(result), uids, local))
+        return self.context.submit([['sign-key', 'lsign-key'][local], pattern], dialog = SignDialog(self.context, pattern, signall))
+
+    def sign_uids(self, fpr, uids = None, local = False):
+        self.changed()
+        return self.context.submit(self._quick_sign_command(fpr, uids, local)).then(lambda result: self._quick_signed(result, uids))
+
+def escape_colons(text):
+    """escape text the way gpg does in its colon listings
+
+    colons, backslashes and control characters are written as \\xNN."""
+    return re.sub(r'[\x00-\x1f\x7f:\\]', lambda m: '\\x%02x' % ord(m.group(0)), text)
+
+def unescape_colons(text):
+    """the text of a field of a colon listing, see escape_colons()"""
+    return re.sub(r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), text)
+
+class RecordDecoder(object):
+    """table-driven decoder for --with-colons records
+
+    each record type maps to the fields we use, as (name, index,
+    type) tuples, following doc/DETAILS in the gnupg source. records
+    shorter than the schema get empty values, and extra fields, which
+    newer gpg versions keep adding, are ignored. unknown record types
+    decode to an empty dictionary.
+    """
+
+    # capability flags, see the capabilities field (12) in DETAILS
+    ENCRYPT = 1
+    SIGN = 2
+    CERTIFY = 4
+    AUTHENTICATE = 8
+
+    capability_flags = { 'e': ENCRYPT, 's': SIGN, 'c': CERTIFY, 'a': AUTHENTICATE }
+
+    @staticmethod
+    def integer(value):
+        """numeric field, 0 if missing"""
+        if value:
+            return int(value)
+        return 0
+
+    @staticmethod
+    def timestamp(value):
+        """seconds since the epoch, 0 if missing
+
+        gpg may also use ISO 8601 dates, which are kept as is."""
+        if value.isdigit():
+            return int(value)
+        return value or 0
+
+    @staticmethod
+    def capabilities(value):
+        """bitmask of the capability flags above
+
+        uppercase letters, describing the whole key on primary keys,
+        are treated like their lowercase version."""
+        mask = 0
+        for c in value.lower():
+            mask |= RecordDecoder.capability_flags.get(c, 0)
+        return mask
+
+    @staticmethod
+    def validity(value):
+        """single-character trust status, '-' if unknown"""
+        return intern(value or '-')
+
+    @staticmethod
+    def code(value):
+        """short code repeated all over a listing, shared between keys"""
+        return intern(value)
+
+    key = (('trust', 1, 'validity'),
+           ('length', 2, 'integer'),
+           ('algo', 3, 'integer'),
+           ('keyid', 4, None),
+           ('creation', 5, 'timestamp'),
+           ('expiry', 6, 'timestamp'),
+           ('ownertrust', 8, 'code'),
+           ('capabilities', 11, 'capabilities'),
+           ('token', 14, 'code'),
+           )
+
+    signature = (('validity', 1, None),
+                 ('algo', 3, 'integer'),
+                 ('keyid', 4, None),
+                 ('creation', 5, 'timestamp'),
+                 ('expiry', 6, 'timestamp'),
+                 ('uid', 9, None),
+                 ('sigclass', 10, 'code'),
+                 )
+
+    schema = { 'pub': key,
+               'sec': key,
+               'sub': key,
+               'ssb': key,
+               'fpr': (('fpr', 9, None),),
+               'grp': (('keygrip', 9, None),),
+               'uid': (('trust', 1, 'validity'),
+                       ('creation', 5, 'timestamp'),
+                       ('expiry', 6, 'timestamp'),
+                       ('uidhash', 7, None),
+                       ('uid', 9, None),
+                       ),
+               'uat': (('trust', 1, 'validity'),
+                       ('creation', 5, 'timestamp'),
+                       ('uidhash', 7, None),
+                       ),
+               'sig': signature,
+               'rev': signature,
+               'rvk': (('algo', 3, 'integer'),
+                       ('fpr', 9, None),
+                       ),
+               'tru': (('staleness', 1, None),
+                       ('model', 2, 'integer'),
+                       ('creation', 3, 'timestamp'),
+                       ('expiry', 4, 'timestamp'),
+                       ),
+               'cfg': (('name', 1, None),
+                       ('value', 2, None),
+                       ),
+               }
 
-class OpenPGPkey():
+    def __init__(self):
+        # resolve the type names once, so decode() stays a tight loop
+        self.fields = {}
+        for rectype, fields in self.schema.iteritems():
+            width = max([ index for (name, index, type) in fields ]) + 1
+            self.fields[rectype] = (width, [ (name, index, type and getattr(self, type)) for (name, index, type) in fields ])
+
+    def decode(self, record):
+        """decode a record, a list of fields, into a dictionary"""
+        (width, fields) = self.fields.get(record[0], (0, ()))
+        if len(record) < width:
+            record = record + [''] * (width - len(record))
+        values = {}
+        for name, index, type in fields:
+            if type is None:
+                values[name] = record[index]
+            else:
+                values[name] = type(record[index])
+        return values
+
+class KeyListParser(object):
+    """incremental parser for --with-colons key listings
+
+    the listing is fed in chunks, as it comes out of gpg, and
+    OpenPGPkey objects are returned as soon as the next key starts,
+    so only the lines of one key are held at a time. keys already
+    in the keys dictionary, if one is given, are completed instead
+    of replaced, which is how secret listings are merged into public
+    ones.
+
+    lines are only split to find where keys start and what their
+    fingerprint is, the keys decode the rest lazily, see
+    OpenPGPkey.parse_lines().
+    """
+
+    # record types starting a new key
+    primary = ('pub:', 'sec:')
+
+    def __init__(self, keys = None):
+        self.keys = keys
+        self.buf = ''
+        self.lines = []
+
+    def parse(self, text):
+        """parse a complete listing, returns the list of keys found"""
+        return self.feed(text) + self.close()
+
+    def feed(self, data):
+        """parse a chunk of the listing, returns the keys it completed"""
+        return [ self.build(lines) for lines in self.blocks(data) ]
+
+    def close(self):
+        """parse the end of the listing, returns the last keys"""
+        return [ self.build(lines) for lines in self.close_blocks() ]
+
+    def blocks(self, data):
+        """split a chunk of the listing, returns the lines of the keys
+        it completed, without parsing them"""
+        blocks = []
+        lines = (self.buf + data).split("\n")
+        self.buf = lines.pop()
+        for line in lines:
+            if line[:4] in self.primary:
+                if self.lines:
+                    blocks.append(self.lines)
+                self.lines = [line]
+            # records before the first key, like tru, are skipped
+            elif self.lines:
+                self.lines.append(line)
+        return blocks
+
+    def close_blocks(self):
+        """split the end of the listing, returns the lines of the last
+        keys"""
+        blocks = []
+        if self.buf:
+            blocks = self.blocks("\n")
+        if self.lines:
+            blocks.append(self.lines)
+            self.lines = []
+        return blocks
+
+    @staticmethod
+    def fingerprint(lines):
+        """the fingerprint of the key listed in those lines"""
+        for line in lines:
+            if line[:4] == 'fpr:':
+                return line.split(":")[9]
+        return None
+
+    def build(self, lines):
+        """build the key listed in those lines"""
+        key = None
+        fpr = self.fingerprint(lines)
+        if self.keys is not None and fpr is not None:
+            key = self.keys.get(fpr)
+        if key is None:
+            key = OpenPGPkey()
+            key.parse_lines(lines)
+            if self.keys is not None:
+                self.keys[key.fpr] = key
+        else:
+            key.parse_lines(lines)
+        return key
+
+def _flag(bit, doc):
+    """a boolean property stored as a bit of the flags attribute"""
+    def get(self):
+        return bool(self.flags & bit)
+    def set(self, value):
+        if value:
+            self.flags |= bit
+        else:
+            self.flags &= ~bit
+    return property(get, set, doc = doc)
+
+class OpenPGPkey(object):
     """An OpenPGP key.
 
     Some of this datastructure is taken verbatim from GPGME.
+
+    Keyrings can hold a lot of those, so they are kept compact: the
+    attributes are slots, booleans are bits of the flags attribute,
+    the capabilities are a bitmask and repeated codes are interned.
+
+    Uids and subkeys are decoded lazily: parse_lines() only decodes
+    the key record and fingerprint, and keeps the other lines until
+    uidslist, uids or subkeys are first accessed.
     """
 
+    # record types decoded right away by parse_lines(), the ones
+    # describing the primary key
+    header = ('tru', 'pub', 'sec', 'fpr', 'grp', 'rvk', 'cfg', '')
+
+    __slots__ = ('flags', 'capabilities', 'algo', 'length', 'fpr', '_keyid',
+                 'creation', 'expiry', 'trust', 'token', 'keygrip',
+                 '_uidslist', '_uidindex', '_subkeys', '_pending')
+
+    # bits of the flags attribute
+    REVOKED = 1
+    EXPIRED = 2
+    DISABLED = 4
+    INVALID = 8
+    QUALIFIED = 16
+    SECRET = 32
+
     # the key has a revocation certificate
     # @todo - not implemented
-    revoked = False
+    revoked = _flag(REVOKED, 'the key has a revocation certificate')
 
     # the expiry date is set and it is passed
     # @todo - not implemented
-    expired = False
+    expired = _flag(EXPIRED, 'the expiry date is set and it is passed')
 
     # the key has been disabled
     # @todo - not implemented
-    disabled = False
+    disabled = _flag(DISABLED, 'the key has been disabled')
 
     # ?
-    invalid = False
-
-    # the various flags on this key
-    purpose = {}
+    invalid = _flag(INVALID, 'the key is invalid')
 
     # This is true if the subkey can be used for qualified
     # signatures according to local government regulations.
     # @todo - not implemented
-    qualified = False
+    qualified = _flag(QUALIFIED, 'the key can be used for qualified signatures')
 
     # this key has also secret key material
-    secret = False
-
-    # This is the public key algorithm supported by this subkey.
-    algo = -1
-
-    # This is the length of the subkey (in bits).
-    length = None
-
-    # The key fingerprint (a string representation)
-    fpr = None
-
-    # The key id (a string representation), only if the fingerprint is unavailable
-    # use keyid() instead of this field to find the keyid
-    _keyid = None
+    secret = _flag(SECRET, 'this key has also secret key material')
 
-    # This is the creation timestamp of the subkey.  This is -1 if
-    # the timestamp is invalid, and 0 if it is not available.
-    creation = 0
-
-    # This is the expiration timestamp of the subkey, or 0 if the
-    # subkey does not expire.
-    expiry = 0
-
-    # single-character trust status, see trust_map below for parsing
-    trust = None
-
-    # the list of OpenPGPuids associated with this key
-    uids = {}
-
-    # the list of subkeys associated with this key
-    subkeys = {}
+    # decodes the records of --with-colons listings
+    decoder = RecordDecoder()
 
     trust_map = {'o': 'new', # this key is new to the system
                  'i': 'invalid', # The key is invalid (e.g. due to a
@@ -619,16 +3505,120 @@ class OpenPGPkey():
                  }
 
     def __init__(self, data=None):
-        self.purpose = { 'encrypt': True, # if the public key part can be used to encrypt data
-                         'sign': True,    # if the private key part can be used to sign data
-                         'certify': True, # if the private key part can be used to sign other keys
-                         'authenticate': True, # if this key can be used for authentication purposes
-                         }
-        self.uids = {}
-        self.subkeys = {}
+        self.flags = 0
+        # the capabilities of the key, a bitmask of RecordDecoder
+        # flags. everything is allowed until the key is parsed
+        self.capabilities = RecordDecoder.ENCRYPT | RecordDecoder.SIGN | RecordDecoder.CERTIFY | RecordDecoder.AUTHENTICATE
+        # This is the public key algorithm supported by this subkey.
+        self.algo = -1
+        # This is the length of the subkey (in bits).
+        self.length = None
+        # The key fingerprint (a string representation)
+        self.fpr = None
+        # The key id (a string representation), only if the fingerprint is unavailable
+        # use keyid() instead of this field to find the keyid
+        self._keyid = None
+        # This is the creation timestamp of the subkey.  This is -1 if
+        # the timestamp is invalid, and 0 if it is not available.
+        self.creation = 0
+        # This is the expiration timestamp of the subkey, or 0 if the
+        # subkey does not expire.
+        self.expiry = 0
+        # single-character trust status, see trust_map for parsing
+        self.trust = None
+        # the serial number or token field, when listed --with-secret:
+        # '+' if the secret part is available, '#' for a stub, or the
+        # serial number of the card holding it
+        self.token = None
+        # the keygrip, listed by gpg 2.1 and later
+        self.keygrip = None
+        # the OpenPGPuids associated with this key, in the order gpg
+        # lists them
+        self._uidslist = []
+        # uid hash => OpenPGPuid, built when first needed by find_uid()
+        self._uidindex = None
+        # keyid => subkey, most keys have one or two, if any
+        self._subkeys = None
+        # lines of the listing not decoded yet, see parse_lines()
+        self._pending = None
         if data is not None:
             self.parse_gpg_list(data)
 
+    @property
+    def purpose(self):
+        """the capabilities of the key, as a dictionary of booleans"""
+        return { 'encrypt': bool(self.capabilities & RecordDecoder.ENCRYPT), # if the public key part can be used to encrypt data
+                 'sign': bool(self.capabilities & RecordDecoder.SIGN), # if the private key part can be used to sign data
+                 'certify': bool(self.capabilities & RecordDecoder.CERTIFY), # if the private key part can be used to sign other keys
+                 'authenticate': bool(self.capabilities & RecordDecoder.AUTHENTICATE), # if this key can be used for authentication purposes
+                 }
+
+    @property
+    def uidslist(self):
+        """the OpenPGPuids of this key, in the order gpg lists them"""
+        if self._pending:
+            self.materialize()
+        return self._uidslist
+
+    @property
+    def uids(self):
+        """the uids of this key, as a new dictionary indexed by uid hash
+
+        this is built from uidslist on every access, use find_uid()
+        to look up a single uid."""
+        uids = {}
+        for uid in self.uidslist:
+            uids[uid.uidhash] = uid
+        return uids
+
+    @property
+    def subkeys(self):
+        """the subkeys of this key, indexed by keyid"""
+        if self._pending:
+            self.materialize()
+        return self._subkeys or {}
+
+    def __copy__(self):
+        """a copy of the key, with its own uids and subkeys
+
+        the lines not decoded yet are shared, they are not changed."""
+        key = type(self).__new__(type(self))
+        for name in OpenPGPkey.__slots__:
+            setattr(key, name, getattr(self, name))
+        key._uidslist = [ copy.copy(uid) for uid in self._uidslist ]
+        key._uidindex = None
+        if self._subkeys is not None:
+            key._subkeys = dict([ (keyid, copy.copy(subkey)) for keyid, subkey in self._subkeys.iteritems() ])
+        return key
+
+    def find_uid(self, uidhash):
+        """the uid with that hash, or None"""
+        if self._uidindex is None:
+            self._uidindex = {}
+            for uid in self.uidslist:
+                self._uidindex[uid.uidhash] = uid
+        return self._uidindex.get(uidhash)
+
+    def add_uid(self, uid):
+        """add a uid at the end of the list"""
+        self.uidslist.append(uid)
+        if self._uidindex is not None:
+            self._uidindex[uid.uidhash] = uid
+
+    def add_subkey(self, subkey):
+        """add a subkey, replacing the one with the same keyid"""
+        if self._pending:
+            self.materialize()
+        if self._subkeys is None:
+            self._subkeys = {}
+        self._subkeys[subkey._keyid] = subkey
+
+    def materialize(self):
+        """decode the lines parse_lines() kept for later"""
+        if self._pending:
+            (lines, self._pending) = (self._pending, None)
+            self.parse_records([ line.split(":") for line in lines ])
+
     def keyid(self, l=8):
         if self.fpr is None:
             assert(self._keyid is not None)
@@ -639,61 +3629,113 @@ class OpenPGPkey():
         return OpenPGPkey.trust_map[self.trust]
 
     def parse_gpg_list(self, text):
-        uidslist = []
-        for block in text.split("\n"):
-            record = block.split(":")
-            #for block in record:
-            #        print >>sys.stderr, block, "|\t",
-            #print >>sys.stderr, "\n"
+        """parse a --with-colons listing of this key"""
+        self.parse_lines(text.split("\n"))
+
+    def parse_lines(self, lines):
+        """parse the lines of a --with-colons listing of this key, lazily
+
+        only the records describing the primary key are decoded, the
+        uids and subkeys are decoded when first accessed. a listing
+        merged into a key already parsed is decoded right away.
+        """
+        if self._pending or self._uidslist or self._subkeys:
+            self.materialize()
+            self.parse_records([ line.split(":") for line in lines ])
+            return
+        header = []
+        for i, line in enumerate(lines):
+            record = line.split(":")
+            if record[0] not in self.header:
+                self._pending = lines[i:]
+                break
+            header.append(record)
+        self.parse_records(header)
+
+    def parse_records(self, records):
+        """parse the records of a --with-colons listing of this key
+
+        the records are lists of fields, decoded according to the
+        RecordDecoder schema. this can be called more than once, to
+        merge a secret key listing into a public one for example, in
+        which case user ids already known are kept. record types we
+        do not know about are ignored.
+        """
+        decode = self.decoder.decode
+        # the key or subkey the next fpr and grp records belong to
+        current = self
+        # the uid the next signature records belong to
+        uid = None
+        # only look for known uids when merging listings
+        merging = bool(self._uidslist)
+        for record in records:
             rectype = record[0]
-            if rectype == 'tru':
-                (rectype, trust, selflen, algo, keyid, creation, expiry, serial) = record
-            elif rectype == 'fpr':
-                self.fpr = record[9]
-            elif rectype == 'pub':
-                (null, self.trust, self.length, self.algo, keyid, self.creation, self.expiry, serial, trust, uid, sigclass, purpose, smime) = record
-                for p in self.purpose:
-                    self.purpose[p] = p[0].lower() in purpose.lower()
-                if self.trust == '':
-                    self.trust = '-'
+            if rectype == 'fpr':
+                if current.fpr is None:
+                    current.fpr = decode(record)['fpr']
+            elif rectype == 'grp':
+                current.keygrip = decode(record)['keygrip']
+            elif rectype in ('pub', 'sec'):
+                current = self
+                uid = None
+                self.set_fields(decode(record))
+                # sec records, and pub records listed --with-secret
+                # in gpg 2.1, flag keys with a secret part, even on a
+                # card or offline, like gpg --list-secret-keys does
+                if rectype == 'sec' or self.token:
+                    self.secret = True
+            elif rectype in ('sub', 'ssb'):
+                fields = decode(record)
+                current = (self._subkeys or {}).get(fields['keyid'])
+                if current is None:
+                    current = OpenPGPkey()
+                    current.set_fields(fields)
+                    self.add_subkey(current)
+                elif rectype == 'sub':
+                    current.set_fields(fields)
+                if rectype == 'ssb' or current.token:
+                    current.secret = True
             elif rectype == 'uid':
-                (rectype, trust, null  , null, null, creation, expiry, uidhash, null, uid, null) = record
-                uid = OpenPGPuid(uid, trust, creation, expiry, uidhash)
-                self.uids[uidhash] = uid
-                uidslist.append(uid)
-            elif rectype == 'sub':
-                subkey = OpenPGPkey()
-                (rectype, trust, subkey.length, subkey.algo, subkey._keyid, subkey.creation, subkey.expiry, serial, trust, uid, sigclass, purpose, smime) = record
-                for p in subkey.purpose:
-                    subkey.purpose[p] = p[0].lower() in purpose.lower()
-                self.subkeys[subkey._keyid] = subkey
-            elif rectype == 'sec':
-                (null, self.trust, self.length, self.algo, keyid, self.creation, self.expiry, serial, trust, uid, sigclass, purpose, smime, wtf, wtf, wtf) = record
-                self.secret = True
-                if self.trust == '':
-                    self.trust = '-'
-            elif rectype == 'ssb':
-                subkey = OpenPGPkey()
-                (rectype, trust, subkey.length, subkey.algo, subkey._keyid, subkey.creation, subkey.expiry, serial, trust, uid, sigclass, purpose, smime, wtf, wtf, wtf) = record
-                if subkey._keyid in self.subkeys:
-                    # XXX: nothing else to add here?
-                    self.subkeys[subkey._keyid].secret = True
+                fields = decode(record)
+                uid = None
+                if merging:
+                    # secret listings from gpg 1.x have no uid hash
+                    if fields['uidhash']:
+                        uid = self.find_uid(fields['uidhash'])
+                    else:
+                        for known in self._uidslist:
+                            if known.uid == fields['uid']:
+                                uid = known
+                if uid is None:
+                    uid = OpenPGPuid(fields['uid'], fields['trust'], fields['creation'], fields['expiry'], fields['uidhash'])
+                    self.add_uid(uid)
                 else:
-                    self.subkeys[subkey._keyid] = subkey
-            elif rectype == 'uat':
-                pass # user attributes, ignore for now
-            elif rectype == 'rvk':
-                pass # revocation key, ignored for now
-            elif rectype == '':
-                pass
-            else:
-                raise NotImplementedError(_("record type '%s' not implemented") % rectype)
-        if uidslist: self.uidslist = uidslist
+                    # already known, keep the signatures we have
+                    uid = None
+            elif rectype in ('sig', 'rev'):
+                if uid is not None:
+                    fields = decode(record)
+                    fields['revocation'] = rectype == 'rev'
+                    if not uid.signatures:
+                        uid.signatures = []
+                    uid.signatures.append(fields)
+            # other records (tru, uat, rvk, cfg, spk...) are not used
+
+    def set_fields(self, fields):
+        """set the attributes of a key from a decoded key record"""
+        self.trust = fields['trust']
+        self.length = fields['length']
+        self.algo = fields['algo']
+        self._keyid = fields['keyid']
+        self.creation = fields['creation']
+        self.expiry = fields['expiry']
+        self.token = fields['token']
+        self.capabilities = fields['capabilities']
 
     def __str__(self):
         ret = u'pub  [%s] %sR/' % (self.get_trust(), self.length)
-        ret += self.keyid(8) + u" " + self.creation
-        if self.expiry: ret += u' [expiry: ' + self.expiry + ']'
+        ret += u"%s %s" % (self.keyid(8), self.creation)
+        if self.expiry: ret += u' [expiry: %s]' % self.expiry
         ret += u"\n"
         ret += u'    Fingerprint = ' + self.format_fpr() + "\n"
         i = 1
@@ -701,8 +3743,8 @@ class OpenPGPkey():
             ret += u"uid %d      [%s] %s\n" % (i, uid.get_trust(), uid.uid.decode('utf-8'))
             i += 1
         for subkey in self.subkeys.values():
-            ret += u"sub   " + subkey.length + u"R/" + subkey.keyid(8) + u" " + subkey.creation
-            if subkey.expiry: ret += u' [expiry: ' + subkey.expiry + "]"
+            ret += u"sub   %sR/%s %s" % (subkey.length, subkey.keyid(8), subkey.creation)
+            if subkey.expiry: ret += u' [expiry: %s]' % subkey.expiry
             ret += u"\n"
         return ret
 
@@ -722,7 +3764,9 @@ class OpenPGPkey():
             if i == 4: s += ' '
         return s
 
-class OpenPGPuid():
+class OpenPGPuid(object):
+    __slots__ = ('uid', 'trust', 'creation', 'expire', 'uidhash', 'signatures')
+
     def __init__(self, uid, trust, creation = 0, expire = None, uidhash = ''):
         self.uid = uid
         self.trust = trust
@@ -731,6 +3775,14 @@ class OpenPGPuid():
         self.creation = creation
         self.expire = expire
         self.uidhash = uidhash
+        # the sig and rev records listed after this uid, decoded
+        # by RecordDecoder. a list once there is any
+        self.signatures = ()
+
+    def __copy__(self):
+        uid = OpenPGPuid(self.uid, self.trust, self.creation, self.expire, self.uidhash)
+        uid.signatures = self.signatures and list(self.signatures)
+        return uid
 
     def get_trust(self):
         return OpenPGPkey.trust_map[self.trust]
@@ -750,3 +3802,12 @@ class GpgProtocolError(IOError):
 
 class GpgRuntimeError(IOError):
     pass
+
+class GpgTimeoutError(GpgRuntimeError):
+    """raised when gpg does not answer in time
+
+    the errno is the exit code of the process, if it exited already,
+    None otherwise. see the timeout and deadline settings in the
+    Context class.
+    """
+    pass
@@ -0,0 +1,806 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012-2013 Antoine Beaupré <anarcat@orangeseeds.org>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+OpenPGP packets, without GPG
+
+This reads keys and signatures straight from keyrings and exports,
+see PacketReader, and does the ASCII armor and the hashes that go
+with them. GPG stays the reference: this only knows what
+monkeysign needs to avoid running it, the Keyring in monkeysign.gpg
+falls back on gpg when the data is not understood.
+"""
+
+import os, time, hashlib
+
+# decoding binary keyrings and armor
+import mmap, struct, base64, binascii, array, sys
+
+import monkeysign.translation
+from monkeysign.gpg import RecordDecoder, OpenPGPkey, OpenPGPuid, escape_colons, unescape_colons
+
+# the message schedule and rotations of RIPEMD-160, left and right lines
+_rmd_r = (range(16) +
+          [7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8] +
+          [3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12] +
+          [1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2] +
+          [4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13])
+_rmd_rr = ([5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12] +
+           [6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2] +
+           [15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13] +
+           [8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14] +
+           [12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11])
+_rmd_s = ([11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8] +
+          [7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12] +
+          [11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5] +
+          [11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12] +
+          [9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6])
+_rmd_sr = ([8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6] +
+           [9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11] +
+           [9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5] +
+           [15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8] +
+           [8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11])
+_rmd_k = (0, 0x5A827999, 0x6ED9EBA1, 0x8F1BBCDC, 0xA953FD4E)
+_rmd_kr = (0x50A28BE6, 0x5C4DD124, 0x6D703EF3, 0x7A6D76E9, 0)
+
+def _rmd_f(j, x, y, z):
+    if j < 16:
+        return x ^ y ^ z
+    elif j < 32:
+        return (x & y) | (~x & z)
+    elif j < 48:
+        return (x | ~y) ^ z
+    elif j < 64:
+        return (x & z) | (y & ~z)
+    return x ^ (y | ~z)
+
+def ripemd160(data):
+    """the RIPEMD-160 digest of the data, in hexadecimal
+
+    gpg identifies user ids by this hash. hashlib only has it when
+    OpenSSL provides it, which recent versions do not by default,
+    this is the slow, but always available, fallback."""
+    try:
+        return hashlib.new('ripemd160', data).hexdigest()
+    except ValueError:
+        pass
+    rol = lambda x, n: ((x << n) | (x >> (32 - n))) & 0xffffffff
+    data = str(data)
+    length = len(data) * 8
+    data += '\x80' + '\x00' * ((55 - len(data)) % 64) + struct.pack('<Q', length)
+    h = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476, 0xC3D2E1F0]
+    for block in range(0, len(data), 64):
+        x = struct.unpack_from('<16I', data, block)
+        (a, b, c, d, e) = h
+        (ar, br, cr, dr, er) = h
+        for j in range(80):
+            t = (rol((a + _rmd_f(j, b, c, d) + x[_rmd_r[j]] + _rmd_k[j >> 4]) & 0xffffffff, _rmd_s[j]) + e) & 0xffffffff
+            (a, e, d, c, b) = (e, d, rol(c, 10), b, t)
+            t = (rol((ar + _rmd_f(79 - j, br, cr, dr) + x[_rmd_rr[j]] + _rmd_kr[j >> 4]) & 0xffffffff, _rmd_sr[j]) + er) & 0xffffffff
+            (ar, er, dr, cr, br) = (er, dr, rol(cr, 10), br, t)
+        h = [(h[1] + c + dr) & 0xffffffff,
+             (h[2] + d + er) & 0xffffffff,
+             (h[3] + e + ar) & 0xffffffff,
+             (h[4] + a + br) & 0xffffffff,
+             (h[0] + b + cr) & 0xffffffff]
+    return struct.pack('<5I', *h).encode('hex')
+
+def _crc24_table():
+    table = []
+    for i in range(256):
+        crc = i << 16
+        for bit in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864cfb
+        table.append(crc & 0xffffff)
+    return table
+
+_crc24 = _crc24_table()
+
+def _crc24_word_table():
+    """the checksums of all two byte strings, starting from zero"""
+    table = []
+    for i in range(65536):
+        crc = _crc24[i >> 8]
+        table.append(((crc << 8) & 0xffffff) ^ _crc24[(crc >> 16) ^ (i & 0xff)])
+    return table
+
+# made on first use, it takes a little while
+_crc24_words = None
+
+def crc24(data, crc = 0xb704ce):
+    """the checksum of ASCII armor, see RFC 4880 section 6.1
+
+    pass the previous checksum to continue it over more data. this
+    goes through the data two bytes at a time."""
+    global _crc24_words
+    if _crc24_words is None:
+        _crc24_words = _crc24_word_table()
+    (table, size) = (_crc24_words, len(data) & ~1)
+    words = array.array('H', data[:size])
+    if sys.byteorder == 'little':
+        words.byteswap()
+    for word in words:
+        crc = ((crc << 16) & 0xffffff) ^ table[(crc >> 8) ^ word]
+    if size < len(data):
+        crc = ((crc << 8) & 0xffffff) ^ _crc24[(crc >> 16) ^ ord(data[size])]
+    return crc
+
+class ArmorEncoder(object):
+    """a streaming ASCII armor encoder, see RFC 4880 section 6.2
+
+    binary OpenPGP data is fed in chunks of any size, and comes out as
+    complete lines of armored text, the checksum is computed along the
+    way:
+
+        encoder = ArmorEncoder()
+        for chunk in keyring.iter_export(fpr):
+            output.write(encoder.feed(chunk))
+        output.write(encoder.close())
+    """
+
+    # the bytes in a line of 64 base64 characters
+    line = 48
+
+    def __init__(self, block = 'PUBLIC KEY BLOCK'):
+        self.block = block
+        self.crc = 0xb704ce
+        # what does not fill a line yet
+        self.pending = ''
+        self.started = False
+
+    def feed(self, data):
+        """armor that data, returns the text of the complete lines"""
+        self.crc = crc24(data, self.crc)
+        data = self.pending + data
+        size = len(data) - len(data) % self.line
+        self.pending = data[size:]
+        text = self.lines(data[:size])
+        if not self.started:
+            self.started = True
+            text = '-----BEGIN PGP %s-----\n\n' % self.block + text
+        return text
+
+    def close(self):
+        """the end of the armored text, with the checksum"""
+        text = self.feed('') + self.lines(self.pending)
+        self.pending = ''
+        return text + '=%s\n-----END PGP %s-----\n' % (base64.b64encode(struct.pack('>I', self.crc)[1:]), self.block)
+
+    def lines(self, data):
+        encoded = base64.b64encode(data)
+        return ''.join([ encoded[i:i+64] + '\n' for i in xrange(0, len(encoded), 64) ])
+
+class ArmorDecoder(object):
+    """a streaming ASCII armor decoder
+
+    armored text is fed in chunks of any size, and the binary data of
+    the armored blocks found in it comes out, one block after the
+    other. text outside of the blocks is ignored. a ValueError is
+    raised if a block is not valid base64 or if its checksum does not
+    match, which is only known at the end of the block:
+
+        decoder = ArmorDecoder()
+        for chunk in iter(lambda: fd.read(4096), ''):
+            output.write(decoder.feed(chunk))
+        output.write(decoder.close())
+    """
+
+    # where we are in the text
+    OUTSIDE, HEADERS, BODY = range(3)
+
+    def __init__(self):
+        self.state = self.OUTSIDE
+        # the last line, if it is not finished
+        self.buffer = ''
+        self.reset()
+
+    def reset(self):
+        self.crc = 0xb704ce
+        self.checksum = None
+        # base64 characters that do not make a full group yet
+        self.encoded = ''
+
+    def feed(self, text):
+        """decode that text, returns the binary data found so far"""
+        lines = (self.buffer + text).split('\n')
+        self.buffer = lines.pop()
+        return ''.join([ self.line(line) for line in lines ])
+
+    def close(self):
+        """the data left, and the end of the checksum verification"""
+        data = self.feed('\n')
+        if self.state == self.BODY:
+            data += self.finish()
+        return data
+
+    def line(self, line):
+        line = line.strip()
+        if self.state == self.OUTSIDE:
+            if line.startswith('-----BEGIN PGP '):
+                self.state = self.HEADERS
+        elif self.state == self.HEADERS:
+            # headers, like Version:, end with an empty line
+            if not line:
+                self.state = self.BODY
+        elif line.startswith('-----END PGP '):
+            self.state = self.OUTSIDE
+            return self.finish()
+        elif line.startswith('='):
+            self.checksum = line[1:]
+        else:
+            encoded = self.encoded + line
+            size = len(encoded) & ~3
+            self.encoded = encoded[size:]
+            return self.decode(encoded[:size])
+        return ''
+
+    def decode(self, encoded):
+        try:
+            data = binascii.a2b_base64(encoded)
+        except binascii.Error:
+            raise ValueError(_('invalid ASCII armor'))
+        self.crc = crc24(data, self.crc)
+        return data
+
+    def finish(self):
+        """the end of a block, checks its checksum"""
+        data = self.decode(self.encoded)
+        if self.checksum is not None:
+            try:
+                checksum = binascii.a2b_base64(self.checksum)
+            except binascii.Error:
+                raise ValueError(_('invalid ASCII armor'))
+            if len(checksum) != 3 or struct.unpack('>I', '\x00' + checksum)[0] != self.crc:
+                raise ValueError(_('invalid checksum in ASCII armor'))
+        self.reset()
+        return data
+
+def armor(data, block = 'PUBLIC KEY BLOCK'):
+    """ASCII armor binary OpenPGP data, like gpg --armor does
+
+    see ArmorEncoder to armor data as it comes."""
+    encoder = ArmorEncoder(block)
+    return encoder.feed(data) + encoder.close()
+
+def dearmor(text):
+    """the binary data of ASCII armored OpenPGP data
+
+    the data of all the armored blocks found in the text is
+    returned, one after the other. a ValueError is raised if a
+    checksum does not match, see ArmorDecoder."""
+    decoder = ArmorDecoder()
+    return decoder.feed(text) + decoder.close()
+
+class PacketReader(object):
+    """a reader for the OpenPGP packets of keyring files, without gpg
+
+    this reads the keys of a pubring.gpg, or of a keybox like the
+    pubring.kbx of gpg 2.1 and later, straight from the file, and
+    builds the same OpenPGPkey objects as a gpg listing. the file is
+    mapped in memory and packets are decoded in place, only what is
+    kept, like user ids, is copied out of it:
+
+        for key in PacketReader.open(homedir + '/pubring.kbx').keys():
+            print key.fpr, key.uidslist[0].uid
+
+    gpg checks signatures and computes validity from its trustdb,
+    this does neither. self-signatures are taken as they are to find
+    the expiry, capabilities and revocations of the keys, and their
+    trust is unknown ('-'), or 'r' and 'e' for revoked and expired
+    keys. only keys from secret keyrings, the secring.gpg of gpg
+    1.x, are flagged as secret.
+
+    a ValueError is raised if the file is not something we
+    understand.
+    """
+
+    # packet tags
+    SIGNATURE = 2
+    SECRET_KEY = 5
+    PUBLIC_KEY = 6
+    SECRET_SUBKEY = 7
+    TRUST = 12
+    USER_ID = 13
+    PUBLIC_SUBKEY = 14
+    USER_ATTRIBUTE = 17
+
+    # the keybox blobs holding OpenPGP keys
+    KEYBOX_OPENPGP = 2
+
+    # key flags subpacket bits => RecordDecoder capabilities
+    key_flags = ((0x01, RecordDecoder.CERTIFY),
+                 (0x02, RecordDecoder.SIGN),
+                 (0x0c, RecordDecoder.ENCRYPT),
+                 (0x20, RecordDecoder.AUTHENTICATE))
+
+    # what keys can do when their self-signature does not say, by
+    # algorithm, like gpg does
+    usage = { 1: RecordDecoder.CERTIFY | RecordDecoder.SIGN | RecordDecoder.ENCRYPT | RecordDecoder.AUTHENTICATE,
+              2: RecordDecoder.ENCRYPT,
+              3: RecordDecoder.CERTIFY | RecordDecoder.SIGN,
+              16: RecordDecoder.ENCRYPT,
+              17: RecordDecoder.CERTIFY | RecordDecoder.SIGN | RecordDecoder.AUTHENTICATE,
+              18: RecordDecoder.ENCRYPT,
+              19: RecordDecoder.CERTIFY | RecordDecoder.SIGN | RecordDecoder.AUTHENTICATE,
+              20: RecordDecoder.ENCRYPT,
+              22: RecordDecoder.CERTIFY | RecordDecoder.SIGN | RecordDecoder.AUTHENTICATE,
+              }
+
+    # the length gpg lists for elliptic curve keys, by curve OID
+    curves = { '2b06010401da470f01': 255, # ed25519
+               '2b060104019755010501': 255, # cv25519
+               '2b6571': 448, # ed448
+               '2b656f': 448, # x448
+               '2a8648ce3d030107': 256, # nistp256
+               '2b81040022': 384, # nistp384
+               '2b81040023': 521, # nistp521
+               '2b2403030208010107': 256, # brainpoolP256r1
+               '2b240303020801010b': 384, # brainpoolP384r1
+               '2b240303020801010d': 512, # brainpoolP512r1
+               '2b8104000a': 256, # secp256k1
+               }
+
+    def __init__(self, data):
+        # a string, or anything with the buffer interface, like mmap
+        self.data = data
+
+    @classmethod
+    def open(cls, path):
+        """a reader for the file at that path, mapped in memory"""
+        with open(path, 'rb') as fd:
+            if not os.fstat(fd.fileno()).st_size:
+                return cls('')
+            return cls(mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ))
+
+    def keybox(self):
+        """if the file is a keybox, instead of a plain keyring"""
+        return len(self.data) >= 16 and self.data[8:12] == 'KBXf'
+
+    def blocks(self):
+        """the (start, end) offsets of the OpenPGP data in the file
+
+        a keybox has one key per blob, with a header we skip, a
+        keyring is a single block of packets."""
+        if not self.keybox():
+            yield (0, len(self.data))
+            return
+        offset = 0
+        while offset + 16 <= len(self.data):
+            (length, blobtype, version, flags, start, size) = struct.unpack_from('>IBBHII', self.data, offset)
+            if length < 16 or offset + length > len(self.data):
+                raise ValueError(_('invalid keybox blob at offset %d') % offset)
+            # flag 2 marks ephemeral keys, which gpg does not list
+            if blobtype == self.KEYBOX_OPENPGP and not flags & 2:
+                if start + size > length:
+                    raise ValueError(_('invalid keybox blob at offset %d') % offset)
+                yield (offset + start, offset + start + size)
+            offset += length
+
+    def packets(self, start, end):
+        """the (tag, header, start, end) of the packets in that part
+        of the file
+
+        header is where the packet starts, start and end are the
+        offsets of its body."""
+        data = self.data
+        offset = start
+        while offset < end:
+            position = offset
+            header = ord(data[offset])
+            if not header & 0x80:
+                raise ValueError(_('invalid OpenPGP packet at offset %d') % offset)
+            if header & 0x40:
+                # new format
+                tag = header & 0x3f
+                first = ord(data[offset + 1])
+                if first < 192:
+                    (length, offset) = (first, offset + 2)
+                elif first < 224:
+                    (length, offset) = (((first - 192) << 8) + ord(data[offset + 2]) + 192, offset + 3)
+                elif first == 255:
+                    (length,) = struct.unpack_from('>I', data, offset + 2)
+                    offset += 6
+                else:
+                    # partial lengths are only used for data packets
+                    raise ValueError(_('invalid OpenPGP packet at offset %d') % offset)
+            else:
+                # old format
+                tag = (header >> 2) & 0xf
+                kind = header & 3
+                if kind == 0:
+                    (length, offset) = (ord(data[offset + 1]), offset + 2)
+                elif kind == 1:
+                    (length,) = struct.unpack_from('>H', data, offset + 1)
+                    offset += 3
+                elif kind == 2:
+                    (length,) = struct.unpack_from('>I', data, offset + 1)
+                    offset += 5
+                else:
+                    (length, offset) = (end - offset - 1, offset + 1)
+            if offset + length > end:
+                raise ValueError(_('truncated OpenPGP packet at offset %d') % offset)
+            yield (tag, position, offset, offset + length)
+            offset += length
+
+    def keep_uid(self, uid):
+        """the packets of the keys in the file, with only that uid
+
+        this returns the binary data of the keys with the given user
+        id, as gpg would export them after deleting all the others.
+        other user ids and user attributes are dropped along with
+        their signatures, the primary keys, subkeys and the rest of
+        their signatures are kept. keys without that user id are
+        left out, and so are trust packets.
+
+        the user id is expected as gpg lists it, with colons and
+        other special characters escaped, see unescape_colons()."""
+        uid = unescape_colons(uid)
+        keys = []
+        for (start, end) in self.blocks():
+            (chunks, found, keep) = ([], False, True)
+            for (tag, header, first, last) in self.packets(start, end):
+                if tag in (self.PUBLIC_KEY, self.SECRET_KEY):
+                    if found:
+                        keys += chunks
+                    (chunks, found, keep) = ([], False, True)
+                elif tag in (self.PUBLIC_SUBKEY, self.SECRET_SUBKEY):
+                    keep = True
+                elif tag == self.USER_ID:
+                    keep = self.data[first:last] == uid
+                    found = found or keep
+                elif tag == self.USER_ATTRIBUTE:
+                    keep = False
+                elif tag == self.TRUST:
+                    continue
+                if keep:
+                    chunks.append(self.data[header:last])
+            if found:
+                keys += chunks
+        return ''.join(keys)
+
+    def signatures(self):
+        """the set of the signature packets in the file, as strings
+
+        this is what delta() compares keys with."""
+        signatures = set()
+        for (start, end) in self.blocks():
+            for (tag, header, first, last) in self.packets(start, end):
+                if tag == self.SIGNATURE:
+                    signatures.add(self.data[header:last])
+        return signatures
+
+    def delta(self, known):
+        """the packets of the keys in the file, with only the
+        certifications that are not known
+
+        known is a set of signature packets, from the signatures() of
+        the same keys at some earlier point. this returns the binary
+        data of the primary keys and of the user ids that got new
+        signatures, with those signatures and the self-signatures gpg
+        needs to import the user ids. everything else, subkeys, user
+        attributes and the signatures that were already there, is
+        left out, and so are keys without new certifications."""
+        keys = []
+        for (start, end) in self.blocks():
+            # the packets of the key, of the uid being looked at, and
+            # whether it has a new signature
+            (chunks, uid, new, keyid) = ([], [], False, None)
+            for (tag, header, first, last) in self.packets(start, end):
+                packet = self.data[header:last]
+                if tag == self.SIGNATURE:
+                    if not uid:
+                        continue
+                    if packet not in known:
+                        uid.append(packet)
+                        new = True
+                    else:
+                        signature = self.parse_signature(first, last)
+                        if signature is not None and signature[1] == keyid:
+                            uid.append(packet)
+                    continue
+                elif tag == self.TRUST:
+                    continue
+                if new:
+                    chunks += uid
+                (uid, new) = ([], False)
+                if tag in (self.PUBLIC_KEY, self.SECRET_KEY):
+                    if len(chunks) > 1:
+                        keys += chunks
+                    key = self.parse_key(tag, first, last)
+                    (chunks, keyid) = ([packet], key and key._keyid)
+                elif tag == self.USER_ID:
+                    uid = [packet]
+                # subkeys and user attributes are skipped, with their
+                # signatures
+            if new:
+                chunks += uid
+            if len(chunks) > 1:
+                keys += chunks
+        return ''.join(keys)
+
+    def keys(self):
+        """iterate over the keys in the file, as OpenPGPkeys"""
+        try:
+            for key in self._keys():
+                yield key
+        except (IndexError, struct.error):
+            # something points past the end of the file
+            raise ValueError(_('truncated OpenPGP data'))
+
+    def _keys(self):
+        primary = (self.PUBLIC_KEY, self.SECRET_KEY)
+        for (start, end) in self.blocks():
+            packets = []
+            for packet in self.packets(start, end):
+                if packet[0] in primary and packets:
+                    key = self.build(packets)
+                    if key is not None:
+                        yield key
+                    packets = []
+                packets.append(packet)
+            if packets:
+                key = self.build(packets)
+                if key is not None:
+                    yield key
+
+    def build(self, packets):
+        """the OpenPGPkey made of those packets, or None
+
+        the packets start with the primary key and end before the
+        next one. keys with a version we do not know are skipped."""
+        (tag, header, start, end) = packets[0]
+        key = self.parse_key(tag, start, end)
+        if key is None:
+            return None
+        # what the next signatures are about
+        current = key
+        # key, uid or subkey => its latest self-signature
+        selfsigs = {}
+        for (tag, header, start, end) in packets[1:]:
+            if tag == self.USER_ID:
+                uid = str(self.data[start:end])
+                # escaped like gpg lists it
+                current = OpenPGPuid(escape_colons(uid), '-', 0, 0, ripemd160(uid).upper())
+                key.add_uid(current)
+            elif tag in (self.PUBLIC_SUBKEY, self.SECRET_SUBKEY):
+                current = self.parse_key(tag, start, end)
+                if current is not None:
+                    key.add_subkey(current)
+            elif tag == self.SIGNATURE:
+                signature = self.parse_signature(start, end)
+                if current is None or signature is None or signature[1] != key._keyid:
+                    # not a self-signature
+                    continue
+                sigclass = signature[0]
+                if sigclass == 0x20:
+                    key.revoked = True
+                elif sigclass == 0x28 and current is not key and isinstance(current, OpenPGPkey):
+                    current.revoked = True
+                elif sigclass == 0x30 and isinstance(current, OpenPGPuid):
+                    current.trust = 'r'
+                elif 0x10 <= sigclass <= 0x13 and isinstance(current, OpenPGPuid) \
+                        or sigclass == 0x18 and current is not key and isinstance(current, OpenPGPkey) \
+                        or sigclass == 0x1f and current is key:
+                    if current not in selfsigs or selfsigs[current][2] <= signature[2]:
+                        selfsigs[current] = signature
+            elif tag != self.TRUST:
+                # signatures on user attributes, like photos, or
+                # anything else, are not used. gpg keeps trust
+                # packets after keys, uids and signatures, skip those
+                current = None
+        # gpg lists the primary uid first, the one flagged as such by
+        # its latest self-signature, or else the one signed last, and
+        # describes the key with that self-signature
+        primary = None
+        for uid in key.uidslist:
+            if uid in selfsigs:
+                uid.creation = selfsigs[uid][2]
+                if uid.trust != 'r' and (primary is None or (selfsigs[uid][5], uid.creation) > (selfsigs[primary][5], primary.creation)):
+                    primary = uid
+        if primary is not None:
+            key.uidslist.remove(primary)
+            key.uidslist.insert(0, primary)
+            if key not in selfsigs or selfsigs[key][2] <= primary.creation:
+                selfsigs[key] = selfsigs[primary]
+        now = time.time()
+        capabilities = 0
+        for subkey in [key] + key.subkeys.values():
+            self.self_signed(subkey, selfsigs.get(subkey), now)
+            if subkey is not key and not subkey.revoked and not subkey.expired:
+                capabilities |= subkey.capabilities
+        # like the uppercase capabilities gpg lists on primary keys,
+        # what the usable parts of a usable key can do
+        if not key.revoked and not key.expired:
+            key.capabilities |= capabilities
+        else:
+            for subkey in key.subkeys.values():
+                if subkey.trust == '-':
+                    subkey.trust = key.trust
+        return key
+
+    def self_signed(self, key, signature, now):
+        """set what the self-signature says about the key"""
+        flags = None
+        if signature is not None:
+            (sigclass, issuer, creation, expires, flags, primary) = signature
+            if expires:
+                key.expiry = key.creation + expires
+        if flags is None:
+            key.capabilities = self.usage.get(key.algo, 0)
+        else:
+            key.capabilities = 0
+            for bit, capability in self.key_flags:
+                if flags & bit:
+                    key.capabilities |= capability
+        if key.expiry and key.expiry < now:
+            key.expired = True
+        if key.revoked:
+            key.trust = 'r'
+        elif key.expired:
+            key.trust = 'e'
+
+    def parse_key(self, tag, start, end):
+        """the OpenPGPkey of a key packet, or None if we do not know
+        its version or algorithm"""
+        data = self.data
+        version = ord(data[start])
+        key = OpenPGPkey()
+        key.trust = '-'
+        key.token = ''
+        if tag in (self.SECRET_KEY, self.SECRET_SUBKEY):
+            key.secret = True
+        if version in (2, 3):
+            (key.creation, days, key.algo) = struct.unpack_from('>IHB', data, start + 1)
+            if days:
+                key.expiry = key.creation + days * 86400
+            # the fingerprint is the md5 of the RSA modulus and exponent
+            (n, offset) = self.mpi(start + 8)
+            (e, offset) = self.mpi(offset)
+            key.fpr = hashlib.md5(n + e).hexdigest().upper()
+            key._keyid = n[-8:].encode('hex').upper()
+            (key.length,) = struct.unpack_from('>H', data, start + 8)
+            return key
+        elif version not in (4, 5):
+            return None
+        (key.creation, key.algo) = struct.unpack_from('>IB', data, start + 1)
+        offset = start + 6
+        if version == 5:
+            # the size of the public key material follows
+            (size,) = struct.unpack_from('>I', data, offset)
+            offset += 4
+            public = offset + size
+        else:
+            public = self.public_end(key.algo, offset)
+            if public is None:
+                return None
+        # the fingerprint covers the public part of the packet only
+        if version == 5:
+            digest = hashlib.sha256('\x9a' + struct.pack('>I', public - start))
+        else:
+            digest = hashlib.sha1('\x99' + struct.pack('>H', public - start))
+        digest.update(buffer(data, start, public - start))
+        key.fpr = digest.hexdigest().upper()
+        if version == 5:
+            key._keyid = key.fpr[:16]
+        else:
+            key._keyid = key.fpr[-16:]
+        if key.algo in (18, 19, 22):
+            oid = data[offset + 1:offset + 1 + ord(data[offset])]
+            key.length = self.curves.get(oid.encode('hex'), 0)
+        else:
+            (key.length,) = struct.unpack_from('>H', data, offset)
+        return key
+
+    def mpi(self, offset):
+        """the multiprecision integer at that offset, and the offset
+        following it"""
+        (bits,) = struct.unpack_from('>H', self.data, offset)
+        end = offset + 2 + (bits + 7) / 8
+        return (self.data[offset + 2:end], end)
+
+    # how many integers make the public part of keys, by algorithm
+    integers = { 1: 2, 2: 2, 3: 2, 16: 3, 17: 4, 18: 1, 19: 1, 20: 3, 22: 1 }
+
+    def public_end(self, algo, offset):
+        """where the public part of a version 4 key ends, the key
+        material starting at offset, or None for unknown algorithms"""
+        if algo not in self.integers:
+            return None
+        if algo in (18, 19, 22):
+            # the curve comes first
+            offset += 1 + ord(self.data[offset])
+        for i in range(self.integers[algo]):
+            (bits,) = struct.unpack_from('>H', self.data, offset)
+            offset += 2 + (bits + 7) / 8
+        if algo == 18:
+            # and the key derivation parameters last
+            offset += 1 + ord(self.data[offset])
+        return offset
+
+    def parse_signature(self, start, end):
+        """the (sigclass, issuer, creation, expires, flags, primary)
+        of a signature packet, or None if we do not know its version
+
+        issuer is the long keyid of the signing key, expires the
+        lifetime of the signed key, in seconds, 0 if it does not
+        expire, flags the key flags, None if not given, and primary
+        if the signed uid is the primary one. those last three are
+        only taken from the signed part of signature."""
+        data = self.data
+        version = ord(data[start])
+        if version in (2, 3):
+            (sigclass, creation) = struct.unpack_from('>BI', data, start + 2)
+            issuer = data[start + 7:start + 15].encode('hex').upper()
+            return (sigclass, issuer, creation, 0, None, False)
+        elif version not in (4, 5):
+            return None
+        sigclass = ord(data[start + 1])
+        (issuer, creation, expires, flags, primary) = (None, 0, 0, None, False)
+        offset = start + 4
+        for hashed in (True, False):
+            if version == 5:
+                (size,) = struct.unpack_from('>I', data, offset)
+                offset += 4
+            else:
+                (size,) = struct.unpack_from('>H', data, offset)
+                offset += 2
+            for (subtype, first, last) in self.subpackets(offset, offset + size):
+                if subtype == 16:
+                    issuer = data[first:last].encode('hex').upper()
+                elif subtype == 33 and issuer is None:
+                    # the version of the key, then its fingerprint
+                    fpr = data[first + 1:last].encode('hex').upper()
+                    if ord(data[first]) == 5:
+                        issuer = fpr[:16]
+                    else:
+                        issuer = fpr[-16:]
+                elif not hashed:
+                    continue
+                elif subtype == 2:
+                    (creation,) = struct.unpack_from('>I', data, first)
+                elif subtype == 9:
+                    (expires,) = struct.unpack_from('>I', data, first)
+                elif subtype == 27 and last > first:
+                    flags = ord(data[first])
+                elif subtype == 25 and last > first:
+                    primary = bool(ord(data[first]))
+            offset += size
+        return (sigclass, issuer, creation, expires, flags, primary)
+
+    def subpackets(self, start, end):
+        """the (type, start, end) of the signature subpackets in that
+        part of the file
+
+        the offsets are those of the subpacket data, the critical bit
+        is stripped from the type."""
+        data = self.data
+        offset = start
+        while offset < end:
+            first = ord(data[offset])
+            if first < 192:
+                (length, offset) = (first, offset + 1)
+            elif first < 255:
+                (length, offset) = (((first - 192) << 8) + ord(data[offset + 1]) + 192, offset + 2)
+            else:
+                (length,) = struct.unpack_from('>I', data, offset + 1)
+                offset += 5
+            if not length or offset + length > end:
+                raise ValueError(_('invalid signature subpacket at offset %d') % offset)
+            yield (ord(data[offset]) & 0x7f, offset + 1, offset + length)
+            offset += length
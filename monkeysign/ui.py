@@ -17,7 +17,8 @@
 
 from monkeysign import __version__
 # gpg interface
-from monkeysign.gpg import Keyring, TempKeyring, GpgRuntimeError
+from monkeysign.gpg import Keyring, TempKeyring, TempKeyringPool, GpgRuntimeError, Context, MetricsCounter, KeyIndex
+from monkeysign.packets import PacketReader, armor, dearmor
 import monkeysign.translation
 
 # mail functions
@@ -75,6 +76,10 @@ class MonkeysignUi(object):
                           help=_('request debugging information from GPG engine (lots of garbage)'))
         parser.add_option('-v', '--verbose', dest='verbose', default=False, action='store_true',
                           help=_('explain what we do along the way'))
+        parser.add_option('--stats', dest='stats', default=False, action='store_true',
+                          help=_('show how much time was spent in GPG at each stage when done'))
+        parser.add_option('--index', dest='index', default=False, action='store_true',
+                          help=_('keep an index of your keyring on disk, to find your keys faster'))
         parser.add_option('-n', '--dry-run', dest='dryrun', default=False, action='store_true',
                           help=_('do not actually do anything'))
         parser.add_option('-u', '--user', dest='user', help=_('user id to sign the key with'))
@@ -88,6 +93,8 @@ class MonkeysignUi(object):
         parser.add_option('--smtppass', dest='smtppass', help=_('password for the SMTP server (default: prompted, if --smtpuser is specified)'))
         parser.add_option('--no-mail', dest='nomail', default=False, action='store_true',
                           help=_('Do not send email at all. (Default is to use sendmail.)'))
+        parser.add_option('--delta', dest='delta', default=False, action='store_true',
+                          help=_('only send the new signatures, not the whole signed key'))
         parser.add_option('-t', '--to', dest='to', 
                           help=_('Override destination email for testing (default is to use the first uid on the key or send email to each uid chosen)'))
         return parser
@@ -122,12 +129,21 @@ class MonkeysignUi(object):
         # data structures and not write any data
         self.tmpkeyring = None
 
+        # where the temporary keyrings come from, also made in prepare()
+        self.pool = None
+
         # the fingerprints that we actually signed
         self.signed_keys = {}
 
+        # the signatures on those keys before we signed them, for --delta
+        self.known_signatures = {}
+
         # temporary, to keep track of the OpenPGPkey we are signing
         self.signing_key = None
 
+        # the metrics of the GPG commands we run, if requested, see stage()
+        self.stats = None
+
         self.parse_args(args)
 
         # set a default logging mechanism
@@ -145,15 +161,35 @@ class MonkeysignUi(object):
         # this is implicit in the garbage collection, but tell the user anyways
         self.log(_('deleting the temporary keyring %s') % self.tmpkeyring.homedir)
 
+        if self.stats is not None:
+            Context.sinks.remove(self.stats)
+            print >>self.logfile, self.stats.summary()
+
+        if self.pool is not None:
+            self.pool.close()
+
         if exc_type is NotImplementedError:
             self.abort(str(exc_value))
 
     def prepare(self):
+        # temporary keyrings are made ahead and removed in the
+        # background, until we exit
+        if self.pool is None:
+            self.pool = TempKeyringPool()
         # initialize the temporary keyring directory
-        self.tmpkeyring = TempKeyring()
+        self.tmpkeyring = TempKeyring(self.pool)
+        # we export and list the same keys many times during a run
+        self.tmpkeyring.cache = {}
+        if self.keyring.cache is None:
+            self.keyring.cache = {}
 
         if self.options.version:
             self.abort(monkeysign.__version__)
+        if self.options.stats and self.stats is None:
+            self.stats = MetricsCounter()
+            Context.sinks.append(self.stats)
+        if self.options.index and self.keyring.index is None:
+            self.keyring.index = KeyIndex(self.keyring)
         if self.options.debug:
             self.tmpkeyring.context.debug = self.logfile
             self.keyring.context.debug = self.logfile
@@ -222,11 +258,23 @@ this should not interrupt the flow of the program, but must be visible to the us
     def prompt_pass(self, prompt):
         raise NotImplementedError('prompting for a password not implemented in base class')
 
+    def stage(self, name):
+        """tell the metrics a new step of the process is starting"""
+        if self.stats is not None:
+            self.stats.enter(name)
+
     def find_key(self):
         """find the key to be signed somewhere"""
+        self.stage('find_key')
         # 1.b) from the local keyring
         self.log(_('looking for key %s in your keyring') % self.pattern)
-        if not self.tmpkeyring.import_data(self.keyring.export_data(self.pattern)):
+        # the index tells if the key is missing without running gpg,
+        # listing the whole keyring for that costs more than the
+        # export. let gpg look for the patterns the index does not
+        # understand
+        index = self.keyring.index
+        if index is not None and index.handles(self.pattern) and index.find(self.pattern) == [] \
+                or not self.keyring.transfer_to(self.tmpkeyring, self.pattern):
             self.log(_('key not in local keyring'))
 
             # 1.a) if allowed, from the keyservers
@@ -246,12 +294,14 @@ we use --secret-keyring instead of copying the secret key material,
 but we still need the public part in the temporary keyring for this to
 work.
 """
+        self.stage('copy_secrets')
         self.log(_('copying your private key to temporary keyring in %s') % self.tmpkeyring.homedir)
-        # detect the proper uid
-        if self.options.user is None:
-            keys = self.keyring.get_keys(None, True, False)
-        else:
-            keys = self.keyring.get_keys(self.options.user, True, False)
+        # detect the proper uid, from the index if there is one
+        keys = None
+        if self.keyring.index is not None and self.keyring.index.handles(self.options.user):
+            keys = self.keyring.index.get_keys(self.options.user, True, False)
+        if not keys:
+            keys = self.keyring.get_keys(self.options.user, True, False) or {}
 
         for fpr, key in keys.iteritems():
             self.log(_('found secret key: %s') % key)
@@ -264,11 +314,12 @@ work.
         self.log(_('signing key chosen: %s') % self.signing_key.fpr)
 
         # export public key material associated with detected private
-        if not self.tmpkeyring.import_data(self.keyring.export_data(self.signing_key.fpr)):
+        if not self.keyring.transfer_to(self.tmpkeyring, self.signing_key.fpr):
             self.abort(_('could not find public key material, do you have a GPG key?'))
 
     def sign_key(self):
         """sign the key uids, as specified"""
+        self.stage('sign_key')
 
         keys = self.tmpkeyring.get_keys(self.pattern)
 
@@ -298,6 +349,8 @@ Sign all identities? [y/N] \
             if not self.options.dryrun:
                 if not self.yes_no(_('Really sign key? [y/N] '), False):
                     continue
+                if self.options.delta:
+                    self.known_signatures[key] = self.tmpkeyring.signatures(key)
                 if not self.tmpkeyring.sign_key(pattern, alluids):
                     self.warn(_('key signing failed'))
                 else:
@@ -306,13 +359,13 @@ Sign all identities? [y/N] \
                     self.log(_('making a non-exportable signature'))
                     self.tmpkeyring.context.set_option('export-options', 'export-minimal')
 
-                    # this is inefficient - we could save a copy if we would fetch the key directly
-                    if not self.keyring.import_data(self.tmpkeyring.export_data(self.pattern)):
+                    if not self.tmpkeyring.transfer_to(self.keyring, self.pattern):
                         self.abort(_('could not import public key back into public keyring, something is wrong'))
                     if not self.keyring.sign_key(pattern, alluids, True):
                         self.warn(_('local key signing failed'))
 
     def export_key(self):
+        self.stage('export_key')
         if self.options.user is not None and '@' in self.options.user:
             from_user = self.options.user
         else:
@@ -321,17 +374,25 @@ Sign all identities? [y/N] \
         if len(self.signed_keys) < 1: self.warn(_('no key signed, nothing to export'))
         
         for fpr, key in self.signed_keys.items():
+            # exported once, and split by uid in memory
+            if self.options.delta:
+                keydata = self.tmpkeyring.export_delta(fpr, self.known_signatures.get(fpr))
+                # only the uids we signed are left
+                uids = [ uid for k in PacketReader(keydata).keys() for uid in k.uidslist ]
+            else:
+                keydata = self.tmpkeyring.export_data(fpr)
+                uids = key.uids.values()
             if self.chosen_uid is None:
-                for uid in key.uids.values():
+                for uid in uids:
                     try:
-                        msg = EmailFactory(self.tmpkeyring.export_data(fpr), fpr, uid.uid, from_user, self.options.to)
+                        msg = EmailFactory(keydata, fpr, uid.uid, from_user, self.options.to, self.tmpkeyring)
                     except GpgRuntimeError as e:
                         self.warn(_('failed to create email: %s') % e)
                         break
                     self.sendmail(msg)
             else:
                 try:
-                    msg = EmailFactory(self.tmpkeyring.export_data(fpr), fpr, self.chosen_uid, from_user, self.options.to)
+                    msg = EmailFactory(keydata, fpr, self.chosen_uid, from_user, self.options.to, self.tmpkeyring)
                 except GpgRuntimeError as e:
                     self.warn(_('failed to create email: %s') % e)
                     break
@@ -368,7 +429,7 @@ expects an EmailFactory email, but will not mail if nomail is set"""
                 self.warn(_("""\
 not sending email to %s, as requested, here's the email message:
 
-%s""") % (msg.mailto, msg.create_mail_from_block(msg.tmpkeyring.export_data(msg.keyfpr))))
+%s""") % (msg.mailto, msg.create_mail_from_block(msg.keydata)))
 
 
 class EmailFactory:
@@ -399,28 +460,24 @@ yourself.  With GnuPG this can be done using:
 Regards,
 """)
 
-    def __init__(self, keydata, keyfpr, recipient, mailfrom, mailto):
+    def __init__(self, keydata, keyfpr, recipient, mailfrom, mailto, keyring = None):
         """email constructor
 
 we expect to find the following arguments:
 
-keydata: the signed public key material
+keydata: the signed public key material, armored or not
 keyfpr: the fingerprint of that public key
 recipient: the recipient to encrypt the mail to
 mailfrom: who the mail originates from
-mailto: who to send the mail to (usually similar to recipient, but can be used to specify specific keyids"""
+mailto: who to send the mail to (usually similar to recipient, but can be used to specify specific keyids
+keyring: a keyring holding the key, to encrypt the mail, a temporary one is created if missing"""
         (self.keyfpr, self.recipient, self.mailfrom, self.mailto) = (keyfpr, recipient, mailfrom.decode('utf-8'), mailto or recipient)
         self.mailto = self.mailto.decode('utf-8')
-        # operate over our own keyring, this allows us to remove UIDs freely
-        self.tmpkeyring = TempKeyring()
-        # copy data over from the UI keyring
-        self.tmpkeyring.import_data(keydata)
-        # prepare for email transport
-        self.tmpkeyring.context.set_option('armor')
-        # XXX: why is this necessary?
-        self.tmpkeyring.context.set_option('always-trust')
+        self.keyring = keyring
+        # the armored key material sent, with only the recipient uid
+        self.keydata = None
         # remove UIDs we don't want to send
-        self.cleanup_uids()
+        self.cleanup_uids(keydata)
         # cleanup email addresses
         self.cleanup_emails()
 
@@ -435,22 +492,35 @@ mailto: who to send the mail to (usually similar to recipient, but can be used t
                              re.sub(r' \([^)]*\)', r'',
                                     self.mailto))
 
-    def cleanup_uids(self):
-        """this will remove any UID not matching the 'recipient' set in the class"""
-        for fpr, key in self.tmpkeyring.get_keys().iteritems():
-            todelete = []
-            for uid in key.uids.values():
-                if self.recipient != uid.uid:
-                    todelete.append(uid.uid)
-            for uid in todelete:
-                self.tmpkeyring.del_uid(fpr, uid)
+    def cleanup_uids(self, keydata):
+        """this will remove any UID not matching the 'recipient' set in the class
+
+the packets of the other uids are filtered out of the key material,
+without going through gpg"""
+        try:
+            if keydata.startswith('-----BEGIN'):
+                keydata = dearmor(keydata)
+            keydata = PacketReader(keydata).keep_uid(self.recipient)
+        except ValueError as e:
+            raise GpgRuntimeError(None, _('invalid key material: %s') % e)
+        if not keydata:
+            raise GpgRuntimeError(None, _('user id not found on key: %s') % self.recipient)
+        self.keydata = armor(keydata)
 
     def get_message(self):
         # first layer, seen from within:
         # an encrypted MIME message, made of two parts: the
         # introduction and the signed key material
-        message = self.create_mail_from_block(self.tmpkeyring.export_data(self.keyfpr))
-        encrypted = self.tmpkeyring.encrypt_data(message.as_string(), self.keyfpr)
+        message = self.create_mail_from_block(self.keydata)
+        if self.keyring is None:
+            # we need the key in a keyring to encrypt to it
+            self.keyring = TempKeyring()
+            self.keyring.import_data(self.keydata)
+        # the key was just signed, it may not be valid yet
+        encrypted = self.keyring.encrypt_data(message.as_string(), self.keyfpr, True)
+        # prepare for email transport, unless gpg.conf asks for armor
+        if not encrypted.startswith('-----BEGIN PGP '):
+            encrypted = armor(encrypted, 'MESSAGE')
 
         # the second layer up, made of two parts: a version number
         # and the first layer, encrypted
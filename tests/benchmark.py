@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2012-2013 Antoine Beaupré <anarcat@orangeseeds.org>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Microbenchmarks for the GPG API.
+
+Those are not part of the test suite, run this file directly to see
+how the parsers behave on large, synthetic, gpg outputs.
+"""
+
+import sys, os, re, time
+from StringIO import StringIO
+
+sys.path.append(os.path.dirname(__file__) + '/..')
+
+from monkeysign.gpg import StatusParser, KeyListParser, OpenPGPkey, OpenPGPuid
+from monkeysign.packets import ArmorEncoder, ArmorDecoder, armor, dearmor
+
+def status_transcript(keys):
+    """what gpg says on the status-fd when importing that many keys"""
+    lines = []
+    for i in range(keys):
+        fpr = '%040X' % (i * 7919)
+        lines.append('[GNUPG:] KEY_CONSIDERED %s 0' % fpr)
+        lines.append('gpg: key %s: public key "Test Key %d <test%d@example.com>" imported' % (fpr[-8:], i, i))
+        lines.append('[GNUPG:] IMPORTED %s Test Key %d <test%d@example.com>' % (fpr[-16:], i, i))
+        lines.append('[GNUPG:] IMPORT_OK 1 %s' % fpr)
+    lines.append('[GNUPG:] IMPORT_RES %d 0 %d 0 0 0 0 0 0 0 0 0 0 0' % (keys, keys))
+    return "\n".join(lines) + "\n"
+
+def regex_scan(text):
+    """count IMPORT_OK lines the way Context.seek() used to look for them"""
+    count = 0
+    fd = StringIO(text)
+    line = fd.readline()
+    while line:
+        if re.search('^\[GNUPG:\] ' + 'IMPORT_OK', line):
+            count += 1
+        line = fd.readline()
+    return count
+
+def parser_scan(text):
+    """count IMPORT_OK lines with the StatusParser"""
+    count = 0
+    for event in StatusParser().parse(text):
+        if event.keyword == 'IMPORT_OK':
+            count += 1
+    return count
+
+def parser_filtered(text):
+    """count IMPORT_OK lines with the StatusParser, ignoring other keywords"""
+    count = 0
+    for event in StatusParser().parse(text, ['IMPORT_OK']):
+        count += 1
+    return count
+
+def parser_feed(text, chunk = 4096):
+    """count IMPORT_OK lines with the StatusParser, reading from a pipe"""
+    counts = {'IMPORT_OK': 0}
+    def handler(event):
+        counts[event.keyword] += 1
+    parser = StatusParser({'IMPORT_OK': handler})
+    for i in range(0, len(text), chunk):
+        parser.feed(text[i:i+chunk])
+    parser.close()
+    return counts['IMPORT_OK']
+
+def key_listing(keys, uids = 3):
+    """what gpg 1.4 says when listing that many keys with colons
+
+    the old parser does not understand the longer records of newer gpg
+    versions, so stick to the old format to compare them."""
+    lines = ['tru::1:1343350431:0:3:1:5']
+    for i in range(keys):
+        fpr = '%040X' % (i * 7919)
+        lines.append('pub:-:2048:1:%s:1342795252:::-:::scESC:' % fpr[-16:])
+        lines.append('fpr:::::::::%s:' % fpr)
+        for j in range(uids):
+            lines.append('uid:-::::1342795252::%040X::Test Key %d.%d <test%d@example.com>:' % (i * 31 + j, i, j, i))
+        lines.append('sub:-:2048:1:%016X:1342795252::::::e:' % (i * 104729))
+    return "\n".join(lines) + "\n"
+
+def legacy_parse(text):
+    """parse a listing the way get_keys() and parse_gpg_list() used to"""
+    keys = {}
+    text = "\n".join(text.split("\n")[1:])
+    for keydata in text.split("pub:"):
+        if not keydata: continue
+        key = OpenPGPkey()
+        for block in ("pub:" + keydata).split("\n"):
+            record = block.split(":")
+            rectype = record[0]
+            if rectype == 'fpr':
+                key.fpr = record[9]
+            elif rectype == 'pub':
+                (null, key.trust, key.length, key.algo, keyid, key.creation, key.expiry, serial, trust, uid, sigclass, purpose, smime) = record
+                purposes = {}
+                for p in ('encrypt', 'sign', 'certify', 'authenticate'):
+                    purposes[p] = p[0].lower() in purpose.lower()
+            elif rectype == 'uid':
+                (rectype, trust, null, null, null, creation, expiry, uidhash, null, uid, null) = record
+                key.add_uid(OpenPGPuid(uid, trust, creation, expiry, uidhash))
+            elif rectype == 'sub':
+                subkey = OpenPGPkey()
+                (rectype, trust, subkey.length, subkey.algo, subkey._keyid, subkey.creation, subkey.expiry, serial, trust, uid, sigclass, purpose, smime) = record
+                purposes = {}
+                for p in ('encrypt', 'sign', 'certify', 'authenticate'):
+                    purposes[p] = p[0].lower() in purpose.lower()
+                key.add_subkey(subkey)
+        keys[key.fpr] = key
+    return len(keys)
+
+def parser_parse(text):
+    """parse a complete listing with the KeyListParser"""
+    keys = {}
+    KeyListParser(keys).parse(text)
+    return len(keys)
+
+def parser_uids(text):
+    """parse a complete listing and look at the uids of every key"""
+    keys = {}
+    KeyListParser(keys).parse(text)
+    count = 0
+    for key in keys.itervalues():
+        count += len(key.uidslist)
+    return count
+
+def parser_stream(text, chunk = 4096):
+    """parse a listing with the KeyListParser, reading from a pipe"""
+    parser = KeyListParser()
+    count = 0
+    for i in range(0, len(text), chunk):
+        count += len(parser.feed(text[i:i+chunk]))
+    return count + len(parser.close())
+
+def armor_stream(data, chunk = 4096):
+    """armor data with the ArmorEncoder, reading from a pipe"""
+    encoder = ArmorEncoder()
+    text = [ encoder.feed(data[i:i+chunk]) for i in range(0, len(data), chunk) ]
+    return len(''.join(text) + encoder.close())
+
+def dearmor_stream(text, chunk = 4096):
+    """dearmor text with the ArmorDecoder, reading from a pipe"""
+    decoder = ArmorDecoder()
+    data = [ decoder.feed(text[i:i+chunk]) for i in range(0, len(text), chunk) ]
+    return len(''.join(data) + decoder.close())
+
+def bench(name, function, data, size, repeat = 3):
+    """run the function on the data a few times and report the best time"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(data)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-30s %8.3fs %8.1f MB/s (result: %s)" % (name, best, size / best / 1024 / 1024, result)
+    return best
+
+def bench_status(keys = 50000):
+    text = status_transcript(keys)
+    size = len(text)
+    print "status transcript: %d keys, %.1f MB" % (keys, size / 1024.0 / 1024)
+    bench('regex (old seek)', regex_scan, text, size)
+    bench('StatusParser.parse()', parser_scan, text, size)
+    bench('StatusParser.parse(keywords)', parser_filtered, text, size)
+    bench('StatusParser.feed()', parser_feed, text, size)
+
+def bench_listing(keys = 20000):
+    text = key_listing(keys)
+    size = len(text)
+    print "key listing: %d keys, %.1f MB" % (keys, size / 1024.0 / 1024)
+    bench('split and unpack (old)', legacy_parse, text, size)
+    bench('KeyListParser.parse()', parser_parse, text, size)
+    bench('KeyListParser.parse() + uids', parser_uids, text, size)
+    bench('KeyListParser.feed()', parser_stream, text, size)
+
+def bench_armor(size = 4 * 1024 * 1024):
+    data = os.urandom(size)
+    text = armor(data)
+    print "armor: %.1f MB of binary data" % (size / 1024.0 / 1024)
+    bench('armor()', lambda data: len(armor(data)), data, size)
+    bench('ArmorEncoder.feed()', armor_stream, data, size)
+    bench('dearmor()', lambda text: len(dearmor(text)), text, size)
+    bench('ArmorDecoder.feed()', dearmor_stream, text, size)
+
+if __name__ == '__main__':
+    bench_status()
+    bench_listing()
+    bench_armor()
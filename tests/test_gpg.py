@@ -21,7 +21,7 @@
 Tests that require network access should go in test_network.py.
 """
 
-import sys, os, shutil
+import sys, os, shutil, time, json, re, signal
 from StringIO import StringIO
 import unittest
 import tempfile
@@ -29,6 +29,7 @@ import tempfile
 sys.path.append(os.path.dirname(__file__) + '/..')
 
 from monkeysign.gpg import *
+from monkeysign.packets import *
 
 class TestContext(unittest.TestCase):
     """Tests for the Context class.
@@ -86,6 +87,314 @@ class TestContext(unittest.TestCase):
         with self.assertRaises(AttributeError):
             k.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read())
 
+class TestCapabilities(unittest.TestCase):
+    """Tests for the gpg capability probe."""
+
+    fake = """#!/bin/sh
+case "$*" in
+    *--version*) echo "gpg (GnuPG) %s";;
+    *--dump-options*) echo "--export-options"; echo "--quick-sign-key";;
+esac
+"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="pygpg-")
+        self.cache = Context.capabilities_cache
+        Context.capabilities_cache = self.tmp + '/cache/capabilities.json'
+        Context.capabilities_probed.clear()
+        self.gpg = Context()
+        self.gpg.gpg_binary = self.tmp + '/gpg'
+        self.write_fake('2.1.11', 1000000000)
+
+    def tearDown(self):
+        Context.capabilities_cache = self.cache
+        Context.capabilities_probed.clear()
+        shutil.rmtree(self.tmp)
+
+    def write_fake(self, version, mtime):
+        with open(self.gpg.gpg_binary, 'w') as fd:
+            fd.write(self.fake % version)
+        os.chmod(self.gpg.gpg_binary, 0755)
+        os.utime(self.gpg.gpg_binary, (mtime, mtime))
+
+    def test_probe(self):
+        """the version and options should be found"""
+        capabilities = self.gpg.capabilities()
+        self.assertEqual(capabilities.version, '2.1.11')
+        self.assertEqual(capabilities.version_info, (2, 1, 11))
+        self.assertEqual(capabilities.agent, 'always')
+        self.assertTrue(capabilities.supports('--quick-sign-key'))
+        self.assertFalse(capabilities.supports('export-filter'))
+        self.assertEqual(self.gpg.version(), '2.1.11')
+
+    def test_cache(self):
+        """gpg should be probed only once, even between runs"""
+        metrics = []
+        self.gpg.sinks = [metrics.append]
+        self.gpg.capabilities()
+        calls = len(metrics)
+        self.assertTrue(self.gpg.capabilities() is self.gpg.capabilities())
+        Context.capabilities_probed.clear()
+        self.assertEqual(self.gpg.capabilities().version, '2.1.11')
+        self.assertEqual(len(metrics), calls)
+
+    def test_changed_binary(self):
+        """a new binary should be probed again"""
+        self.gpg.capabilities()
+        self.write_fake('1.4.12', 1000000010)
+        self.assertEqual(self.gpg.capabilities().version, '1.4.12')
+        self.assertEqual(self.gpg.capabilities().agent, 'optional')
+
+class ShellContext(Context):
+    """a context running shell commands instead of gpg
+
+    STATUS_FD in the command is replaced by the status-fd gpg would
+    get."""
+
+    def build_command(self, command, overrides = None):
+        options = dict(self.options)
+        options.update(overrides or {})
+        return ['sh', '-c', command.replace('STATUS_FD', str(options['status-fd']))]
+
+class TestSession(unittest.TestCase):
+    """Tests for the GpgSession class."""
+
+    def setUp(self):
+        self.context = ShellContext()
+
+    def test_both_pipes(self):
+        """make sure we do not deadlock if stdout fills up while we read stderr"""
+        session = GpgSession(self.context, 'head -c 1000000 /dev/zero; echo status >&2')
+        try:
+            self.assertEqual(session.stderr.readline(5), "status\n")
+            self.assertEqual(session.wait(), 0)
+            self.assertEqual(len(session.stdout.getvalue()), 1000000)
+        finally:
+            session.close()
+
+    def test_step_timeout(self):
+        """a stalled process should raise a timeout, not hang"""
+        session = GpgSession(self.context, 'sleep 10')
+        try:
+            with self.assertRaises(GpgTimeoutError):
+                self.context.expect(session.stderr, 'GOT_IT', 0.1)
+        finally:
+            session.close()
+        self.assertIsNotNone(session.returncode)
+
+    def test_deadline(self):
+        """the whole process should be killed at the deadline"""
+        self.context.deadline = 0.1
+        with self.assertRaises(GpgTimeoutError):
+            self.context.call_command('sleep 10')
+
+    def test_wait_exit(self):
+        """gpg may exit a while after closing its output"""
+        self.context.status_pipe = False
+        self.context.deadline = 5
+        result = self.context.call_command('exec >&- 2>&-; sleep 0.2; exit 3')
+        self.assertEqual(result.returncode, 3)
+        self.context.deadline = 0.2
+        with self.assertRaises(GpgTimeoutError):
+            self.context.call_command('exec >&- 2>&-; sleep 10')
+
+    def test_wait_fds_interrupted(self):
+        """signals should not make us wait longer than the timeout"""
+        (r, w) = os.pipe()
+        signals = []
+        def handler(signum, frame):
+            signals.append(signum)
+            if len(signals) >= 10:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        previous = signal.signal(signal.SIGALRM, handler)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.05, 0.05)
+            started = time.time()
+            self.assertEqual(GpgSession.wait_fds([r], [], 0.3), ([], []))
+            self.assertLess(time.time() - started, 0.5)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            os.close(r)
+            os.close(w)
+
+    def test_communicate(self):
+        """make sure large inputs and outputs do not block"""
+        data = "x" * 1000000
+        result = self.context.call_command('cat; echo done >&2', data)
+        self.assertTrue(result)
+        self.assertEqual(result.stdout, data)
+        self.assertEqual(result.stderr, "done\n")
+
+    def test_stream_command(self):
+        """output should be returned in chunks and not kept around"""
+        found = []
+        stream = self.context.stream_command('head -c 1000000 /dev/zero; echo "[GNUPG:] GOT_IT" >/dev/fd/STATUS_FD', handlers = {'GOT_IT': found.append})
+        chunks = list(stream)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(len(''.join(chunks)), 1000000)
+        self.assertEqual(stream.result.stdout, '')
+        self.assertEqual(stream.result.returncode, 0)
+        self.assertEqual(len(found), 1)
+
+    def test_output(self):
+        """output can be written to a file object"""
+        output = StringIO()
+        result = self.context.call_command('echo foo', output = output)
+        self.assertTrue(result)
+        self.assertEqual(output.getvalue(), "foo\n")
+        self.assertEqual(result.stdout, '')
+
+    def test_status_pipe(self):
+        """status lines should not be mixed with diagnostics"""
+        result = self.context.call_command('echo "[GNUPG:] GOT_IT" >/dev/fd/STATUS_FD; echo "gpg: oops" >&2')
+        self.assertTrue(result)
+        self.assertEqual(result.status, "[GNUPG:] GOT_IT\n")
+        self.assertEqual(result.stderr, "gpg: oops\n")
+        self.assertEqual(result.error_message(), "gpg: oops")
+
+    def test_status_stderr(self):
+        """status lines can still be sent to stderr"""
+        self.context.status_pipe = False
+        result = self.context.call_command('echo "gpg: oops" >&2; echo "[GNUPG:] GOT_IT" >/dev/fd/STATUS_FD')
+        self.assertTrue(result)
+        self.assertEqual(result.status, result.stderr)
+        self.assertEqual(result.error_message(), "gpg: oops")
+
+    def test_result(self):
+        """results should not be shared or modified"""
+        result = self.context.call_command('echo "[GNUPG:] GOT_IT" >/dev/fd/STATUS_FD; exit 1')
+        self.assertFalse(result)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual([ e.keyword for e in result.events ], ['GOT_IT'])
+        self.assertGreaterEqual(result.elapsed, 0)
+        with self.assertRaises(AttributeError):
+            result.returncode = 0
+        self.assertFalse(hasattr(self.context, 'stdout'))
+
+class TestEventLoop(unittest.TestCase):
+    """Tests for the EventLoop class."""
+
+    def setUp(self):
+        self.context = ShellContext()
+        self.loop = EventLoop()
+
+    def submit(self, command, stdin = None):
+        return self.loop.submit(self.context, command, Dialog(self.context, stdin))
+
+    def test_concurrent(self):
+        """processes should run in parallel"""
+        start = time.time()
+        futures = [ self.submit('sleep 0.5; echo %d' % i) for i in range(5) ]
+        self.loop.run()
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual([ f.result().stdout for f in futures ], [ "%d\n" % i for i in range(5) ])
+
+    def test_concurrency_limit(self):
+        """processes above the limit should wait for a free slot"""
+        self.loop.concurrency = 1
+        start = time.time()
+        futures = [ self.submit('sleep 0.2') for i in range(3) ]
+        self.loop.run()
+        self.assertGreaterEqual(time.time() - start, 0.6)
+        self.assertTrue(all([ f.done() for f in futures ]))
+
+    def test_deadline(self):
+        """a process running past the deadline should be killed"""
+        self.context.deadline = 0.1
+        future = self.submit('sleep 10')
+        self.assertIsInstance(future.exception(), GpgTimeoutError)
+
+    def test_stdin(self):
+        """make sure large inputs and outputs do not block"""
+        data = "x" * 1000000
+        future = self.submit('cat', data).then(lambda result: result.stdout)
+        self.assertEqual(future.result(), data)
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the metrics sinks."""
+
+    def setUp(self):
+        self.context = ShellContext()
+        self.metrics = []
+        self.context.sinks = [self.metrics.append]
+
+    def test_callback(self):
+        """every process should be reported"""
+        self.context.call_command('cat; echo "[GNUPG:] GOT_IT" >/dev/fd/STATUS_FD; exit 3', 'hello')
+        self.assertEqual(len(self.metrics), 1)
+        metrics = self.metrics[0]
+        self.assertEqual(metrics['command'], 'cat; echo "[GNUPG:] GOT_IT" >/dev/fd/STATUS_FD; exit 3')
+        self.assertEqual(metrics['bytes_in'], 5)
+        self.assertEqual(metrics['bytes_out'], len("hello[GNUPG:] GOT_IT\n"))
+        self.assertEqual(metrics['status_lines'], 1)
+        self.assertEqual(metrics['returncode'], 3)
+        self.assertGreaterEqual(metrics['wall'], metrics['spawn'])
+
+    def test_counter(self):
+        """totals should be kept per stage"""
+        counter = MetricsCounter()
+        self.context.sinks.append(counter)
+        counter.enter('first')
+        self.context.call_command('true')
+        self.context.call_command('true')
+        counter.enter('second')
+        self.context.call_command('false')
+        self.assertEqual(counter.totals[('first', 'true')]['calls'], 2)
+        self.assertEqual(counter.totals[('second', 'false')]['failed'], 1)
+        self.assertEqual(counter.stages, ['first', 'second'])
+        self.assertIn('second', counter.summary())
+
+    def test_log(self):
+        """metrics can be written as JSON lines"""
+        output = StringIO()
+        self.context.sinks = [MetricsLog(output)]
+        self.context.call_command('true')
+        self.assertEqual(json.loads(output.getvalue())['command'], 'true')
+
+class TestStatusParser(unittest.TestCase):
+    """Tests for the StatusParser class."""
+
+    transcript = """gpg: key 96F47C6A: public key "Test Key <foo@example.com>" imported
+[GNUPG:] IMPORTED 86E4E70A96F47C6A Test Key <foo@example.com>
+[GNUPG:] IMPORT_OK 1 3F94240C918E63590B04152E86E4E70A96F47C6A
+[GNUPG:] IMPORT_RES 1 0 1 0 0 0 0 0 0 0 0 0 0 0
+"""
+
+    def test_parse(self):
+        """make sure lines are split properly and garbage skipped"""
+        events = list(StatusParser().parse(self.transcript))
+        self.assertEqual([ e.keyword for e in events ], ['IMPORTED', 'IMPORT_OK', 'IMPORT_RES'])
+        self.assertEqual(events[1].args, ['1', '3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertTrue(events[1].match('IMPORT_OK', ['1']))
+        self.assertFalse(events[1].match('IMPORT_OK', ['2']))
+
+    def test_handlers(self):
+        """test the callback interface"""
+        found = []
+        parser = StatusParser({'IMPORT_OK': found.append})
+        list(parser.parse(StringIO(self.transcript)))
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0].args[1], '3F94240C918E63590B04152E86E4E70A96F47C6A')
+
+    def test_feed(self):
+        """partial lines should be kept until they are complete"""
+        parser = StatusParser()
+        events = []
+        for i in range(0, len(self.transcript), 7):
+            events += parser.feed(self.transcript[i:i+7])
+        events += parser.close()
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[2].args[0:3], ['1', '0', '1'])
+
+    def test_expect_informational(self):
+        """expect() should skip lines gpg sends in the middle of a dialog"""
+        c = Context()
+        fd = StringIO("[GNUPG:] KEY_CONSIDERED 3F94240C918E63590B04152E86E4E70A96F47C6A 0\n[GNUPG:] GET_LINE keyedit.prompt\n[GNUPG:] GOT_IT\n")
+        self.assertTrue(c.expect(fd, 'GET_LINE keyedit.prompt'))
+        with self.assertRaises(GpgProtocolError):
+            c.expect(fd, 'GET_BOOL keyedit.remove.uid.okay')
+
 class TestTempKeyring(unittest.TestCase):
     """Test the TempKeyring class."""
 
@@ -142,6 +451,40 @@ class TestKeyringBasics(TestKeyringBase):
         """test that import_data() throws an error on wrong data"""
         self.assertFalse(self.gpg.import_data(''))
 
+    def test_import_many(self):
+        """import strings and files in a single gpg process"""
+        metrics = []
+        self.gpg.context.sinks = [metrics.append]
+        result = self.gpg.import_many([open(os.path.dirname(__file__) + '/7B75921E.asc').read(),
+                                       open(os.path.dirname(__file__) + '/96F47C6A.asc'),
+                                       'garbage'])
+        self.assertEqual(['import'], [ m['command'] for m in metrics ])
+        self.assertTrue(result)
+        self.assertEqual(set(['8DC901CE64146C048AD50FBB792152527B75921E',
+                              '3F94240C918E63590B04152E86E4E70A96F47C6A']), set(result.keys))
+        for flags in result.keys.values():
+            self.assertTrue(flags & result.NEW)
+        self.assertEqual(2, result.counts['imported'])
+        # importing again changes nothing
+        result = self.gpg.import_many([open(os.path.dirname(__file__) + '/96F47C6A.asc')])
+        self.assertEqual(0, result.keys['3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertEqual(1, result.counts['unchanged'])
+
+    def test_transfer_to(self):
+        """keys should go from one keyring to the other through a pipe"""
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/7B75921E.asc').read()))
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        self.gpg.context.set_option('armor')
+        other = TempKeyring()
+        metrics = []
+        self.gpg.context.sinks = other.context.sinks = [metrics.append]
+        result = self.gpg.transfer_to(other, ['7B75921E', '96F47C6A'])
+        self.assertTrue(result)
+        self.assertEqual(2, result.counts['imported'])
+        self.assertItemsEqual(['export', 'import'], [ m['command'] for m in metrics ])
+        self.assertEqual(2, len(other.get_keys()))
+        self.assertFalse(self.gpg.transfer_to(other, 'nonexistent'))
+
     def test_export(self):
         """test that we can export data similar to what we import
 
@@ -160,6 +503,15 @@ class TestKeyringBasics(TestKeyringBase):
         # this shouldn't show anything, as this is just a public key blob
         self.assertFalse(self.gpg.get_keys('8DC901CE64146C048AD50FBB792152527B75921E', True, False))
 
+    def test_export_stream(self):
+        """exporting to a file should give the same data"""
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        k1 = self.gpg.export_data('96F47C6A')
+        output = StringIO()
+        self.assertTrue(self.gpg.export_data('96F47C6A', output = output))
+        self.assertEqual(k1, output.getvalue())
+        self.assertEqual(k1, ''.join(self.gpg.iter_export('96F47C6A')))
+
     def test_export_secret(self):
         """make sure we can import and export secret data"""
         self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A-secret.asc').read()))
@@ -190,11 +542,133 @@ class TestKeyringBasics(TestKeyringBase):
         with self.assertRaises(GpgRuntimeError):
             self.gpg.sign_key('7B75921E')
 
+    def test_sign_key_missing_key_editor(self):
+        """same as above, without --quick-sign-key"""
+        self.gpg.quick_sign = False
+        self.test_sign_key_missing_key()
+
     def test_failed_revoke(self):
         self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A-revoke.asc').read())
         with self.assertRaises(GpgRuntimeError):
             self.gpg.sign_key('7B75921E', True)
 
+class TestAsyncKeyring(TestKeyringBase):
+    """Test the AsyncKeyring class."""
+
+    def setUp(self):
+        TestKeyringBase.setUp(self)
+        self.gpg = AsyncKeyring(self.tmp)
+        self.gpg.context.set_option('always-trust')
+
+    def test_import_export(self):
+        """import keys concurrently, then export them"""
+        futures = [ self.gpg.import_data(open(os.path.dirname(__file__) + '/' + f).read()) for f in ['7B75921E.asc', '96F47C6A.asc'] ]
+        self.gpg.loop.run()
+        self.assertEqual([ f.result() for f in futures ], [True, True])
+        self.assertTrue(self.gpg.export_data('96F47C6A').result())
+        self.assertFalse(self.gpg.import_data('').result())
+
+    def test_sign_key_missing_key(self):
+        """signing a missing key should fail like with Keyring"""
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A-secret.asc').read()).result())
+        with self.assertRaises(GpgRuntimeError):
+            self.gpg.sign_key('7B75921E').result()
+
+    def test_sign_key_fingerprint(self):
+        """a fingerprint is not a uid to sign"""
+        self.gpg.use_quick_sign = lambda: True
+        metrics = []
+        self.gpg.context.sinks = [metrics.append]
+        fpr = '3F94240C918E63590B04152E86E4E70A96F47C6A'
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()).result())
+        with self.assertRaises(GpgRuntimeError):
+            self.gpg.sign_key(fpr).result()
+        # the uid was looked up, not signed
+        self.assertNotIn('quick-sign-key', [ m['command'] for m in metrics ])
+
+    def test_sign_key_one_uid_editor(self):
+        """the key editor should sign the uid we asked for, not its neighbour"""
+        self.gpg.use_quick_sign = lambda: False
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/323F39BD-secret.asc').read()).result())
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()).result())
+        self.assertTrue(self.gpg.sign_key('Second Test Key <unittests@monkeysphere.info>').result())
+        result = self.gpg.context.call_command(['list-sigs', '96F47C6A'])
+        signed = [ uid.split(':')[8] for uid in result.stdout.split('\nuid:')[1:] if ':A31E75E4323F39BD:' in uid ]
+        self.assertEqual(signed, ['Second Test Key <unittests@monkeysphere.info>'])
+
+    def test_lookup_gpg1(self):
+        """listing public and secret keys apart should not give futures"""
+        self.gpg.context.capabilities = lambda: GpgCapabilities('1.4.12')
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A-secret.asc').read()).result())
+        self.assertEqual([ key.secret for key in self.gpg.iter_keys(None, True, True) ], [True])
+        self.assertTrue(self.gpg.lookup().get_keys('96F47C6A', True, False))
+
+class TestQuickSign(unittest.TestCase):
+    """Test how the results of --quick-sign-key are interpreted."""
+
+    fpr = '8DC901CE64146C048AD50FBB792152527B75921E'
+    listing = """sec:u:1024:1:792152527B75921E:1792271457:0::u:::sc
+fpr:::::::::8DC901CE64146C048AD50FBB792152527B75921E:
+uid:u::::::::Test Key <foo@example.com>:::S9 S8 S7 S2 H10 H9 H8 H11 H2 Z2 Z3 Z1,mdc,no-ks-modify:1,psm::
+"""
+
+    def test_command(self):
+        self.assertEqual(Keyring._quick_sign_command(self.fpr, ['a', 'b'], True), ['quick-lsign-key', self.fpr, 'a', 'b'])
+        self.assertEqual(Keyring._quick_sign_command(self.fpr, None, False), ['quick-sign-key', self.fpr])
+
+    def test_signed(self):
+        self.assertTrue(Keyring._quick_signed(GpgResult(['quick-sign-key'], 0, self.listing), None))
+
+    def test_already_signed(self):
+        result = GpgResult(['quick-sign-key'], 0, '', '', '[GNUPG:] ALREADY_SIGNED 86E4E70A96F47C6A\n')
+        with self.assertRaisesRegexp(GpgRuntimeError, 'already signed'):
+            Keyring._quick_signed(result, ['Test Key <foo@example.com>'])
+
+    def test_missing_uid(self):
+        result = GpgResult(['quick-sign-key'], 2, self.listing, '', '', 'gpg: No matching user IDs.  Nothing to sign.\n')
+        with self.assertRaisesRegexp(GpgRuntimeError, 'user id not found'):
+            Keyring._quick_signed(result, ['Nobody <nobody@example.com>'])
+
+    def test_missing_key(self):
+        result = GpgResult(['quick-sign-key'], 2, '', '', '', 'gpg: key "%s" not found: No public key\n' % self.fpr)
+        with self.assertRaisesRegexp(GpgRuntimeError, 'unable to open key'):
+            Keyring._quick_signed(result, None)
+
+class TestTempKeyringPool(unittest.TestCase):
+    """Tests for the pool of temporary keyrings."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="pygpg-")
+        self.pool = TempKeyringPool(2, self.tmp)
+        self.pool.tasks.join()
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmp)
+
+    def test_ready(self):
+        """keyrings should be initialized already, and gone when deleted"""
+        keyring = TempKeyring(self.pool)
+        homedir = keyring.homedir
+        self.assertEqual(os.path.dirname(homedir), self.tmp)
+        self.assertTrue(os.path.exists(homedir + '/pubring.kbx') or os.path.exists(homedir + '/pubring.gpg'))
+        self.assertTrue(keyring.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        del keyring
+        self.assertFalse(os.path.exists(homedir))
+        # and the pool is filled up again
+        self.pool.tasks.join()
+        self.assertEqual(len(self.pool.ready), 2)
+        self.assertNotIn(homedir, self.pool.ready)
+
+    def test_close(self):
+        """nothing should be left behind"""
+        keyring = TempKeyring(self.pool)
+        self.pool.close()
+        self.assertEqual(os.listdir(self.tmp), [])
+        # giving it back later is fine
+        del keyring
+        self.assertEqual(os.listdir(self.tmp), [])
+
 class TestKeyringWithKeys(TestKeyringBase):
     def setUp(self):
         TestKeyringBase.setUp(self)
@@ -211,6 +685,13 @@ class TestKeyringWithKeys(TestKeyringBase):
         for fpr, key in self.gpg.get_keys('96F47C6A').iteritems():
             print key
 
+    def test_iter_keys(self):
+        """iter_keys should list the same keys as get_keys"""
+        keys = self.gpg.get_keys(None, True)
+        self.assertEqual(sorted([ key.fpr for key in self.gpg.iter_keys(None, True) ]), sorted(keys.keys()))
+        self.assertEqual([ key.secret for key in self.gpg.iter_keys('96F47C6A', True) ], [True])
+        self.assertEqual(list(self.gpg.iter_keys('0000000F')), [])
+
     def test_sign_key_wrong_user(self):
         """make sure sign_key with a erroneous local-user fails
 
@@ -222,21 +703,21 @@ class TestKeyringWithKeys(TestKeyringBase):
     def test_sign_key_all_uids(self):
         """test signature of all uids of a key"""
         self.assertTrue(self.gpg.sign_key('7B75921E', True))
-        self.gpg.context.call_command(['list-sigs', '7B75921E'])
-        self.assertRegexpMatches(self.gpg.context.stdout, 'sig:::1:86E4E70A96F47C6A:[^:]*::::Second Test Key <unittests@monkeysphere.info>:10x:')
+        result = self.gpg.context.call_command(['list-sigs', '7B75921E'])
+        self.assertRegexpMatches(result.stdout, 'sig:::1:86E4E70A96F47C6A:[^:]*::::Second Test Key <unittests@monkeysphere.info>:10x:')
 
     def test_sign_key_single_uid(self):
         """test signing a key with a single uid"""
         self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/323F39BD.asc').read()))
         self.assertTrue(self.gpg.sign_key('323F39BD', True))
-        self.gpg.context.call_command(['list-sigs', '323F39BD'])
-        self.assertRegexpMatches(self.gpg.context.stdout, 'sig:::1:A31E75E4323F39BD:[^:]*::::Monkeysphere second test key <bar@example.com>:[0-9]*x:')
+        result = self.gpg.context.call_command(['list-sigs', '323F39BD'])
+        self.assertRegexpMatches(result.stdout, 'sig:::1:A31E75E4323F39BD:[^:]*::::Monkeysphere second test key <bar@example.com>:[0-9]*x:')
 
     def test_sign_key_one_uid(self):
         """test signature of a single uid"""
         self.assertTrue(self.gpg.sign_key('Antoine Beaupré <anarcat@debian.org>'))
-        self.gpg.context.call_command(['list-sigs', '7B75921E'])
-        self.assertRegexpMatches(self.gpg.context.stdout, 'sig:::1:86E4E70A96F47C6A:[^:]*::::Second Test Key <unittests@monkeysphere.info>:10x:')
+        result = self.gpg.context.call_command(['list-sigs', '7B75921E'])
+        self.assertRegexpMatches(result.stdout, 'sig:::1:86E4E70A96F47C6A:[^:]*::::Second Test Key <unittests@monkeysphere.info>:10x:')
 
     def test_sign_key_as_user(self):
         """normal signature with a signing user specified"""
@@ -261,6 +742,13 @@ class TestKeyringWithKeys(TestKeyringBase):
         self.assertTrue(p)
         self.assertEqual(p, plaintext)
 
+    def test_encrypt_metrics(self):
+        """encryptions should be counted as such"""
+        metrics = []
+        self.gpg.context.sinks = [metrics.append]
+        self.assertTrue(self.gpg.encrypt_data('i come in peace', '96F47C6A', True))
+        self.assertEqual([ m['command'] for m in metrics ], ['encrypt'])
+
     def test_gen_key(self):
         """test key generation
 
@@ -314,6 +802,325 @@ class TestKeyringWithKeys(TestKeyringBase):
             for u, uid in key.uids.iteritems():
                 self.assertEqual(userid, uid.uid)
 
+    def test_edit_session(self):
+        """delete many uids in a single edit session"""
+        # gpg 2 will not edit keys without a trustdb, which
+        # always-trust never creates
+        self.gpg.context.unset_option('always-trust')
+        fpr = '8DC901CE64146C048AD50FBB792152527B75921E'
+        uids = re.findall('^uid:[^:]*:(?:[^:]*:){7}([^:]*):', self.gpg.context.call_command(['list-keys', fpr]).stdout, re.MULTILINE)
+        self.assertGreater(len(uids), 1)
+        metrics = []
+        self.gpg.context.sinks = [metrics.append]
+        with self.gpg.edit_key(fpr) as edit:
+            for uid in uids[1:]:
+                edit.select_uid(uid)
+            edit.deluid()
+        self.assertEqual([ m['command'] for m in metrics ], ['edit-key'])
+        self.assertEqual(re.findall('^uid:[^:]*:(?:[^:]*:){7}([^:]*):', self.gpg.context.call_command(['list-keys', fpr]).stdout, re.MULTILINE), uids[:1])
+
+    def test_edit_session_missing_uid(self):
+        """selecting a missing uid should fail"""
+        self.gpg.context.unset_option('always-trust')
+        with self.assertRaisesRegexp(GpgRuntimeError, 'user id not found'):
+            self.gpg.edit_key('8DC901CE64146C048AD50FBB792152527B75921E').select_uid('Nobody <nobody@example.com>').deluid().commit()
+
+class TestKeyIndex(TestKeyringBase):
+    def setUp(self):
+        TestKeyringBase.setUp(self)
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/7B75921E.asc').read()))
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A-secret.asc').read()))
+        self.index = KeyIndex(self.gpg, self.tmp + '/index.sqlite')
+
+    def tearDown(self):
+        self.index.close()
+        TestKeyringBase.tearDown(self)
+
+    def test_refresh(self):
+        """only changed keys should be written again"""
+        self.assertEqual(self.index.refresh(), 2)
+        self.assertEqual(self.index.refresh(), 0)
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/323F39BD.asc').read()))
+        self.assertEqual(self.index.refresh(), 1)
+        self.assertEqual(len(self.index.find()), 3)
+
+    def test_find(self):
+        """keys should be found by fingerprint, keyid and email"""
+        fpr = '8DC901CE64146C048AD50FBB792152527B75921E'
+        self.assertEqual(self.index.find(fpr), [fpr])
+        self.assertEqual(self.index.find('8DC901'), [fpr])
+        self.assertEqual(self.index.find('792152527B75921E'), [fpr])
+        self.assertEqual(self.index.find('0x7b75921e'), [fpr])
+        self.assertEqual(self.index.find('<Anarcat@Orangeseeds.org>'), [fpr])
+        self.assertEqual(self.index.find('<nobody@example.com>'), [])
+
+    def test_find_subkey(self):
+        """subkeys should find their primary key, like in gpg"""
+        fpr = '8DC901CE64146C048AD50FBB792152527B75921E'
+        self.assertTrue(self.index.handles('A51D5B109C5A5581'))
+        self.assertEqual(self.index.find('A51D5B109C5A5581'), [fpr])
+        self.assertEqual(self.index.find('9C5A5581'), [fpr])
+        self.gpg.index = self.index
+        self.assertEqual(self.gpg.get_keys('A51D5B109C5A5581').keys(), [fpr])
+
+    def test_get_keys(self):
+        """get_keys should use the index when it can"""
+        self.gpg.index = self.index
+        keys = self.gpg.get_keys(None, True, False)
+        self.assertEqual(keys.keys(), ['3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertTrue(keys.values()[0].secret)
+        self.assertEqual(self.gpg.get_keys('<foo@example.com>').keys(), ['3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertIsNone(self.gpg.get_keys('0000000F'))
+        # this has to go through gpg
+        self.assertFalse(self.index.handles('Test Key'))
+        self.assertEqual(len(self.gpg.get_keys('Test Key')), 1)
+
+class TestKeyringCache(TestKeyringBase):
+    def setUp(self):
+        TestKeyringBase.setUp(self)
+        self.gpg.cache = {}
+        self.metrics = []
+        self.gpg.context.sinks = [self.metrics.append]
+
+    def commands(self):
+        return [ m['command'] for m in self.metrics ]
+
+    def test_export(self):
+        """exports should be remembered until the keyring changes"""
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        data = self.gpg.export_data('96F47C6A')
+        self.assertEqual(self.gpg.export_data('96F47C6A'), data)
+        self.assertEqual(self.commands(), ['import', 'export'])
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/7B75921E.asc').read()))
+        self.assertEqual(self.gpg.export_data('96F47C6A'), data)
+        self.assertEqual(self.commands(), ['import', 'export', 'import', 'export'])
+
+    def test_options(self):
+        """changing options should not return stale exports"""
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        self.gpg.export_data('96F47C6A')
+        self.gpg.context.set_option('export-options', 'export-minimal')
+        self.gpg.export_data('96F47C6A')
+        self.assertEqual(self.commands(), ['import', 'export', 'export'])
+
+    def test_get_keys(self):
+        """listings should be remembered, and copied"""
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        keys = self.gpg.get_keys()
+        keys.clear()
+        self.assertEqual(len(self.gpg.get_keys()), 1)
+        self.assertIsNone(self.gpg.get_keys('0000000F'))
+        self.assertIsNone(self.gpg.get_keys('0000000F'))
+        self.assertEqual(self.commands(), ['import', 'list-keys', 'list-keys'])
+        generation = self.gpg.generation
+        # fails, without a secret key, but the keyring may still change
+        try:
+            self.gpg.sign_key('96F47C6A', True)
+        except GpgRuntimeError:
+            pass
+        self.assertGreater(self.gpg.generation, generation)
+        self.gpg.get_keys()
+        self.assertEqual(self.commands()[-1], 'list-keys')
+
+    def test_get_keys_changed(self):
+        """changing the keys returned should not change the cached ones"""
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        for native in (False, True):
+            self.gpg.native = native
+            key = self.gpg.get_keys('96F47C6A').values()[0]
+            key.trust = 'u'
+            key.secret = True
+            key.add_uid(OpenPGPuid('Nobody <nobody@example.com>', '-'))
+            key.uidslist[0].uid = 'Changed'
+            key.subkeys.values()[0].expiry = 1
+            key = self.gpg.get_keys('96F47C6A').values()[0]
+            self.assertNotEqual(key.trust, 'u')
+            self.assertFalse(key.secret)
+            self.assertEqual([ uid.uid for uid in key.uidslist ], ['Second Test Key <unittests@monkeysphere.info>', 'Test Key <foo@example.com>'])
+            self.assertEqual(key.subkeys.values()[0].expiry, 0)
+
+class TestKeyLookup(TestKeyringBase):
+    def setUp(self):
+        TestKeyringBase.setUp(self)
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/7B75921E.asc').read()))
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A-secret.asc').read()))
+
+    def test_find(self):
+        """keys should be found without running gpg again"""
+        lookup = self.gpg.lookup()
+        metrics = []
+        self.gpg.context.sinks = [metrics.append]
+        self.assertIs(self.gpg.lookup(), lookup)
+        fpr = '8DC901CE64146C048AD50FBB792152527B75921E'
+        self.assertEqual(lookup.find(fpr), [fpr])
+        self.assertEqual(lookup.find('8DC9 01CE 6414 6C04 8AD5  0FBB 7921 5252 7B75 921E'), [fpr])
+        self.assertEqual(lookup.find('8DC901CE64'), [fpr])
+        self.assertEqual(lookup.find('0x7B75921E'), [fpr])
+        self.assertEqual(lookup.find('792152527b75921e'), [fpr])
+        self.assertEqual(lookup.find('<ANARCAT@orangeseeds.org>'), [fpr])
+        self.assertEqual(lookup.find('anarcat@orangeseeds.org'), [fpr])
+        self.assertEqual(lookup.find('@example.com'), ['3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertEqual(lookup.find('894EE34814B46386'), ['3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertEqual(lookup.find('0000000F'), [])
+        self.assertIsNone(lookup.find('Test Key'))
+        self.assertEqual(metrics, [])
+
+    def test_get_keys_many(self):
+        """many patterns should be resolved by a single gpg"""
+        metrics = []
+        self.gpg.context.sinks = [metrics.append]
+        (keys, missing) = self.gpg.get_keys_many(['7B75921E', '3F94240C918E63590B04152E86E4E70A96F47C6A',
+                                                  'test key', '=Test Key <foo@example.com>', '0000000F', 'Nobody'])
+        self.assertEqual(sorted(keys.keys()), ['3F94240C918E63590B04152E86E4E70A96F47C6A', '8DC901CE64146C048AD50FBB792152527B75921E'])
+        self.assertEqual(missing, ['0000000F', 'Nobody'])
+        self.assertEqual([ m['command'] for m in metrics ], ['list-keys'])
+        self.gpg.batch = 2
+        (keys, missing) = self.gpg.get_keys_many(['7B75921E', '0000000F', '96F47C6A'], True, False)
+        self.assertEqual(keys.keys(), ['3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertEqual(missing, ['7B75921E', '0000000F'])
+
+    def test_get_keys(self):
+        """secret keys should be told apart"""
+        lookup = self.gpg.lookup()
+        self.assertEqual(lookup.get_keys(None, True, False).keys(), ['3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertEqual(len(lookup.get_keys()), 2)
+        self.assertEqual(lookup.get_keys('7B75921E', True, False), {})
+        self.assertIsNone(lookup.get_keys('Test Key'))
+
+class TestPacketReader(TestKeyringBase):
+    def setUp(self):
+        TestKeyringBase.setUp(self)
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/7B75921E.asc').read()))
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/323F39BD.asc').read()))
+
+    @staticmethod
+    def describe(key):
+        """what the reader and gpg should agree on"""
+        return (key.fpr, key.keyid(16), key.algo, key.length, key.creation, key.expiry, key.capabilities,
+                [ (uid.uid, uid.uidhash, uid.creation) for uid in key.uidslist ],
+                sorted([ (sub.keyid(16), sub.algo, sub.length, sub.creation, sub.expiry, sub.capabilities) for sub in key.subkeys.values() ]))
+
+    def test_read_keys(self):
+        """keys read from the keyring should be the ones gpg lists"""
+        listed = self.gpg.get_keys()
+        read = self.gpg.read_keys()
+        self.assertItemsEqual(listed.keys(), read.keys())
+        for fpr, key in listed.iteritems():
+            self.assertEqual(self.describe(key), self.describe(read[fpr]))
+        # the key expired in 2016
+        self.assertTrue(read['8DC901CE64146C048AD50FBB792152527B75921E'].expired)
+
+    def test_native(self):
+        """get_keys() should not run gpg for patterns the lookup knows"""
+        self.gpg.native = True
+        metrics = []
+        self.gpg.context.sinks = [metrics.append]
+        self.assertEqual(len(self.gpg.get_keys()), 3)
+        self.assertEqual(self.gpg.get_keys('foo@example.com').keys(), ['3F94240C918E63590B04152E86E4E70A96F47C6A'])
+        self.assertIsNone(self.gpg.get_keys('0000000F'))
+        self.assertEqual(metrics, [])
+        # other patterns are still given to gpg
+        self.assertEqual(len(self.gpg.get_keys('Test Key')), 2)
+        self.assertEqual([ m['command'] for m in metrics ], ['list-keys'])
+
+    def test_truncated(self):
+        """broken keyrings should be reported, and left to gpg"""
+        self.gpg.context.set_option('armor', False)
+        data = self.gpg.context.call_command(['export']).stdout
+        self.assertEqual(len(list(PacketReader(data).keys())), 3)
+        with self.assertRaises(ValueError):
+            list(PacketReader(data[:1000]).keys())
+
+    def test_keep_uid(self):
+        """a single uid should be cut out of an export"""
+        self.gpg.context.set_option('armor')
+        data = self.gpg.export_data('7B75921E')
+        self.assertEqual(armor(dearmor(data)).split("\n")[-3:], data.split("\n")[-3:])
+        uid = 'Antoine Beaupr\xc3\xa9 <anarcat@orangeseeds.org>'
+        keys = list(PacketReader(PacketReader(dearmor(data)).keep_uid(uid)).keys())
+        self.assertEqual([ key.fpr for key in keys ], ['8DC901CE64146C048AD50FBB792152527B75921E'])
+        self.assertEqual([ u.uid for u in keys[0].uidslist ], [uid])
+        self.assertEqual(len(keys[0].subkeys), 4)
+        self.assertEqual(PacketReader(dearmor(data)).keep_uid('Test Key <foo@example.com>'), '')
+        with self.assertRaises(ValueError):
+            dearmor(data.replace("\n=", "\n=AA"))
+
+    def test_delta(self):
+        """only the new certifications should be exported"""
+        known = self.gpg.signatures('7B75921E')
+        self.assertEqual(len(known), 9)
+        self.assertEqual(self.gpg.export_delta('7B75921E', known), '')
+        # pretend the signature on the second uid is new
+        data = self.gpg.context.call_command(['export', '7B75921E'], overrides = {'armor': False}).stdout
+        reader = PacketReader(data)
+        (tag, header, start, end) = [ p for p in reader.packets(0, len(data)) if p[0] == PacketReader.SIGNATURE ][1]
+        delta = self.gpg.export_delta('7B75921E', known - set([data[header:end]]))
+        keys = list(PacketReader(delta).keys())
+        self.assertEqual([ key.fpr for key in keys ], ['8DC901CE64146C048AD50FBB792152527B75921E'])
+        self.assertEqual([ u.uid for u in keys[0].uidslist ], ['Antoine Beaupr\xc3\xa9 <anarcat@debian.org>'])
+        self.assertEqual(keys[0].subkeys, {})
+        self.assertLess(len(delta), len(data) / 4)
+        # gpg merges it in the key
+        self.assertTrue(self.gpg.import_data(delta))
+        # without what the key had, gpg cleans the key instead
+        self.assertEqual(len(list(PacketReader(self.gpg.export_delta('7B75921E')).keys())), 1)
+
+    def test_colon_uid(self):
+        """uids should be escaped like gpg lists them"""
+        self.assertTrue(self.gpg.import_data(open(os.path.dirname(__file__) + '/colon-uid.asc').read()))
+        fpr = 'C0310ABE68836B23A285001C834BDD89DA8332AD'
+        uid = 'Carol (https\\x3a//carol.example\\x5cback) <carol3@example.com>'
+        self.assertEqual([ u.uid for u in self.gpg.get_keys(fpr)[fpr].uidslist ], [uid])
+        self.assertEqual(self.describe(self.gpg.get_keys(fpr)[fpr]), self.describe(self.gpg.read_keys()[fpr]))
+        self.assertEqual(unescape_colons(uid), 'Carol (https://carol.example\\back) <carol3@example.com>')
+        self.assertEqual(escape_colons(unescape_colons(uid)), uid)
+        self.gpg.context.set_option('armor', False)
+        keys = list(PacketReader(PacketReader(self.gpg.export_data(fpr)).keep_uid(uid)).keys())
+        self.assertEqual([ u.uid for u in keys[0].uidslist ], [uid])
+
+    def test_ripemd160(self):
+        """uid hashes should be found without OpenSSL"""
+        self.assertEqual(ripemd160(''), '9c1185a5c5e9fc54612808977ee8f548b2258d31')
+        self.assertEqual(ripemd160('Test Key <foo@example.com>').upper(), '214CB0EDA28F3CA8754A4D43B7CDB7B114171B3C')
+
+class TestArmor(unittest.TestCase):
+    """Tests for the ASCII armor codec."""
+
+    def setUp(self):
+        self.text = open(os.path.dirname(__file__) + '/96F47C6A.asc').read()
+
+    def test_crc24(self):
+        """the checksum should not depend on how the data is split"""
+        data = ''.join([ chr(i % 251) for i in range(1001) ])
+        self.assertEqual(crc24(''), 0xb704ce)
+        self.assertEqual(crc24('123456789'), 0x21cf02)
+        self.assertEqual(crc24(data), crc24(data[501:], crc24(data[:501])))
+
+    def test_stream(self):
+        """armor fed in small chunks should give what gpg armored"""
+        decoder = ArmorDecoder()
+        data = ''.join([ decoder.feed(self.text[i:i+7]) for i in range(0, len(self.text), 7) ]) + decoder.close()
+        self.assertEqual(data, dearmor(self.text))
+        self.assertEqual(len(list(PacketReader(data).keys())), 1)
+        encoder = ArmorEncoder()
+        text = ''.join([ encoder.feed(data[i:i+5]) for i in range(0, len(data), 5) ]) + encoder.close()
+        self.assertEqual(text, armor(data))
+        self.assertEqual(dearmor(text + text), data + data)
+        # gpg adds a Version header
+        self.assertEqual(text.split("\n")[2:], self.text.split("\n")[-len(text.split("\n")) + 2:])
+
+    def test_invalid(self):
+        """broken armor should be reported"""
+        with self.assertRaises(ValueError):
+            dearmor(self.text.replace("\n=", "\n=AA"))
+        lines = self.text.split("\n")
+        lines[5] = lines[5][:-1]
+        with self.assertRaises(ValueError):
+            dearmor("\n".join(lines))
+
 class TestOpenPGPkey(unittest.TestCase):
     def setUp(self):
         self.key = OpenPGPkey("""tru::1:1343350431:0:3:1:5
@@ -334,6 +1141,144 @@ sub:-:1024:1:894EE34814B46386:1342795252::::::e:""")
     def test_get_trust(self):
         self.assertEqual('unknown', self.key.get_trust())
 
+    def test_compact(self):
+        """keys should not carry a dictionary per instance"""
+        self.assertFalse(hasattr(self.key, '__dict__'))
+        self.assertFalse(hasattr(self.key.uidslist[0], '__dict__'))
+        with self.assertRaises(AttributeError):
+            self.key.comment = 'no room for this'
+
+    def test_flags(self):
+        """booleans and capabilities should be stored as bits"""
+        self.assertFalse(self.key.secret)
+        self.key.secret = True
+        self.key.revoked = True
+        self.assertEqual(self.key.flags, OpenPGPkey.SECRET | OpenPGPkey.REVOKED)
+        self.key.secret = False
+        self.assertEqual(self.key.flags, OpenPGPkey.REVOKED)
+        self.assertEqual(self.key.purpose, {'encrypt': True, 'sign': True, 'certify': True, 'authenticate': False})
+        self.assertEqual(self.key.subkeys['894EE34814B46386'].purpose['sign'], False)
+
+    def test_find_uid(self):
+        """uids should be found by hash"""
+        uid = self.key.find_uid('214CB0EDA28F3CA8754A4D43B7CDB7B114171B3C')
+        self.assertIs(uid, self.key.uidslist[0])
+        self.assertEqual(self.key.uids, {uid.uidhash: uid})
+        self.assertIsNone(self.key.find_uid('0000000000000000000000000000000000000000'))
+
+class TestKeyListParser(unittest.TestCase):
+    public = r"""tru::1:1343350431:0:3:1:5
+pub:-:1024:1:86E4E70A96F47C6A:1342795252:::-:::scESC:
+fpr:::::::::3F94240C918E63590B04152E86E4E70A96F47C6A:
+uid:-::::1342795252::214CB0EDA28F3CA8754A4D43B7CDB7B114171B3C::Test Key <foo@example.com>:
+sub:-:1024:1:894EE34814B46386:1342795252::::::e:
+pub:-:1024:1:A31E75E4323F39BD:1342795252:::-:::scESC:
+fpr:::::::::20D6ED3D6BE5A2E7A7AC9C7FA31E75E4323F39BD:
+uid:-::::1342795252::0EA5B3B0B1D6D70F2F6AFB35E1E6E0F5F6A0C5EA::Evil pub\x3a <bar@example.com>:
+"""
+
+    secret = """sec::1024:1:86E4E70A96F47C6A:1342795252::::::::::
+fpr:::::::::3F94240C918E63590B04152E86E4E70A96F47C6A:
+uid:::::::::Test Key <foo@example.com>:
+ssb::1024:1:894EE34814B46386:1342795252::::::::::
+"""
+
+    def test_chunks(self):
+        """keys should come out as soon as the next one starts"""
+        parser = KeyListParser()
+        keys = []
+        for i in range(0, len(self.public), 7):
+            keys += parser.feed(self.public[i:i+7])
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(keys[0].fpr, '3F94240C918E63590B04152E86E4E70A96F47C6A')
+        keys += parser.close()
+        self.assertEqual([ key.fpr for key in keys ], ['3F94240C918E63590B04152E86E4E70A96F47C6A', '20D6ED3D6BE5A2E7A7AC9C7FA31E75E4323F39BD'])
+        self.assertEqual(keys[1].uidslist[0].uid, 'Evil pub\\x3a <bar@example.com>')
+        self.assertNotIn('894EE34814B46386', keys[1].subkeys)
+
+    def test_lazy(self):
+        """uids and subkeys should be decoded on first access"""
+        (key, other) = KeyListParser().parse(self.public)
+        self.assertEqual(key.fpr, '3F94240C918E63590B04152E86E4E70A96F47C6A')
+        self.assertEqual(key.length, 1024)
+        self.assertTrue(key._pending)
+        self.assertEqual(key._uidslist, [])
+        self.assertEqual(key.uidslist[0].uid, 'Test Key <foo@example.com>')
+        self.assertIsNone(key._pending)
+        self.assertTrue(other._pending)
+        self.assertEqual(other.subkeys, {})
+        self.assertIsNone(other._pending)
+
+    def test_merge(self):
+        """secret listings should complete the public keys"""
+        keys = {}
+        KeyListParser(keys).parse(self.public)
+        key = keys['3F94240C918E63590B04152E86E4E70A96F47C6A']
+        self.assertFalse(key.secret)
+        self.assertEqual(KeyListParser(keys).parse(self.secret), [key])
+        self.assertEqual(len(keys), 2)
+        self.assertTrue(key.secret)
+        self.assertTrue(key.subkeys['894EE34814B46386'].secret)
+        self.assertEqual([ uid.uid for uid in key.uidslist ], ['Test Key <foo@example.com>'])
+        self.assertEqual(key.uids.keys(), ['214CB0EDA28F3CA8754A4D43B7CDB7B114171B3C'])
+
+class TestRecordDecoder(unittest.TestCase):
+    def setUp(self):
+        self.decoder = RecordDecoder()
+
+    def test_typed(self):
+        """numbers, timestamps and capabilities should be decoded"""
+        fields = self.decoder.decode('pub:u:1024:1:110EC0971B18B604:1792271457:1800000000::u:::scESCA:::+:::::0:'.split(':'))
+        self.assertEqual(fields['length'], 1024)
+        self.assertEqual(fields['creation'], 1792271457)
+        self.assertEqual(fields['expiry'], 1800000000)
+        self.assertEqual(fields['capabilities'], RecordDecoder.ENCRYPT | RecordDecoder.SIGN | RecordDecoder.CERTIFY | RecordDecoder.AUTHENTICATE)
+        self.assertEqual(fields['token'], '+')
+
+    def test_short(self):
+        """missing fields should get empty values"""
+        fields = self.decoder.decode('sub:-:1024:1:894EE34814B46386:1342795252'.split(':'))
+        self.assertEqual(fields['expiry'], 0)
+        self.assertEqual(fields['capabilities'], 0)
+
+    def test_unknown(self):
+        """unknown record types should be ignored"""
+        self.assertEqual(self.decoder.decode('xyz:1:2:3'.split(':')), {})
+
+    def test_gpg2_listing(self):
+        """newer listings, with more fields and records, should parse"""
+        key = OpenPGPkey("""tru::1:1792271457:0:3:1:5
+cfg:version:2.2.40
+pub:u:1024:1:06B123523AF40E9F:1792271457:::u:::scSC:::+:::::0:
+fpr:::::::::EC6E359C81D64F86BFEB6B2206B123523AF40E9F:
+grp:::::::::DE2BD9205896D7718132143CAF4F8A20C6F1C322:
+uid:u::::1792271457::C6E9BD528F5FC57B727A65890926D96CAAB594CB::Alice Two <alice2@example.org>::::::::::0:
+sig:!::1:06B123523AF40E9F:1792271457::::Alice Two <alice2@example.org>:13x:::::8:
+rev:!::1:110EC0971B18B604:1792271500::::Signer <signer@example.com>:30x:::::8:
+sub:u:1024:16:2BEA7DC05EBB6E46:1792271457:1800000000:::::e:::+:::::0:
+fpr:::::::::5F6DB9A5E8A3E8D4D0E0C5C32BEA7DC05EBB6E46:
+grp:::::::::0D3DDE8CC7D0FB66F2A5B7D2D6A3E1B5B0C4E6A7:""")
+        self.assertEqual(key.fpr, 'EC6E359C81D64F86BFEB6B2206B123523AF40E9F')
+        self.assertEqual(key.keygrip, 'DE2BD9205896D7718132143CAF4F8A20C6F1C322')
+        self.assertTrue(key.secret)
+        self.assertFalse(key.purpose['encrypt'])
+        self.assertTrue(key.purpose['certify'])
+        uid = key.uidslist[0]
+        self.assertEqual([ (sig['keyid'], sig['revocation']) for sig in uid.signatures ], [('06B123523AF40E9F', False), ('110EC0971B18B604', True)])
+        subkey = key.subkeys['2BEA7DC05EBB6E46']
+        self.assertEqual(subkey.fpr, '5F6DB9A5E8A3E8D4D0E0C5C32BEA7DC05EBB6E46')
+        self.assertEqual(subkey.expiry, 1800000000)
+        self.assertEqual(subkey.capabilities, RecordDecoder.ENCRYPT)
+
+    def test_card_listing(self):
+        """keys on a card, or with an offline primary, are secret too"""
+        key = OpenPGPkey("""pub:u:1024:1:06B123523AF40E9F:1792271457:::u:::scSC:::#:::::0:
+fpr:::::::::EC6E359C81D64F86BFEB6B2206B123523AF40E9F:
+sub:u:1024:16:2BEA7DC05EBB6E46:1792271457:1800000000:::::e:::D2760001240102010006041234560000:::::0:
+fpr:::::::::5F6DB9A5E8A3E8D4D0E0C5C32BEA7DC05EBB6E46:""")
+        self.assertTrue(key.secret)
+        self.assertTrue(key.subkeys['2BEA7DC05EBB6E46'].secret)
+
 class TestSecretOpenPGPkey(unittest.TestCase):
     def setUp(self):
         self.key = OpenPGPkey("""sec::1024:17:586073B34023702F:1110320887:1268438180:::::::::
@@ -24,11 +24,14 @@ import unittest
 import os
 import sys
 import re
+import tempfile
+import shutil
 
 sys.path.append(os.path.dirname(__file__) + '/..')
 
 from monkeysign.ui import MonkeysignUi, EmailFactory
-from monkeysign.gpg import TempKeyring
+from monkeysign.gpg import TempKeyring, Context, KeyIndex, GpgRuntimeError
+from monkeysign.packets import PacketReader, dearmor
 
 from test_lib import TestTimeLimit
 
@@ -113,6 +116,8 @@ class BaseTestCase(unittest.TestCase):
         self.ui = MonkeysignUi(self.args)
         self.ui.keyring = TempKeyring()
         self.ui.prepare() # needed because we changed the base keyring
+        # like __exit__ does, even if the test does not get there
+        self.addCleanup(self.ui.pool.close)
 
 class BasicTests(BaseTestCase):
     pattern = '7B75921E'
@@ -125,6 +130,58 @@ class BasicTests(BaseTestCase):
         del self.ui
         self.assertFalse(os.path.exists(self.homedir))
 
+    def test_exit_pool(self):
+        """the temporary keyrings should be removed on exit"""
+        self.ui.logfile = open('/dev/null', 'w')
+        self.ui.__exit__(None, None, None)
+        self.assertTrue(self.ui.pool.closed)
+        self.assertFalse(os.path.exists(self.homedir))
+        self.assertEqual(self.ui.pool.ready, [])
+
+class StatsTests(BaseTestCase):
+    args = [ '--stats' ]
+
+    def test_stats(self):
+        """test if gpg commands are counted per stage"""
+        self.ui.stage('testing')
+        self.ui.keyring.export_data()
+        self.assertRegexpMatches(self.ui.stats.summary(), 'testing +export +1 ')
+        self.ui.logfile = open('/dev/null', 'w')
+        self.ui.__exit__(None, None, None)
+        self.assertNotIn(self.ui.stats, Context.sinks)
+
+class IndexTests(BaseTestCase):
+    args = [ '--index' ]
+
+    def setUp(self):
+        """keep the index databases out of the home directory"""
+        self.cache = KeyIndex.cache
+        KeyIndex.cache = tempfile.mkdtemp(prefix='monkeysign-')
+        BaseTestCase.setUp(self)
+
+    def tearDown(self):
+        shutil.rmtree(KeyIndex.cache)
+        KeyIndex.cache = self.cache
+
+    def test_copy_secrets(self):
+        """test if the signing key is found through the index"""
+        self.assertIsInstance(self.ui.keyring.index, KeyIndex)
+        self.assertTrue(self.ui.keyring.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        self.assertTrue(self.ui.keyring.import_data(open(os.path.dirname(__file__) + '/96F47C6A-secret.asc').read()))
+        # the index is queried, not loaded whole
+        self.ui.keyring.lookup = lambda refresh = False: self.fail('all keys loaded from the index')
+        self.ui.copy_secrets()
+        self.assertEqual(self.ui.signing_key.fpr, '3F94240C918E63590B04152E86E4E70A96F47C6A')
+        self.assertEqual(self.ui.keyring.index.refresh(), 0)
+
+    def test_find_key(self):
+        """test if the key to sign is checked in the index"""
+        self.assertTrue(self.ui.keyring.import_data(open(os.path.dirname(__file__) + '/96F47C6A.asc').read()))
+        self.ui.keyring.lookup = lambda refresh = False: self.fail('all keys loaded from the index')
+        self.ui.pattern = '96F47C6A'
+        self.ui.find_key()
+        self.assertTrue(self.ui.tmpkeyring.get_keys('96F47C6A'))
+
 class SigningTests(BaseTestCase):
     pattern = '7B75921E'
 
@@ -168,10 +225,9 @@ this duplicates tests from the gpg code, but is necessary to test later function
                 msg = EmailFactory(self.ui.tmpkeyring.export_data(fpr), fpr, uid.uid, 'unittests@localhost', 'devnull@localhost')
                 if oldmsg is not None:
                     self.assertNotEqual(oldmsg.as_string(), msg.as_string())
-                    self.assertNotEqual(oldmsg.create_mail_from_block(oldmsg.tmpkeyring.export_data(fpr)).as_string(),
-                                        msg.create_mail_from_block(oldmsg.tmpkeyring.export_data(fpr)).as_string())
-                    self.assertNotEqual(oldmsg.tmpkeyring.export_data(fpr),
-                                        msg.tmpkeyring.export_data(fpr))
+                    self.assertNotEqual(oldmsg.create_mail_from_block(oldmsg.keydata).as_string(),
+                                        msg.create_mail_from_block(msg.keydata).as_string())
+                    self.assertNotEqual(oldmsg.keydata, msg.keydata)
                 oldmsg = msg
             self.assertIsNot(oldmsg, None)
 
@@ -189,13 +245,28 @@ class EmailFactoryTest(BaseTestCase):
 
     def test_cleanup_uids(self):
         """test if we can properly remove irrelevant UIDs"""
-        for fpr, key in self.email.tmpkeyring.get_keys('7B75921E').iteritems():
-            for u, uid in key.uids.iteritems():
-                self.assertEqual(self.email.recipient, uid.uid)
+        keys = list(PacketReader(dearmor(self.email.keydata)).keys())
+        self.assertEqual(len(keys), 1)
+        self.assertEqual([ uid.uid for uid in keys[0].uidslist ], [self.email.recipient])
+        self.assertEqual(len(keys[0].subkeys), 4)
+        # the filtered key is what gpg would export
+        self.assertTrue(self.ui.keyring.import_data(self.email.keydata))
+        with self.assertRaises(GpgRuntimeError):
+            EmailFactory(self.ui.tmpkeyring.export_data(self.pattern), self.pattern, 'nobody', 'nobody@example.com', 'nobody@example.com')
+
+    def test_colon_uid(self):
+        """uids with colons should be found on the key"""
+        self.assertTrue(self.ui.tmpkeyring.import_data(open(os.path.dirname(__file__) + '/colon-uid.asc').read()))
+        fpr = 'C0310ABE68836B23A285001C834BDD89DA8332AD'
+        uid = self.ui.tmpkeyring.get_keys(fpr)[fpr].uidslist[0].uid
+        self.assertIn('\\x3a', uid)
+        email = EmailFactory(self.ui.tmpkeyring.export_data(fpr), fpr, uid, 'nobody@example.com', 'nobody@example.com')
+        keys = list(PacketReader(dearmor(email.keydata)).keys())
+        self.assertEqual([ u.uid for u in keys[0].uidslist ], [uid])
 
     def test_mail_key(self):
         """test if we can generate a mail with a key inside"""
-        data = self.email.tmpkeyring.export_data(self.pattern)
+        data = self.email.keydata
         self.assertNotEqual(data, '')
         message = self.email.create_mail_from_block(data)
         match = re.compile("""Content-Type: multipart/mixed; boundary="===============[0-9]*=="